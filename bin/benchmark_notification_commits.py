@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Measures the commit latency of a notification that grants an user access to
+many datasets when every dataset is committed on its own (as notifications
+were processed before) and when the whole notification is committed at once,
+with a savepoint per dataset (as they are processed now).
+
+Usage:
+
+    python bin/benchmark_notification_commits.py [-d DATASETS] [-r ROUNDS] [URL]
+
+URL is the SQLAlchemy URL of the database used by the benchmark (a temporary
+SQLite file by default). Use a PostgreSQL database to get the numbers of a real
+deployment. The benchmark creates and drops its own table.
+'''
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import sqlalchemy as sa
+
+metadata = sa.MetaData()
+
+# Same primary key as the package_allowed_users table
+grants_table = sa.Table(
+    'privatedatasets_benchmark_grants',
+    metadata,
+    sa.Column('package_id', sa.types.UnicodeText, primary_key=True),
+    sa.Column('user_name', sa.types.UnicodeText, primary_key=True),
+)
+
+
+def _enable_sqlite_savepoints(engine):
+    # pysqlite does not support savepoints unless transactions are started explicitly
+    @sa.event.listens_for(engine, 'connect')
+    def _connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @sa.event.listens_for(engine, 'begin')
+    def _begin(connection):
+        connection.execute('BEGIN')
+
+
+def _grants(datasets, user_name):
+    return [{'package_id': u'pkg%d' % i, 'user_name': user_name} for i in range(datasets)]
+
+
+def commit_per_dataset(connection, grants):
+    for grant in grants:
+        with connection.begin():
+            connection.execute(grants_table.insert(), grant)
+
+
+def single_transaction(connection, grants):
+    with connection.begin():
+        for grant in grants:
+            with connection.begin_nested():
+                connection.execute(grants_table.insert(), grant)
+
+
+def run(engine, datasets, rounds):
+    results = {}
+    connection = engine.connect()
+    try:
+        for strategy in (commit_per_dataset, single_transaction):
+            timings = []
+            for i in range(rounds):
+                grants = _grants(datasets, u'%s-%d' % (strategy.__name__, i))
+                start = time.time()
+                strategy(connection, grants)
+                timings.append(time.time() - start)
+            results[strategy.__name__] = sorted(timings)[len(timings) // 2]
+    finally:
+        connection.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Commit latency of the notifications')
+    parser.add_argument('url', nargs='?', help='SQLAlchemy URL of the database (a temporary SQLite file by default)')
+    parser.add_argument('-d', '--datasets', type=int, default=500, help='Datasets included in each notification')
+    parser.add_argument('-r', '--rounds', type=int, default=5, help='Notifications processed with each strategy')
+    args = parser.parse_args()
+
+    directory = None
+    url = args.url
+    if url is None:
+        directory = tempfile.mkdtemp()
+        url = 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+
+    engine = sa.create_engine(url)
+    if engine.dialect.name == 'sqlite':
+        _enable_sqlite_savepoints(engine)
+
+    metadata.create_all(engine)
+    try:
+        results = run(engine, args.datasets, args.rounds)
+    finally:
+        metadata.drop_all(engine)
+        engine.dispose()
+        if directory is not None:
+            shutil.rmtree(directory)
+
+    print('Notifications of %d datasets (median of %d rounds, %s)' % (args.datasets, args.rounds, engine.dialect.name))
+    for strategy in ('commit_per_dataset', 'single_transaction'):
+        print('  %-20s %8.1f ms  %6.3f ms/dataset' % (strategy, results[strategy] * 1000,
+                                                       results[strategy] * 1000 / args.datasets))
+    print('  speedup              %8.1fx' % (results['commit_per_dataset'] / results['single_transaction']))
+
+
+if __name__ == '__main__':
+    main()
@@ -22,16 +22,47 @@ from __future__ import absolute_import
 
 import importlib
 import logging
-import os
 
+from ckan import model
+from ckan.common import _, request
+import ckan.lib.helpers as helpers
+from ckan.lib import search
 import ckan.plugins as plugins
 
-from ckanext.privatedatasets import constants, db
+from ckanext.privatedatasets import bloom, cache, constants, converters_validators as conv_val, db, indexer, settings
 
 
 log = logging.getLogger(__name__)
 
-PARSER_CONFIG_PROP = 'ckan.privatedatasets.parser'
+PARSER_CONFIG_PROP = constants.PARSER
+
+# Parser classes indexed by their path
+_parser_classes = {}
+
+
+@plugins.toolkit.chained_action
+def package_show(up_func, context, data_dict):
+    '''
+    Shows a flash message with the URL to acquire the dataset when an user tries
+    to access a private dataset that cannot read via its URL (/dataset/...).
+
+    The message cannot be displayed in other pages that uses the package_show
+    function such as the user profile page, so this check is not performed in
+    the package_show auth function. In this way, API calls and background jobs
+    do not pay for it.
+    '''
+    try:
+        return up_func(context, data_dict)
+    except plugins.toolkit.NotAuthorized:
+        package = context.get('package')
+
+        if context.get('for_view') and package is not None and request.path.startswith('/dataset/'):
+            acquire_url = package.extras.get(constants.ACQUIRE_URL, '')
+            if acquire_url != '':
+                helpers.flash_notice(_('This private dataset can be acquired. To do so, please click ' +
+                                       '<a target="_blank" href="%s">here</a>') % acquire_url,
+                                     allow_html=True)
+        raise
 
 
 def package_acquired(context, request_data):
@@ -82,9 +113,6 @@ def acquisitions_list(context, data_dict):
 
     plugins.toolkit.check_access(constants.ACQUISITIONS_LIST, context.copy(), data_dict)
 
-    # Init db
-    db.init_db(context['model'])
-
     # Init the result array
     result = []
 
@@ -95,13 +123,13 @@ def acquisitions_list(context, data_dict):
         raise plugins.toolkit.ValidationError('User %s does not exist' % data_dict['user'])
 
     # Get the datasets acquired by the user
-    query = db.AllowedUser.get(user_name=data_dict['user'])
+    package_ids = db.AllowedUser.iter_by_user(data_dict['user'])
 
     # Get the datasets
-    for dataset in query:
+    for package_id in package_ids:
         try:
             dataset_show_func = 'package_show'
-            func_data_dict = {'id': dataset.package_id}
+            func_data_dict = {'id': package_id}
             internal_context = context.copy()
 
             # Check that the the dataset can be accessed and get its data
@@ -145,15 +173,251 @@ def revoke_access(context, request_data):
     return _process_package(context, request_data)
 
 
-def _process_package(context, request_data):
-    log.info('Notification received: %s' % request_data)
+def bundle_show(context, data_dict):
+    '''
+    API action to retrieve a bundle: a named set of datasets that can be acquired
+    as a whole.
 
-    # Check access
-    method = constants.PACKAGE_ACQUIRED if context.get('method') == 'grant' else constants.PACKAGE_DELETED
-    plugins.toolkit.check_access(method, context, request_data)
+    :parameter id: The id or name of the bundle
+    :type id: string
+
+    :return: The bundle with its id, name, title and the ids of its datasets
+    :rtype: dict
+    '''
+    plugins.toolkit.check_access(constants.BUNDLE_SHOW, context, data_dict)
+    return _bundle_dict(_get_bundle(data_dict))
+
+
+def bundle_create(context, data_dict):
+    '''
+    API action to create a bundle. Users are granted every dataset of a bundle
+    by including it in the `bundles` field of a notification, so acquiring it
+    only stores one grant regardless of the number of datasets it contains.
+
+    :parameter name: The name of the bundle
+    :type name: string
+    :parameter title: The title of the bundle (optional)
+    :type title: string
+    :parameter packages: The ids or names of the datasets of the bundle (optional)
+    :type packages: list
+
+    :return: The created bundle
+    :rtype: dict
+    '''
+    plugins.toolkit.check_access(constants.BUNDLE_CREATE, context, data_dict)
+
+    name = _get_bundle_name(data_dict)
+    package_ids = _get_bundle_package_ids(data_dict.get('packages', []))
+
+    bundle_id = db.Bundle.create(name, data_dict.get('title'))
+    added, _ = db.Bundle.set_packages(bundle_id, package_ids)
+    model.Session.commit()
+
+    _reindex_packages(added)
+    return _bundle_dict(db.Bundle.get(bundle_id))
+
+
+def bundle_update(context, data_dict):
+    '''
+    API action to update a bundle. Only the fields that are included are updated.
+
+    :parameter id: The id or name of the bundle
+    :type id: string
+    :parameter name: The new name of the bundle (optional)
+    :type name: string
+    :parameter title: The new title of the bundle (optional)
+    :type title: string
+    :parameter packages: The ids or names of the datasets of the bundle (optional)
+    :type packages: list
+
+    :return: The updated bundle
+    :rtype: dict
+    '''
+    plugins.toolkit.check_access(constants.BUNDLE_UPDATE, context, data_dict)
+    bundle = _get_bundle(data_dict)
+
+    values = {}
+    if 'name' in data_dict and data_dict['name'] != bundle.name:
+        values['name'] = _get_bundle_name(data_dict)
+    if 'title' in data_dict:
+        values['title'] = data_dict['title']
+    if values:
+        db.Bundle.update(bundle.id, **values)
+
+    changed = []
+    if 'packages' in data_dict:
+        added, removed = db.Bundle.set_packages(bundle.id, _get_bundle_package_ids(data_dict['packages']))
+        changed = added + removed
+    model.Session.commit()
+
+    _reindex_packages(changed)
+    return _bundle_dict(db.Bundle.get(bundle.id))
+
+
+def bundle_delete(context, data_dict):
+    '''
+    API action to delete a bundle. Users that acquired it lose access to its datasets.
+
+    :parameter id: The id or name of the bundle
+    :type id: string
+    '''
+    plugins.toolkit.check_access(constants.BUNDLE_DELETE, context, data_dict)
+    bundle = _get_bundle(data_dict)
+
+    package_ids = db.Bundle.delete(bundle.id)
+    model.Session.commit()
+
+    _reindex_packages(package_ids)
+
+
+def _get_bundle(data_dict):
+    bundle = db.Bundle.get(data_dict.get('id'))
+    if bundle is None:
+        raise plugins.toolkit.ObjectNotFound('Bundle %s was not found in this instance' % data_dict.get('id'))
+    return bundle
+
+
+def _get_bundle_name(data_dict):
+    name = data_dict.get('name')
+    if not name:
+        raise plugins.toolkit.ValidationError({'name': ['Missing value']})
+    if db.Bundle.get(name) is not None:
+        raise plugins.toolkit.ValidationError({'name': ['Bundle name already in use']})
+    return name
+
+
+def _get_bundle_package_ids(packages):
+    package_ids = []
+    for id_or_name in packages:
+        package = model.Package.get(id_or_name)
+        if package is None:
+            raise plugins.toolkit.ValidationError({'packages': ['Dataset %s was not found in this instance' % id_or_name]})
+        package_ids.append(package.id)
+    return package_ids
+
+
+def _bundle_dict(bundle):
+    return {'id': bundle.id, 'name': bundle.name, 'title': bundle.title,
+            'packages': db.Bundle.get_package_ids(bundle.id)}
+
+
+def _reindex_packages(package_ids):
+    # Datasets are labelled with their bundles, so they have to be reindexed when
+    # they are added to or removed from a bundle (but not when a bundle is acquired)
+    for package_id in package_ids:
+        search.rebuild(package_id, defer_commit=True)
+    if package_ids:
+        search.commit()
 
-    # Get the parser from the configuration
-    class_path = os.environ.get(PARSER_CONFIG_PROP.upper().replace('.', '_'), plugins.toolkit.config.get(PARSER_CONFIG_PROP, ''))
+
+def allowed_users_patch(context, data_dict):
+    '''
+    API action to add users to (or remove them from) the list of allowed users of
+    a private dataset without sending the whole list. Only the given users are
+    read and written, so its cost depends on the number of changes instead of on
+    the number of allowed users.
+
+    :parameter id: The id or name of the dataset
+    :type id: string
+    :parameter add: The names of the users to allow (optional). Users that are
+        already allowed are kept, but their expiry date is updated
+    :type add: list
+    :parameter remove: The names of the users to remove (optional)
+    :type remove: list
+    :parameter expires_at: The UTC date (ISO 8601) when the access of the added
+        users expires (optional, it never expires by default)
+    :type expires_at: string
+
+    :return: The id of the dataset and the outcome for each user: added (also
+        when an expired grant is renewed), updated (already allowed), removed or
+        not_allowed (it could not be removed because it was not allowed)
+    :rtype: dict
+    '''
+    plugins.toolkit.check_access(constants.ALLOWED_USERS_PATCH, context, data_dict)
+
+    package = model.Package.get(data_dict.get('id'))
+    if package is None:
+        raise plugins.toolkit.ObjectNotFound('Dataset %s was not found in this instance' % data_dict.get('id'))
+    if not package.private:
+        raise plugins.toolkit.ValidationError({constants.ALLOWED_USERS: [
+            'This field is only valid when you create a private dataset']})
+
+    add = _get_user_names(data_dict, 'add', context)
+    remove = _get_user_names(data_dict, 'remove', context)
+    both = set(add).intersection(remove)
+    if both:
+        raise plugins.toolkit.ValidationError({'remove': ['Users cannot be added and removed at the same time: %s'
+                                                          % ', '.join(sorted(both))]})
+    expires_at = conv_val.parse_expires_at(data_dict.get(constants.EXPIRES_AT))
+
+    # Users that were already allowed get the new expiry date (upsert). The
+    # lock is held until the changes are committed
+    db.lock_package(package.id)
+    granted = [(package.id, user) for user in add]
+    active = db.AllowedUser.get_existing(granted, include_expired=False)
+    added = [user_name for _, user_name in db.AllowedUser.bulk_grant(granted, expires_at)]
+    outcomes = dict((user_name, 'added') for user_name in added)
+    for user_name in add:
+        if user_name not in outcomes:
+            db.AllowedUser.set_expiry(package.id, user_name, expires_at)
+            if (package.id, user_name) in active:
+                outcomes[user_name] = 'updated'
+            else:
+                # Expired grants that have not been swept yet are renewed, so the user is added again
+                outcomes[user_name] = 'added'
+                added.append(user_name)
+
+    revoked = [(package.id, user_name) for user_name in remove]
+    removed = [user_name for _, user_name in sorted(db.AllowedUser.get_existing(revoked))]
+    db.AllowedUser.bulk_revoke(revoked)
+    for user_name in remove:
+        outcomes[user_name] = 'removed' if user_name in removed else 'not_allowed'
+
+    model.Session.commit()
+    cache.forget_package(package.id)
+    bloom.add_grants(package.id, added)
+    cache.forget_acquired(add + remove)
+
+    # The labels of the users are only updated when the list has changed
+    if (added or removed) and settings.get().incremental_index:
+        labels_indexer = indexer.PermissionLabelsIndexer()
+        user_ids = db.get_user_ids(added + removed)
+        # Users that signed up after being granted may still be labelled by name
+        removed_labels = set(constants.PENDING_USER_LABEL % user for user in removed)
+        removed_labels.update(indexer.user_label(user_ids.get(user), user) for user in removed)
+        with indexer.batch():
+            if added:
+                labels_indexer.add_labels(package.id, [indexer.user_label(user_ids.get(user), user) for user in added])
+            if removed:
+                labels_indexer.remove_labels(package.id, sorted(removed_labels))
+    elif added or removed:
+        # The dataset is reindexed as when its whole list is updated, so it may be queued
+        plugins.get_plugin('privatedatasets').reindex_package(package.id)
+
+    return {'id': package.id, 'users': outcomes}
+
+
+def _get_user_names(data_dict, field, context):
+    user_names = data_dict.get(field) or []
+    if not isinstance(user_names, list):
+        raise plugins.toolkit.ValidationError({field: ['The list of users is not valid']})
+
+    result = []
+    for user_name in user_names:
+        # User names should be validated
+        try:
+            plugins.toolkit.get_validator('name_validator')(user_name, context)
+        except plugins.toolkit.Invalid as e:
+            raise plugins.toolkit.ValidationError({field: ['%s: %s' % (user_name, e.error)]})
+        if user_name not in result:
+            result.append(user_name)
+    return result
+
+
+def _get_parser_class(class_path):
+    # The parser class is only imported the first time it is used
+    if class_path in _parser_classes:
+        return _parser_classes[class_path]
 
     if class_path != '':
         try:
@@ -161,23 +425,118 @@ def _process_package(context, request_data):
             class_package = cls[0]
             class_name = cls[1]
             parser_cls = getattr(importlib.import_module(class_package), class_name)
-            parser = parser_cls()
         except Exception as e:
             raise plugins.toolkit.ValidationError({'message': '%s: %s' % (type(e).__name__, str(e))})
     else:
         raise plugins.toolkit.ValidationError({'message': '%s not configured' % PARSER_CONFIG_PROP})
 
+    _parser_classes[class_path] = parser_cls
+    return parser_cls
+
+
+def _process_package(context, request_data):
+    log.info('Notification received: %s' % request_data)
+
+    # Check access
+    method = constants.PACKAGE_ACQUIRED if context.get('method') == 'grant' else constants.PACKAGE_DELETED
+    plugins.toolkit.check_access(method, context, request_data)
+
+    # Get the parser from the configuration
+    parser_cls = _get_parser_class(settings.get().parser)
+    try:
+        parser = parser_cls()
+    except Exception as e:
+        raise plugins.toolkit.ValidationError({'message': '%s: %s' % (type(e).__name__, str(e))})
+
     # Parse the result using the parser set in the configuration
     # Expected result: {'errors': ["...", "...", ...]
-    #                   'users_datasets': [{'user': 'user_name', 'datasets': ['ds1', 'ds2', ...]}, ...]}
+    #                   'users_datasets': [{'user': 'user_name', 'datasets': ['ds1', 'ds2', ...],
+    #                                       'organizations': ['org1', ...], 'creators': ['user1', ...],
+    #                                       'expires_at': '2018-12-31T23:59:59Z'}, ...]}
     result = parser.parse_notification(request_data)
 
+    # Notifications with scoped grants require further permissions, which are checked
+    # before any grant is changed
+    scoped = any(user_info.get(field) for user_info in result['users_datasets']
+                 for field in constants.SCOPED_GRANT_FIELDS.values())
+    if scoped:
+        plugins.toolkit.check_access(constants.SCOPED_GRANTS, context, request_data)
+
+    # Expiry dates are optional, but they are validated before any grant is changed
+    for user_info in result['users_datasets']:
+        if constants.EXPIRES_AT in user_info:
+            user_info[constants.EXPIRES_AT] = conv_val.parse_expires_at(user_info[constants.EXPIRES_AT])
+
     warns = []
 
+    # The whole notification is applied in a single transaction. Label updates are
+    # sent to Solr once it has been committed (and discarded if it fails)
+    with indexer.batch():
+        try:
+            _update_datasets(context, result, warns)
+
+            # Grants of every dataset of an organization or a creator are stored as a single
+            # row, so they do not have to update any dataset
+            _update_scoped_grants(context, result, warns)
+
+            model.Session.commit()
+        except Exception:
+            model.Session.rollback()
+            raise
+
+    # Return warnings that inform about non-existing datasets
+    if len(warns) > 0:
+        return {'warns': warns}
+
+
+def _get_scope_target_id(scope, target):
+    if scope == constants.SCOPE_ORGANIZATION:
+        group = model.Group.get(target)
+        return group.id if group is not None and group.is_organization else None
+    elif scope == constants.SCOPE_BUNDLE:
+        bundle = db.Bundle.get(target)
+        return bundle.id if bundle is not None else None
+    else:
+        user = model.User.get(target)
+        return user.id if user is not None else None
+
+
+def _update_scoped_grants(context, result, warns):
+    for user_info in result['users_datasets']:
+        for scope, field in sorted(constants.SCOPED_GRANT_FIELDS.items()):
+            for target in user_info.get(field) or []:
+                target_id = _get_scope_target_id(scope, target)
+                if target_id is None:
+                    log.warn('%s %s was not found in this instance' % (scope.capitalize(), target))
+                    warns.append('%s %s was not found in this instance' % (scope.capitalize(), target))
+                elif context['method'] == 'grant':
+                    db.ScopedGrant.grant(scope, target_id, user_info['user'], user_info.get(constants.EXPIRES_AT))
+                else:
+                    db.ScopedGrant.revoke(scope, target_id, user_info['user'])
+
+
+def _rollback(savepoint):
+    # package_update may have rolled it back already
+    if savepoint.is_active:
+        savepoint.rollback()
+
+
+def _update_datasets(context, result, warns):
+    # Datasets are locked beforehand (in order), so the lists of allowed users cannot be
+    # changed by another notification between reading and updating them
+    dataset_ids = [dataset_id for user_info in result['users_datasets'] for dataset_id in user_info.get('datasets', [])]
+    package_ids = db.get_package_ids(dataset_ids)
+    db.lock_packages(package_ids.values())
+
     for user_info in result['users_datasets']:
-        for dataset_id in user_info['datasets']:
+        for dataset_id in user_info.get('datasets', []):
 
+            # Each dataset is updated in its own savepoint, so a failure only discards its changes
+            savepoint = model.Session.begin_nested()
             try:
+                if dataset_id not in package_ids:
+                    raise plugins.toolkit.ObjectNotFound()
+
                 context_pkg_show = context.copy()
                 context_pkg_show['ignore_auth'] = True
                 context_pkg_show[constants.CONTEXT_CALLBACK] = True
@@ -202,8 +561,10 @@ def _process_package(context, request_data):
                         else:
                             dataset[constants.ALLOWED_USERS].remove(user_info['user'])
 
+                        # Changes are committed once the whole notification has been processed
                         context_pkg_update = context.copy()
                         context_pkg_update['ignore_auth'] = True
+                        context_pkg_update['defer_commit'] = True
 
                         # Set creator as the user who is performing the changes
                         user_show = plugins.toolkit.get_action('user_show')
@@ -216,13 +577,21 @@ def _process_package(context, request_data):
                         log.info('Action %s access to dataset ended successfully' % context['method'])
                     else:
                         log.warn('Action %s access to dataset not completed. The dataset %s already %s access to the user %s' % (context['method'], dataset_id, context['method'], user_info['user']))
+
+                    # The expiry date is also set (or renewed) when the user was already allowed
+                    if method and constants.EXPIRES_AT in user_info:
+                        db.AllowedUser.set_expiry(dataset['id'], user_info['user'], user_info[constants.EXPIRES_AT])
+                        cache.forget_acquired([user_info['user']])
                 else:
                     log.warn('Dataset %s is public. Cannot %s access to users' % (dataset_id, context['method']))
                     warns.append('Unable to upload the dataset %s: It\'s a public dataset' % dataset_id)
 
+                savepoint.commit()
+
             except plugins.toolkit.ObjectNotFound:
                 # If a dataset does not exist in the instance, an error message will be returned to the user.
                 # However the process won't stop and the process will continue with the remaining datasets.
+                _rollback(savepoint)
                 log.warn('Dataset %s was not found in this instance' % dataset_id)
                 warns.append('Dataset %s was not found in this instance' % dataset_id)
             except plugins.toolkit.ValidationError as e:
@@ -230,10 +599,7 @@ def _process_package(context, request_data):
                 # only valid for private datasets outside an organization. In this case, a wanr will return
                 # but the process will continue
                 # WARN: This exception should not be risen anymore since public datasets are not updated.
+                _rollback(savepoint)
                 message = '%s(%s): %s' % (dataset_id, constants.ALLOWED_USERS, e.error_dict[constants.ALLOWED_USERS][0])
                 log.warn(message)
                 warns.append(message)
-
-    # Return warnings that inform about non-existing datasets
-    if len(warns) > 0:
-        return {'warns': warns}
@@ -19,23 +19,35 @@
 
 from __future__ import absolute_import
 
-import ckan.authz as authz
-from ckan.common import _, request
-import ckan.lib.helpers as helpers
+from ckan.common import _
 import ckan.logic.auth as logic_auth
 import ckan.plugins.toolkit as tk
 
-from ckanext.privatedatasets import db
+from ckanext.privatedatasets import cache, settings
+
+
+def _get_package_meta(context, data_dict):
+    # The package_show action stores the package in the context, so it does not
+    # have to be loaded again
+    package = context.get('package')
+    if package is not None:
+        return cache.PackageMeta.from_package(package)
+
+    package = cache.get_package_meta(data_dict.get('id'))
+    if package is None:
+        raise tk.ObjectNotFound(_('No package found for this resource, cannot check auth.'))
+
+    return package
 
 
 @tk.auth_allow_anonymous_access
 def package_show(context, data_dict):
     user = context.get('user')
     user_obj = context.get('auth_user_obj')
-    package = logic_auth.get_package_object(context, data_dict)
+    package = _get_package_meta(context, data_dict)
 
     # datasets can be read by its creator
-    if package and user_obj and package.creator_user_id == user_obj.id:
+    if user_obj and package.creator_user_id == user_obj.id:
         return {'success': True}
 
     # Not active packages can only be seen by its owners
@@ -46,33 +58,25 @@ def package_show(context, data_dict):
 
         # if the user has rights to read in the organization or in the group
         if package.owner_org:
-            authorized = authz.has_user_permission_for_group_or_org(
-                package.owner_org, user, 'read')
+            authorized = cache.has_user_permission_for_group_or_org(package.owner_org, user, 'read')
         else:
             authorized = False
 
         # if the user is not authorized yet, we should check if the
-        # user is in the allowed_users object
-        if not authorized:
-            # Init the model
-            db.init_db(context['model'])
+        # user is in the allowed_users object. Anonymous users cannot be
+        # included in this list.
+        if not authorized and user:
+            authorized = cache.is_granted(package.id, user)
 
-            # Branch not executed if the database return an empty list
-            if db.AllowedUser.get(package_id=package.id, user_name=user):
-                authorized = True
-
-        if not authorized:
-            # Show a flash message with the URL to acquire the dataset
-            # This message only can be shown when the user tries to access the dataset via its URL (/dataset/...)
-            # The message cannot be displayed in other pages that uses the package_show function such as
-            # the user profile page
+        # or if the user belongs to one of the allowed groups
+        if not authorized and user:
+            authorized = cache.has_group_grant(package.id, user)
 
-            if hasattr(package, 'extras') and 'acquire_url' in package.extras and request.path.startswith('/dataset/')\
-                    and package.extras['acquire_url'] != '':
-                helpers.flash_notice(_('This private dataset can be acquired. To do so, please click ' +
-                                       '<a target="_blank" href="%s">here</a>') % package.extras['acquire_url'],
-                                     allow_html=True)
+        # or if the user has been granted every dataset of the organization or the creator
+        if not authorized and user:
+            authorized = cache.has_scoped_grant(package, user)
 
+        if not authorized:
             return {'success': False, 'msg': _('User %s not authorized to read package %s') % (user, package.id)}
         else:
             return {'success': True}
@@ -91,7 +95,7 @@ def package_update(context, data_dict):
 
     # if the user has rights to update a dataset in the organization or in the group
     if package and package.owner_org:
-        authorized = authz.has_user_permission_for_group_or_org(
+        authorized = cache.has_user_permission_for_group_or_org(
             package.owner_org, user, 'update_dataset')
     else:
         authorized = False
@@ -102,6 +106,11 @@ def package_update(context, data_dict):
         return {'success': True}
 
 
+def allowed_users_patch(context, data_dict):
+    # Users that can update a dataset can also change its allowed users
+    return package_update(context, data_dict)
+
+
 @tk.auth_allow_anonymous_access
 def resource_show(context, data_dict):
     # This function is needed since CKAN resource_show function uses the default package_show
@@ -137,6 +146,15 @@ def package_acquired(context, data_dict):
     return {'success': True}
 
 
+def scoped_grants(context, data_dict):
+    # Scoped grants give access to every dataset of an organization, a creator or a bundle,
+    # so only sysadmins (who skip the auth functions) and the notifier users can change them
+    user = context.get('user')
+    if user and user in settings.get().notifier_users:
+        return {'success': True}
+    return {'success': False, 'msg': _('User %s not authorized to change scoped grants') % user}
+
+
 def acquisitions_list(context, data_dict):
     # Users can get only their acquisitions list
     return {'success': context['user'] == data_dict['user']}
@@ -146,3 +164,8 @@ def acquisitions_list(context, data_dict):
 def revoke_access(context, data_dict):
     # TODO: Check functionality and improve security(if needed)
     return {'success': True}
+
+
+def manage_bundles(context, data_dict):
+    # Only sysadmins (who skip the auth functions) can manage bundles
+    return {'success': False, 'msg': _('User %s not authorized to manage bundles') % context.get('user')}
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import absolute_import
+
+import hashlib
+import logging
+import math
+import struct
+import threading
+import time
+
+from ckan import model
+
+from ckanext.privatedatasets import db, settings
+
+
+log = logging.getLogger(__name__)
+
+_grants_filter = None
+_grants_filter_lock = threading.Lock()
+
+
+class BloomFilter(object):
+    '''
+    Set of keys that can answer that a key has never been added without storing
+    the keys. It may answer that a key has been added when it has not (with a
+    probability close to `error_rate` while it holds `capacity` keys or less),
+    but never the other way round. Its bits array never uses more than
+    `max_bytes` bytes, which raises the error rate when it is too small.
+    '''
+
+    def __init__(self, capacity, error_rate=0.01, max_bytes=None):
+        capacity = max(capacity, 1)
+        size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        if max_bytes is not None and size > max_bytes * 8:
+            size = max_bytes * 8
+
+        self.capacity = capacity
+        self.size = max(size, 8)
+        self.hashes = max(int(round(float(self.size) / capacity * math.log(2))), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    @property
+    def error_rate(self):
+        '''Expected probability of a false positive once `capacity` keys have been added.'''
+        return (1 - math.exp(-float(self.hashes) * self.capacity / self.size)) ** self.hashes
+
+    def _positions(self, key):
+        # Double hashing: the positions are derived from the two halves of a single digest
+        digest = hashlib.md5(key.encode('utf-8')).digest()
+        first, second = struct.unpack('<QQ', digest)
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def __len__(self):
+        return len(self._bits)
+
+
+def _grant_key(package_id, user_name):
+    return '%s\n%s' % (package_id, user_name)
+
+
+class GrantsFilter(object):
+    '''
+    Bloom filter of the grants of the allowed users, so most of the users that
+    have not been granted a dataset are answered without querying the database.
+    It is kept per process and rebuilt in a background thread every `refresh`
+    seconds. While it is being built (and when it is older than `refresh`
+    seconds) the database is always queried, so grants stored by other processes
+    are taken into account after `refresh` seconds at most. Grants stored by the
+    current process are added as soon as they are stored.
+    '''
+
+    def __init__(self, refresh, error_rate=0.01, max_memory=16):
+        self.refresh = refresh
+        self.error_rate = error_rate
+        self.max_memory = max_memory
+        self._filter = None
+        self._built_at = 0
+        self._added = None
+        self._lock = threading.Lock()
+
+    def might_be_granted(self, package_id, user_name):
+        '''Returns False when the user has not been granted the package for sure.'''
+        bloom = self._filter
+        if bloom is None or time.time() - self._built_at >= self.refresh:
+            self._start_rebuild()
+            return True
+        return _grant_key(package_id, user_name) in bloom
+
+    def add(self, package_id, user_name):
+        '''Adds a grant stored by the current process.'''
+        key = _grant_key(package_id, user_name)
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(key)
+            # Grants stored while the filter is being built may not be read by it
+            if self._added is not None:
+                self._added.append(key)
+
+    def _start_rebuild(self):
+        with self._lock:
+            if self._added is not None:
+                return
+            self._added = []
+
+        thread = threading.Thread(target=self._rebuild_later)
+        thread.daemon = True
+        thread.start()
+
+    def _rebuild_later(self):
+        try:
+            self.rebuild()
+        except Exception:
+            log.exception('Error while building the filter of the grants')
+            with self._lock:
+                self._added = None
+        finally:
+            model.Session.remove()
+
+    def rebuild(self):
+        '''Builds the filter again from the grants stored in the database.'''
+        with self._lock:
+            if self._added is None:
+                self._added = []
+
+        built_at = time.time()
+        # Room for the grants added until it is built again
+        capacity = int(db.AllowedUser.count() * 1.1) + 1000
+        bloom = BloomFilter(capacity, self.error_rate, self.max_memory * 1024 * 1024)
+        grants = 0
+        for package_id, user_name in db.AllowedUser.iter_grants():
+            bloom.add(_grant_key(package_id, user_name))
+            grants += 1
+
+        with self._lock:
+            for key in self._added:
+                bloom.add(key)
+            self._filter = bloom
+            self._built_at = built_at
+            self._added = None
+
+        log.debug('Filter of %d grants built in %.2f seconds (%d bytes, %.4f false positive rate)',
+                  grants, time.time() - built_at, len(bloom), bloom.error_rate)
+
+
+def get_grants_filter():
+    '''Returns the filter of the grants of this process, or None when it is disabled.'''
+    global _grants_filter
+
+    config = settings.get()
+    if not config.grants_filter_refresh:
+        return None
+
+    if _grants_filter is None:
+        with _grants_filter_lock:
+            if _grants_filter is None:
+                _grants_filter = GrantsFilter(config.grants_filter_refresh, config.grants_filter_error_rate,
+                                              config.grants_filter_max_memory)
+    return _grants_filter
+
+
+def might_be_granted(package_id, user_name):
+    '''Returns False when the user has not been granted the package for sure.'''
+    grants_filter = get_grants_filter()
+    return grants_filter is None or grants_filter.might_be_granted(package_id, user_name)
+
+
+def add_grants(package_id, user_names):
+    '''Adds the grants stored by the current process to its filter.'''
+    grants_filter = get_grants_filter()
+    if grants_filter is not None:
+        for user_name in user_names:
+            grants_filter.add(package_id, user_name)
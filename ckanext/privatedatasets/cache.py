@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import calendar
+from collections import namedtuple, OrderedDict
+import logging
+import threading
+import time
+
+from ckan import authz, model
+from ckan.plugins import toolkit as tk
+import sqlalchemy as sa
+
+from ckanext.privatedatasets import bloom, constants, db, settings, snapshot
+
+
+log = logging.getLogger(__name__)
+
+CACHE_ATTR = '_privatedatasets_cache'
+PACKAGES = 'packages'
+GRANTS = 'grants'
+SCOPED_GRANTS = 'scoped_grants'
+BUNDLES = 'bundles'
+ALLOWED_GROUPS = 'allowed_groups'
+USERS = 'users'
+MEMBERSHIPS = 'memberships'
+PARENT_GROUPS = 'parent_groups'
+ROLES = 'roles'
+ACQUIRED = 'acquired'
+
+
+class PackageMeta(namedtuple('PackageMeta', ['id', 'private', 'state', 'owner_org', 'creator_user_id'])):
+    '''The attributes of a package required to check whether an user can read it.'''
+
+    @classmethod
+    def from_package(cls, package):
+        return cls(package.id, package.private, package.state, package.owner_org, package.creator_user_id)
+
+
+UserMeta = namedtuple('UserMeta', ['id', 'sysadmin'])
+
+# The ids of the packages an user has acquired and the time (as returned by
+# time.time) until they can be used
+AcquiredPackages = namedtuple('AcquiredPackages', ['package_ids', 'valid_until'])
+
+
+class LRUCache(object):
+    '''
+    Thread safe cache that keeps the `maxsize` most recently used values. It
+    counts its hits and misses, and logs them (at debug level) every
+    `stats_interval` lookups so its efficiency can be monitored.
+    '''
+
+    def __init__(self, maxsize=1000, name='LRU', stats_interval=10000):
+        self.maxsize = maxsize
+        self.name = name
+        self.stats_interval = stats_interval
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def log_stats(self):
+        log.debug('%s cache: %.1f%% hit rate (%d hits, %d misses), %d values', self.name, 100 * self.hit_rate,
+                  self.hits, self.misses, len(self))
+
+    def get(self, key, loader):
+        '''Returns the value stored for `key`, calling `loader` to get it when it is not cached.'''
+        with self._lock:
+            cached = key in self._values
+            if cached:
+                self.hits += 1
+                # Mark the value as the most recently used one
+                value = self._values.pop(key)
+                self._values[key] = value
+            else:
+                self.misses += 1
+            lookups = self.hits + self.misses
+
+        if lookups % self.stats_interval == 0:
+            self.log_stats()
+
+        if cached:
+            return value
+
+        # The lock is not held while loading, so slow loaders do not block the cache
+        value = loader()
+
+        with self._lock:
+            self._values[key] = value
+            while len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+
+        return value
+
+    def pop(self, key):
+        '''Removes the value stored for `key`, if any.'''
+        with self._lock:
+            self._values.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# Packages acquired by each user, shared by the requests of this process. Its
+# size is set when the plugin is configured.
+acquired_packages = LRUCache(name='Acquired packages')
+
+
+def _request_cache():
+    '''
+    Returns a dict that lives as long as the current request. When there is no
+    request (background jobs, commands...) an empty dict is returned, so nothing
+    is memoized.
+    '''
+    try:
+        cache = getattr(tk.c, CACHE_ATTR, None)
+        # Pylons returns an empty string for the attributes that are not defined
+        if not isinstance(cache, dict):
+            cache = {}
+            setattr(tk.c, CACHE_ATTR, cache)
+        return cache
+    except (AttributeError, RuntimeError, TypeError):
+        return {}
+
+
+def memoize(namespace, key, loader):
+    '''Returns the value stored in the request cache, calling `loader` to get it the first time.'''
+    values = _request_cache().setdefault(namespace, {})
+    if key not in values:
+        values[key] = loader()
+    return values[key]
+
+
+def get_package_meta(id_or_name):
+    '''Returns the PackageMeta of the given package or None if it does not exist.'''
+    def _load():
+        package = model.Package
+        query = model.Session.query(package.id, package.private, package.state, package.owner_org,
+                                    package.creator_user_id).autoflush(False)
+        # As in model.Package.get, ids take precedence over names
+        row = query.filter(package.id == id_or_name).first() or query.filter(package.name == id_or_name).first()
+        return PackageMeta(*row) if row else None
+
+    return memoize(PACKAGES, id_or_name, _load)
+
+
+def is_granted(package_id, user_name):
+    '''Returns whether the given user is included in the list of allowed users of the given package.'''
+    def _load():
+        # Read-only frontends answer from the exported snapshot, without querying the database
+        if snapshot.is_enabled():
+            return snapshot.is_granted(package_id, user_name)
+        # Most of the users checked have not been granted, and they are answered without querying the database
+        return bloom.might_be_granted(package_id, user_name) and db.AllowedUser.is_granted(package_id, user_name)
+
+    return memoize(GRANTS, (package_id, user_name), _load)
+
+
+def _load_acquired_packages(user_name, ttl):
+    valid_until = time.time() + ttl
+    package_ids = []
+    for package_id, expires_at in db.AllowedUser.get_by_user(user_name):
+        package_ids.append(package_id)
+        # The packages are loaded again when one of their grants expires
+        if expires_at is not None:
+            valid_until = min(valid_until, calendar.timegm(expires_at.utctimetuple()))
+    return AcquiredPackages(frozenset(package_ids), valid_until)
+
+
+def get_acquired_packages(user_name):
+    '''
+    Returns the ids of the packages the given user has acquired. When
+    `acquired_cache_ttl` is set, they are kept in memory for that many seconds,
+    so they can be outdated if they are changed by another process. Otherwise
+    they are loaded once per request.
+    '''
+    def _load():
+        ttl = settings.get().acquired_cache_ttl
+        if not ttl:
+            return frozenset(package_id for package_id, _ in db.AllowedUser.get_by_user(user_name))
+
+        acquired = acquired_packages.get(user_name, lambda: _load_acquired_packages(user_name, ttl))
+        if acquired.valid_until <= time.time():
+            acquired_packages.pop(user_name)
+            acquired = acquired_packages.get(user_name, lambda: _load_acquired_packages(user_name, ttl))
+        return acquired.package_ids
+
+    return memoize(ACQUIRED, user_name, _load)
+
+
+def get_acquired_package_ids(package_ids, user_name):
+    '''
+    Returns which ones of the given packages the given user has acquired. When
+    the acquired packages are kept in memory, no query is needed.
+    '''
+    if not user_name:
+        return frozenset()
+
+    # The packages of an user cannot be listed from a snapshot, which only stores hashed grants
+    if settings.get().acquired_cache_ttl and not snapshot.is_enabled():
+        return get_acquired_packages(user_name).intersection(package_ids)
+
+    # The grants of every package are loaded with a single query
+    prefetch(package_ids, user_name)
+    return frozenset(package_id for package_id in package_ids if is_granted(package_id, user_name))
+
+
+def forget_acquired(user_names):
+    '''Removes the acquired packages of the given users from the cache. It must be called when they change.'''
+    acquired = _request_cache().get(ACQUIRED, {})
+    for user_name in user_names:
+        acquired_packages.pop(user_name)
+        acquired.pop(user_name, None)
+
+
+def get_scoped_grants(user_name):
+    '''
+    Returns the (scope, target_id) pairs of the organizations and creators whose
+    datasets the given user has been granted. They are loaded once per request,
+    so checking many packages only costs one query.
+    '''
+    def _load():
+        return frozenset(db.ScopedGrant.get_by_user(user_name))
+
+    return memoize(SCOPED_GRANTS, user_name, _load)
+
+
+def get_package_bundles(package_id):
+    '''Returns the ids of the bundles that contain the given package.'''
+    def _load():
+        return frozenset(db.Bundle.get_by_package([package_id]).get(package_id, []))
+
+    return memoize(BUNDLES, package_id, _load)
+
+
+def _get_granted_bundles(user_name):
+    return set(target_id for scope, target_id in get_scoped_grants(user_name) if scope == constants.SCOPE_BUNDLE)
+
+
+def has_scoped_grant(package, user_name):
+    '''
+    Returns whether the given user has been granted every dataset of the package
+    organization, of its creator or of one of the bundles that contain it.
+    '''
+    grants = get_scoped_grants(user_name)
+    if (constants.SCOPE_ORGANIZATION, package.owner_org) in grants or \
+            (constants.SCOPE_CREATOR, package.creator_user_id) in grants:
+        return True
+
+    # The bundles of the package are only loaded when the user has acquired any bundle
+    bundle_ids = _get_granted_bundles(user_name)
+    return bool(bundle_ids) and not bundle_ids.isdisjoint(get_package_bundles(package.id))
+
+
+def get_allowed_groups(package_id):
+    '''Returns the ids of the groups allowed in the given package.'''
+    def _load():
+        return frozenset(db.AllowedGroup.get_groups_by_package([package_id]).get(package_id, []))
+
+    return memoize(ALLOWED_GROUPS, package_id, _load)
+
+
+def get_user_group_ids(user_name):
+    '''Returns the ids of the active organizations and groups the given user belongs to.'''
+    user = get_user_meta(user_name)
+    return frozenset(get_user_capacities(user.id)) if user is not None else frozenset()
+
+
+def has_group_grant(package_id, user_name):
+    '''
+    Returns whether the given user belongs to one of the groups allowed in the
+    given package. The memberships of the user are loaded once per request, and
+    the groups of the package are only loaded when the user belongs to any group.
+    '''
+    group_ids = get_user_group_ids(user_name)
+    return bool(group_ids) and not group_ids.isdisjoint(get_allowed_groups(package_id))
+
+
+def prefetch(package_ids, user_name=None):
+    '''
+    Loads the PackageMeta of the given packages and, when an user is given, whether
+    he/she has been granted access to them. Only the packages that are not cached
+    yet are loaded, using one query for each kind of data.
+    '''
+    cache = _request_cache()
+
+    packages = cache.setdefault(PACKAGES, {})
+    missing = [package_id for package_id in package_ids if package_id not in packages]
+    if missing:
+        package = model.Package
+        rows = model.Session.query(package.id, package.private, package.state, package.owner_org, package.creator_user_id)\
+            .autoflush(False)\
+            .filter(package.id.in_(missing))
+        for row in rows:
+            packages[row[0]] = PackageMeta(*row)
+        for package_id in missing:
+            packages.setdefault(package_id, None)
+
+    if user_name:
+        grants = cache.setdefault(GRANTS, {})
+        missing = [package_id for package_id in package_ids if (package_id, user_name) not in grants]
+        if snapshot.is_enabled():
+            for package_id in missing:
+                grants[(package_id, user_name)] = snapshot.is_granted(package_id, user_name)
+        else:
+            for package_id in missing:
+                grants[(package_id, user_name)] = False
+            candidates = [package_id for package_id in missing if bloom.might_be_granted(package_id, user_name)]
+            if candidates:
+                for package_id in db.AllowedUser.get_users_by_package(candidates, user_name=user_name):
+                    grants[(package_id, user_name)] = True
+
+        if get_user_group_ids(user_name):
+            groups = cache.setdefault(ALLOWED_GROUPS, {})
+            missing = [package_id for package_id in package_ids if package_id not in groups]
+            if missing:
+                allowed_groups = db.AllowedGroup.get_groups_by_package(missing)
+                for package_id in missing:
+                    groups[package_id] = frozenset(allowed_groups.get(package_id, []))
+
+        if _get_granted_bundles(user_name):
+            bundles = cache.setdefault(BUNDLES, {})
+            missing = [package_id for package_id in package_ids if package_id not in bundles]
+            if missing:
+                package_bundles = db.Bundle.get_by_package(missing)
+                for package_id in missing:
+                    bundles[package_id] = frozenset(package_bundles.get(package_id, []))
+
+
+def forget_package(package_id):
+    '''Removes a package from the request cache. It must be called when a package is modified.'''
+    cache = _request_cache()
+
+    packages = cache.get(PACKAGES, {})
+    for key, meta in list(packages.items()):
+        if key == package_id or (meta is not None and meta.id == package_id):
+            del packages[key]
+
+    grants = cache.get(GRANTS, {})
+    for key in list(grants.keys()):
+        if key[0] == package_id:
+            del grants[key]
+
+    cache.get(BUNDLES, {}).pop(package_id, None)
+    cache.get(ALLOWED_GROUPS, {}).pop(package_id, None)
+
+
+def get_user_meta(user_name):
+    '''Returns the UserMeta of the given user or None if it does not exist.'''
+    def _load():
+        user = model.User
+        row = model.Session.query(user.id, user.sysadmin)\
+            .autoflush(False)\
+            .filter(sa.or_(user.name == user_name, user.id == user_name))\
+            .first()
+        return UserMeta(*row) if row else None
+
+    return memoize(USERS, user_name, _load)
+
+
+def get_user_capacities(user_id):
+    '''
+    Returns a dict with the capacity of the given user in each one of the active
+    organizations and groups he/she belongs to. All of them are loaded with a
+    single query.
+    '''
+    def _load():
+        member = model.Member
+        group = model.Group
+        rows = model.Session.query(member.group_id, member.capacity)\
+            .autoflush(False)\
+            .join(group, group.id == member.group_id)\
+            .filter(member.table_name == 'user',
+                    member.table_id == user_id,
+                    member.state == 'active',
+                    group.state == 'active')
+        return dict(rows)
+
+    return memoize(MEMBERSHIPS, user_id, _load)
+
+
+def get_parent_groups(group_id):
+    '''Returns the ids of the ancestors of the given organization or group.'''
+    def _load():
+        group = model.Group.get(group_id)
+        if group is None:
+            return []
+        return [parent.id for parent in group.get_parent_group_hierarchy(type=group.type)]
+
+    return memoize(PARENT_GROUPS, group_id, _load)
+
+
+def _get_roles(permission):
+    return memoize(ROLES, permission, lambda: set(authz.get_roles_with_permission(permission)))
+
+
+def has_user_permission_for_group_or_org(group_id, user_name, permission):
+    '''
+    Equivalent to `authz.has_user_permission_for_group_or_org`, but the user and
+    his/her memberships are loaded once per request instead of once per check.
+    '''
+    if not group_id or not user_name:
+        return False
+
+    user = get_user_meta(user_name)
+    if user is None:
+        return False
+
+    if user.sysadmin:
+        return True
+
+    capacities = get_user_capacities(user.id)
+    roles = _get_roles(permission)
+    if capacities.get(group_id) in roles:
+        return True
+
+    # Some roles are also granted in the sub-organizations
+    cascade_roles = roles.intersection(authz.check_config_permission('roles_that_cascade_to_sub_groups'))
+    if cascade_roles and capacities:
+        for parent_id in get_parent_groups(group_id):
+            if capacities.get(parent_id) in cascade_roles:
+                return True
+
+    return False
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function
+
+import logging
+import multiprocessing
+import sys
+import time
+
+from ckan import model
+from ckan.lib import search
+from ckan.lib.cli import CkanCommand
+from ckan.plugins import toolkit as tk
+import sqlalchemy as sa
+
+from ckanext.privatedatasets import constants, db, indexer, migration, settings, snapshot
+
+
+log = logging.getLogger(__name__)
+
+
+def _package_ids_query(all_datasets=False):
+    '''
+    Returns a query that selects the id of every active dataset that has allowed
+    users or groups or that includes the searchable field (or of every active
+    dataset when `all_datasets` is True)
+    '''
+    allowed_users = db.package_allowed_users_table
+    allowed_groups = db.package_allowed_groups_table
+    package = model.package_table
+    package_extra = model.package_extra_table
+
+    if all_datasets:
+        return sa.select([package.c.id]).where(package.c.state == 'active')
+
+    with_allowed_users = sa.select([allowed_users.c.package_id])
+    with_allowed_groups = sa.select([allowed_groups.c.package_id])
+    searchable = sa.select([package_extra.c.package_id]).where(sa.and_(
+        package_extra.c.key == constants.SEARCHABLE,
+        package_extra.c.state == 'active'))
+
+    ids = sa.union(with_allowed_users, with_allowed_groups, searchable).alias('ids')
+
+    return sa.select([ids.c.package_id]).select_from(
+        ids.join(package, package.c.id == ids.c.package_id)).where(package.c.state == 'active')
+
+
+def iter_package_ids(batch_size, all_datasets=False):
+    '''Streams the ids of the datasets managed by this extension in lists of `batch_size` ids'''
+    query = _package_ids_query(all_datasets)
+
+    # A dedicated connection is used so the datasets can be reindexed while the
+    # ids are being read
+    connection = model.meta.engine.connect()
+    result = connection.execution_options(stream_results=True).execute(query)
+
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [row[0] for row in rows]
+    finally:
+        result.close()
+        connection.close()
+
+
+def count_package_ids(all_datasets=False):
+    query = _package_ids_query(all_datasets).alias('datasets')
+    return model.Session.execute(sa.select([sa.func.count()]).select_from(query)).scalar()
+
+
+def reindex_packages(package_ids):
+    '''
+    Reindexes the given datasets without committing the changes. It can be used
+    as the target of a worker process.
+    '''
+    package_index = search.index_for(model.Package)
+    context = {'model': model, 'ignore_auth': True, 'validate': False, 'use_cache': False}
+
+    try:
+        # Avoid one query per dataset when their grants are indexed
+        indexer.prefetch_allowed_users(package_ids)
+
+        for package_id in package_ids:
+            try:
+                pkg_dict = tk.get_action('package_show')(context.copy(), {'id': package_id})
+                package_index.update_dict(pkg_dict, defer_commit=True)
+            except Exception as e:
+                log.error('Error while indexing dataset %s: %s' % (package_id, e))
+    finally:
+        indexer.clear_prefetched()
+        model.Session.remove()
+
+    return len(package_ids)
+
+
+class PrivateDatasetsCommand(CkanCommand):
+    '''Private datasets management commands
+
+    Usage:
+
+        privatedatasets initdb
+            Creates the tables of the extension if they do not exist and runs
+            their pending migrations.
+
+        privatedatasets migrate [VERSION] [--sql] [--from FROM_VERSION]
+            Upgrades or downgrades the tables of the extension to VERSION (the
+            latest one by default). If --sql is used, the SQL statements of the
+            migrations are printed instead of run, so they can be reviewed or
+            applied manually (the database is assumed to be at FROM_VERSION, 0
+            by default).
+
+        privatedatasets sweep [-b BATCH_SIZE]
+            Removes the grants (including the organization, creator and
+            bundle ones) that have expired, in batches of BATCH_SIZE grants
+            (100 by default), and updates the search index of the affected
+            datasets. It can be run periodically (e.g. with cron).
+
+        privatedatasets reindex [-a] [-b BATCH_SIZE] [-i COMMIT_INTERVAL] [-w WORKERS]
+            Reindexes the datasets that have allowed users or groups or that
+            include the searchable field (or every active dataset if -a is
+            used). The datasets are reindexed in batches of BATCH_SIZE datasets (100 by
+            default) using WORKERS processes (one per CPU by default). Changes
+            are committed to Solr every COMMIT_INTERVAL seconds (10 by default)
+            and at the end of the process.
+
+        privatedatasets snapshot PATH
+            Exports the grants of the allowed users that have not expired to
+            a snapshot file in PATH, replacing the previous one atomically.
+            Instances with ckan.privatedatasets.grants_snapshot = PATH (e.g.
+            read-only mirrors) read the grants from it instead of the
+            database. It can be run periodically (e.g. with cron).
+
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 2
+    min_args = 1
+
+    def __init__(self, name):
+        super(PrivateDatasetsCommand, self).__init__(name)
+
+        self.parser.add_option('-a', '--all', dest='all_datasets', action='store_true', default=False,
+                               help='Reindex every active dataset')
+        self.parser.add_option('-b', '--batch-size', dest='batch_size', type='int', default=100,
+                               help='Number of datasets reindexed by each task')
+        self.parser.add_option('-i', '--commit-interval', dest='commit_interval', type='int', default=10,
+                               help='Seconds between Solr commits')
+        self.parser.add_option('-w', '--workers', dest='workers', type='int', default=multiprocessing.cpu_count(),
+                               help='Number of worker processes')
+        self.parser.add_option('--sql', dest='sql', action='store_true', default=False,
+                               help='Print the SQL of the migrations instead of running them')
+        self.parser.add_option('--from', dest='from_version', type='int', default=0,
+                               help='Version the database is assumed to be at when --sql is used')
+
+    def command(self):
+        cmd = self.args[0]
+
+        # Generating the SQL of the migrations does not require a database
+        if cmd == 'migrate' and self.options.sql:
+            self.migrate_sql(self._get_config())
+            return
+
+        self._load_config()
+
+        if cmd == 'initdb':
+            self.initdb()
+        elif cmd == 'migrate':
+            self.migrate()
+        elif cmd == 'sweep':
+            self.sweep()
+        elif cmd == 'reindex':
+            self.reindex()
+        elif cmd == 'snapshot':
+            self.export_snapshot()
+        else:
+            print('Command %s not recognized' % cmd)
+            sys.exit(1)
+
+    def initdb(self):
+        db.init_db()
+        print('Tables of the privatedatasets extension created')
+
+    def _get_target_version(self):
+        return int(self.args[1]) if len(self.args) > 1 else None
+
+    def migrate(self):
+        version = migration.migrate(model.meta.engine, self._get_target_version())
+        print('Tables of the privatedatasets extension migrated to version %d' % version)
+
+    def migrate_sql(self, config):
+        statements = migration.generate_sql(config['sqlalchemy.url'], self.options.from_version,
+                                            self._get_target_version())
+        for statement in statements:
+            print(statement)
+
+    def sweep(self):
+        package_index = search.index_for(model.Package)
+        labels_indexer = indexer.PermissionLabelsIndexer()
+        batch_size = self.options.batch_size
+        swept = 0
+
+        while True:
+            # Each batch is committed on its own, so the table is never locked for long
+            expired = db.AllowedUser.delete_expired(batch_size)
+            model.Session.commit()
+            swept += len(expired)
+
+            if expired and settings.get().incremental_index:
+                with indexer.batch():
+                    for package_id, user_id, user_name in expired:
+                        labels_indexer.remove_labels(package_id, [indexer.user_label(user_id, user_name)])
+            elif expired:
+                reindex_packages(sorted(set(package_id for package_id, _, _ in expired)))
+                package_index.commit()
+
+            if len(expired) < batch_size:
+                break
+
+        # Scoped grants are not indexed, so they are just deleted
+        while True:
+            deleted = db.ScopedGrant.delete_expired(batch_size)
+            model.Session.commit()
+            swept += deleted
+
+            if deleted < batch_size:
+                break
+
+        print('%d expired grants removed' % swept)
+
+    def reindex(self):
+        package_index = search.index_for(model.Package)
+        total = count_package_ids(self.options.all_datasets)
+        print('Reindexing %d datasets' % total)
+
+        pool = None
+        batches = iter_package_ids(self.options.batch_size, self.options.all_datasets)
+
+        if self.options.workers > 1:
+            # Connections cannot be shared with the worker processes
+            model.Session.remove()
+            model.meta.engine.dispose()
+            pool = multiprocessing.Pool(self.options.workers)
+            results = pool.imap_unordered(reindex_packages, batches)
+        else:
+            results = (reindex_packages(batch) for batch in batches)
+
+        indexed = 0
+        start = last_commit = time.time()
+
+        try:
+            for count in results:
+                indexed += count
+                now = time.time()
+
+                if now - last_commit >= self.options.commit_interval:
+                    package_index.commit()
+                    last_commit = now
+
+                sys.stdout.write('\r%d/%d datasets reindexed (%.1f datasets/s)' % (indexed, total, indexed / max(now - start, 0.001)))
+                sys.stdout.flush()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+            package_index.commit()
+
+        print('\nReindexed %d datasets in %.1f seconds' % (indexed, time.time() - start))
+
+    def export_snapshot(self):
+        if len(self.args) < 2:
+            print('The path of the snapshot is required')
+            sys.exit(1)
+
+        start = time.time()
+        exported = snapshot.export(self.args[1])
+        print('%d grants exported to %s in %.1f seconds' % (exported, self.args[1], time.time() - start))
@@ -25,3 +25,45 @@ ACQUIRE_URL = 'acquire_url'
 CONTEXT_CALLBACK = 'updating_via_cb'
 PACKAGE_ACQUIRED = 'package_acquired'
 PACKAGE_DELETED = 'revoke_access'
+ALLOWED_USERS_PATCH = 'allowed_users_patch'
+# Users are labelled by id, so renaming them does not change any dataset. Users that
+# had not signed up when they were granted are labelled by name
+ALLOWED_USER_LABEL = 'allowed-%s'
+PENDING_USER_LABEL = 'allowed_name-%s'
+ALLOWED_GROUPS = 'allowed_groups'
+# User names can include hyphens, so group labels cannot start with allowed-
+ALLOWED_GROUP_LABEL = 'allowed_group-%s'
+PARSER = 'ckan.privatedatasets.parser'
+SHOW_ACQUIRE_URL_ON_CREATE = 'ckan.privatedatasets.show_acquire_url_on_create'
+SHOW_ACQUIRE_URL_ON_EDIT = 'ckan.privatedatasets.show_acquire_url_on_edit'
+INCREMENTAL_INDEX = 'ckan.privatedatasets.incremental_index'
+# Integer field, so it can be sorted and incremented by atomic updates
+ACQUIRERS_FIELD = 'privatedatasets_acquirers_i'
+PRIVATE_FIELD = 'privatedatasets_private'
+SEARCHABLE_FIELD = 'privatedatasets_searchable'
+# vocab_* is the only multi-valued string field of the CKAN Solr schema
+GRANTEES_FIELD = 'vocab_privatedatasets_grantees'
+ACQUIRE_BUTTON_CACHE_SIZE = 'ckan.privatedatasets.acquire_button_cache_size'
+AUTO_MIGRATE = 'ckan.privatedatasets.auto_migrate'
+REINDEX_DELAY = 'ckan.privatedatasets.reindex_delay'
+REINDEX_BATCH_SIZE = 'ckan.privatedatasets.reindex_batch_size'
+GRANTS_FILTER_REFRESH = 'ckan.privatedatasets.grants_filter_refresh'
+GRANTS_FILTER_ERROR_RATE = 'ckan.privatedatasets.grants_filter_error_rate'
+GRANTS_FILTER_MAX_MEMORY = 'ckan.privatedatasets.grants_filter_max_memory'
+ACQUIRED_CACHE_TTL = 'ckan.privatedatasets.acquired_cache_ttl'
+ACQUIRED_CACHE_SIZE = 'ckan.privatedatasets.acquired_cache_size'
+GRANTS_SNAPSHOT = 'ckan.privatedatasets.grants_snapshot'
+GRANTS_SNAPSHOT_REFRESH = 'ckan.privatedatasets.grants_snapshot_refresh'
+NOTIFIER_USERS = 'ckan.privatedatasets.notifier_users'
+EXPIRES_AT = 'expires_at'
+SCOPE_ORGANIZATION = 'organization'
+SCOPE_CREATOR = 'creator'
+SCOPE_BUNDLE = 'bundle'
+SCOPED_GRANT_LABEL = 'grant-%s-%s'
+# Fields of the parsers results with the targets of the scoped grants
+SCOPED_GRANT_FIELDS = {SCOPE_ORGANIZATION: 'organizations', SCOPE_CREATOR: 'creators', SCOPE_BUNDLE: 'bundles'}
+SCOPED_GRANTS = 'scoped_grants'
+BUNDLE_CREATE = 'bundle_create'
+BUNDLE_SHOW = 'bundle_show'
+BUNDLE_UPDATE = 'bundle_update'
+BUNDLE_DELETE = 'bundle_delete'
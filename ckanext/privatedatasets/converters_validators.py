@@ -19,9 +19,11 @@
 
 from __future__ import absolute_import
 
+import datetime
 from itertools import count
 import re
 
+from ckan import model
 from ckan.plugins import toolkit
 from ckan.common import _
 import six
@@ -29,6 +31,9 @@ import six
 from ckanext.privatedatasets import constants, db
 
 
+EXPIRES_AT_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+
 def private_datasets_metadata_checker(key, data, errors, context):
 
     dataset_id = data.get(('id',))
@@ -81,12 +86,39 @@ def allowed_users_convert(key, data, errors, context):
 def get_allowed_users(key, data, errors, context):
     pkg_id = data[('id',)]
 
-    db.init_db(context['model'])
+    users = db.AllowedUser.iter_by_package(pkg_id)
+
+    for i, user_name in enumerate(users):
+        data[(key[0], i)] = user_name
+
+
+def allowed_groups_convert(key, data, errors, context):
+    '''
+    Converts the names (or ids) of the allowed groups, given as a list or as a
+    comma separated string, into the ids of the groups.
+    '''
+    value = data.get(key)
+
+    if isinstance(value, six.string_types):
+        groups = [group for group in value.split(',') if group.strip() != '']
+    elif isinstance(value, list):
+        groups = value
+    else:
+        return
+
+    group_ids = []
+    for group_name in groups:
+        group = model.Group.get(group_name.strip())
+        if group is None or group.state != 'active':
+            errors[key].append(_('Group %s does not exist') % group_name.strip())
+        elif group.id not in group_ids:
+            group_ids.append(group.id)
+
+    data[key] = group_ids
 
-    users = db.AllowedUser.get(package_id=pkg_id)
 
-    for i, user in enumerate(users):
-        data[(key[0], i)] = user.user_name
+def get_allowed_groups(key, data, errors, context):
+    data[key] = db.AllowedGroup.get_group_names(data[('id',)])
 
 
 def url_checker(key, data, errors, context):
@@ -105,3 +137,26 @@ def url_checker(key, data, errors, context):
 
         if regex.match(url) is None:
             errors[key].append(_('The URL "%s" is not valid.') % url)
+
+
+def parse_expires_at(value):
+    '''
+    Converts the expiry date of a grant returned by a notification parser (an
+    ISO 8601 UTC string or a datetime) into a naive UTC datetime. None means
+    that the grant never expires.
+    '''
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+
+    if isinstance(value, six.string_types):
+        date_str = value.strip()
+        if date_str.endswith('Z'):
+            date_str = date_str[:-1]
+
+        for date_format in EXPIRES_AT_FORMATS:
+            try:
+                return datetime.datetime.strptime(date_str, date_format)
+            except ValueError:
+                pass
+
+    raise toolkit.ValidationError({'message': 'Invalid %s value: %s' % (constants.EXPIRES_AT, value)})
@@ -19,35 +19,667 @@
 
 from __future__ import absolute_import
 
+import datetime
+import uuid
+import zlib
+
+from ckan import model
 import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from ckanext.privatedatasets import constants, migration
+
+# Compiled statements reused by the membership checks
+_compiled_cache = {}
+
+# First key of the advisory locks of the packages, so they do not clash with
+# the locks taken by other applications that share the database
+_LOCK_NAMESPACE = 0x70647473
+
+# FIXME: Maybe a default value should not be included...
+package_allowed_users_table = sa.Table(
+    'package_allowed_users',
+    model.meta.metadata,
+    sa.Column('package_id', sa.types.UnicodeText, primary_key=True, default=u''),
+    sa.Column('user_name', sa.types.UnicodeText, primary_key=True, default=u''),
+    sa.Column('user_id', sa.types.UnicodeText, sa.ForeignKey('user.id', ondelete='CASCADE'), nullable=True),
+    sa.Column('expires_at', sa.types.DateTime, nullable=True),
+    # Created by the migrations, they are only declared here so the table matches them
+    sa.Index('idx_package_allowed_users_user_name', 'user_name'),
+    sa.Index('idx_package_allowed_users_user_id', 'user_id'),
+    sa.Index('idx_package_allowed_users_expires_at', 'expires_at'),
+)
+
+# Grants of every dataset of an organization or a creator (the target)
+scoped_grants_table = sa.Table(
+    'privatedatasets_scoped_grants',
+    model.meta.metadata,
+    sa.Column('scope', sa.types.UnicodeText, primary_key=True),
+    sa.Column('target_id', sa.types.UnicodeText, primary_key=True),
+    sa.Column('user_name', sa.types.UnicodeText, primary_key=True),
+    sa.Column('user_id', sa.types.UnicodeText, sa.ForeignKey('user.id', ondelete='CASCADE'), nullable=True),
+    sa.Column('expires_at', sa.types.DateTime, nullable=True),
+    sa.Index('idx_privatedatasets_scoped_grants_user_name', 'user_name'),
+    sa.Index('idx_privatedatasets_scoped_grants_user_id', 'user_id'),
+)
+
+# Groups (or organizations) whose members are allowed in each dataset
+package_allowed_groups_table = sa.Table(
+    'package_allowed_groups',
+    model.meta.metadata,
+    sa.Column('package_id', sa.types.UnicodeText, primary_key=True),
+    sa.Column('group_id', sa.types.UnicodeText, primary_key=True),
+    sa.Index('idx_package_allowed_groups_group_id', 'group_id'),
+)
+
+# Named sets of datasets that can be granted as a whole
+bundles_table = sa.Table(
+    'privatedatasets_bundles',
+    model.meta.metadata,
+    sa.Column('id', sa.types.UnicodeText, primary_key=True),
+    sa.Column('name', sa.types.UnicodeText, nullable=False, unique=True),
+    sa.Column('title', sa.types.UnicodeText, nullable=True),
+)
+
+bundle_packages_table = sa.Table(
+    'privatedatasets_bundle_packages',
+    model.meta.metadata,
+    sa.Column('bundle_id', sa.types.UnicodeText,
+              sa.ForeignKey('privatedatasets_bundles.id', ondelete='CASCADE'), primary_key=True),
+    sa.Column('package_id', sa.types.UnicodeText, primary_key=True),
+    sa.Index('idx_privatedatasets_bundle_packages_package_id', 'package_id'),
+)
+
+# Grants are matched by user id, so renaming an user does not break them. Users
+# granted before they signed up have no id and are matched by name instead.
+
+
+def _users_join(table=package_allowed_users_table):
+    return table.outerjoin(model.user_table, model.user_table.c.id == table.c.user_id)
+
+
+def _current_user_name(table=package_allowed_users_table):
+    return sa.func.coalesce(model.user_table.c.name, table.c.user_name)
+
+
+def _not_expired(now=None, table=package_allowed_users_table):
+    # Expired grants are ignored until they are swept
+    expires_at = table.c.expires_at
+    if now is None:
+        now = datetime.datetime.utcnow()
+    return sa.or_(expires_at.is_(None), expires_at > now)
+
+
+def _users_criteria(user_names, user_ids, table=package_allowed_users_table):
+    criteria = sa.and_(table.c.user_id.is_(None), table.c.user_name.in_(user_names))
+    return sa.or_(table.c.user_id.in_(user_ids), criteria) if user_ids else criteria
+
+
+def _dialect_name():
+    return model.Session.get_bind().dialect.name
+
+
+def _insert_ignore(table, rows):
+    '''
+    Inserts the given rows skipping the ones whose primary key is already stored
+    (e.g. by a concurrent transaction) and returns the inserted ones. Conflicts
+    never abort the transaction, so callers do not have to read the table first.
+    '''
+    if not rows:
+        return []
+
+    if _dialect_name() == 'postgresql':
+        primary_key = list(table.primary_key.columns)
+        query = postgresql.insert(table).values(rows).on_conflict_do_nothing().returning(*primary_key)
+        inserted = set(tuple(row) for row in model.Session.execute(query))
+        return [row for row in rows if tuple(row[column.name] for column in primary_key) in inserted]
+
+    # Used by the tests (SQLite), where the rows are inserted one by one to know
+    # which ones have been skipped
+    query = table.insert().prefix_with('OR IGNORE', dialect='sqlite')
+    return [row for row in rows if model.Session.execute(query, row).rowcount]
+
+
+def _lock_key(package_id):
+    # crc32 returns a signed integer in Python 2 and an unsigned one in Python 3
+    key = zlib.crc32(package_id.encode('utf-8')) & 0xffffffff
+    return key - 0x100000000 if key > 0x7fffffff else key
+
+
+def lock_package(package_id):
+    '''
+    Locks the grants of the given package until the current transaction ends, so
+    changes that read them before writing them (like replacing the list of
+    allowed users) are not interleaved and no update is lost. Locks are only
+    taken in PostgreSQL, since SQLite already serializes its write transactions.
+    '''
+    if _dialect_name() == 'postgresql':
+        model.Session.execute(sa.select([sa.func.pg_advisory_xact_lock(_LOCK_NAMESPACE, _lock_key(package_id))]))
+
+
+def lock_packages(package_ids):
+    '''
+    Locks the grants of several packages until the current transaction ends. They
+    are locked in order, so transactions that lock the same packages never wait
+    for each other in a cycle.
+    '''
+    for package_id in sorted(set(package_ids)):
+        lock_package(package_id)
+
+
+def get_package_ids(ids_or_names):
+    '''Returns a dict with the id of each one of the given (active or not) packages, by id or name.'''
+    ids_or_names = set(ids_or_names)
+    if not ids_or_names:
+        return {}
+
+    package = model.package_table
+    query = sa.select([package.c.id, package.c.name])\
+        .where(sa.or_(package.c.id.in_(ids_or_names), package.c.name.in_(ids_or_names)))
+
+    package_ids = {}
+    for package_id, name in model.Session.execute(query):
+        # Ids take precedence over names
+        if name in ids_or_names and name not in package_ids:
+            package_ids[name] = package_id
+        if package_id in ids_or_names:
+            package_ids[package_id] = package_id
+    return package_ids
+
+
+def get_user_ids(user_names):
+    '''Returns a dict with the ids of the given users, if they exist.'''
+    user_names = set(user_names)
+    if not user_names:
+        return {}
+
+    user_table = model.user_table
+    query = sa.select([user_table.c.name, user_table.c.id]).where(user_table.c.name.in_(user_names))
+    return dict((name, user_id) for name, user_id in model.Session.execute(query))
+
+
+class AllowedUser(model.DomainObject):
+
+    _is_granted_statement = None
+
+    @classmethod
+    def get(cls, **kw):
+        '''Finds all the instances required.'''
+        query = model.Session.query(cls).autoflush(False)
+        return query.filter_by(**kw).all()
+
+    @classmethod
+    def get_with_names(cls, package_id):
+        '''
+        Returns the grants of the given package as (grant, user_name) pairs, where
+        user_name is the current name of the user, so renamed users are matched.
+        '''
+        user_table = model.user_table
+        query = model.Session.query(cls, _current_user_name()).autoflush(False)\
+            .outerjoin(user_table, user_table.c.id == cls.user_id).filter(cls.package_id == package_id)
+        return [(user, user_name) for user, user_name in query.all()]
+
+    @classmethod
+    def get_users_by_package(cls, package_ids, user_name=None, include_expired=False, with_ids=False):
+        '''
+        Returns a dict with the (current) names of the users allowed in each one of
+        the given packages, sorted by name. The results can be restricted to the
+        given user. If `with_ids` is True, (user_id, user_name) pairs are returned.
+        '''
+        table = package_allowed_users_table
+        user_name_column = _current_user_name()
+        query = sa.select([table.c.package_id, table.c.user_id, user_name_column]).select_from(_users_join())\
+            .where(table.c.package_id.in_(package_ids)).order_by(user_name_column)
+        if not include_expired:
+            query = query.where(_not_expired())
+        if user_name is not None:
+            query = query.where(user_name_column == user_name)
+
+        users = {}
+        for package_id, user_id, allowed_user in model.Session.execute(query):
+            users.setdefault(package_id, []).append((user_id, allowed_user) if with_ids else allowed_user)
+        return users
+
+    @classmethod
+    def count_by_package(cls, package_ids):
+        '''Returns a dict with the number of grants that have not expired of each one of the given packages.'''
+        package_ids = set(package_ids)
+        if not package_ids:
+            return {}
+
+        table = package_allowed_users_table
+        query = sa.select([table.c.package_id, sa.func.count()])\
+            .where(sa.and_(table.c.package_id.in_(package_ids), _not_expired()))\
+            .group_by(table.c.package_id)
+        return dict((package_id, count) for package_id, count in model.Session.execute(query))
+
+    # The following methods use SQLAlchemy Core, so no ORM instances are built
+
+    @classmethod
+    def _criteria(cls, **kw):
+        table = package_allowed_users_table
+        return sa.and_(*[table.c[column] == value for column, value in kw.items()])
+
+    @classmethod
+    def count(cls, **kw):
+        '''Returns the number of rows that match the given values.'''
+        query = sa.select([sa.func.count()]).select_from(package_allowed_users_table)\
+            .where(cls._criteria(**kw))
+        return model.Session.execute(query).scalar()
+
+    @classmethod
+    def exists(cls, **kw):
+        '''Returns whether there is at least one row that matches the given values.'''
+        query = sa.select([sa.exists([package_allowed_users_table.c.package_id]).where(cls._criteria(**kw))])
+        return bool(model.Session.execute(query).scalar())
+
+    @classmethod
+    def is_granted(cls, package_id, user_name):
+        '''
+        Returns whether the given user is allowed in the given package. The EXISTS
+        statement is built once and its compiled form is cached, so each check only
+        binds the parameters.
+        '''
+        if cls._is_granted_statement is None:
+            table = package_allowed_users_table
+            cls._is_granted_statement = sa.select([sa.exists([table.c.package_id]).select_from(_users_join()).where(
+                sa.and_(table.c.package_id == sa.bindparam('package_id'),
+                        _current_user_name() == sa.bindparam('user_name'),
+                        _not_expired(sa.bindparam('now'))))])
+
+        connection = model.Session.connection().execution_options(compiled_cache=_compiled_cache)
+        result = connection.execute(cls._is_granted_statement, package_id=package_id, user_name=user_name,
+                                    now=datetime.datetime.utcnow())
+        return bool(result.scalar())
+
+    @classmethod
+    def _iter_column(cls, column, criteria, batch_size, from_obj=None):
+        # Keyset pagination: each page starts after the last value of the previous one
+        last_value = None
+        while True:
+            query = sa.select([column]).where(criteria)
+            if from_obj is not None:
+                query = query.select_from(from_obj)
+            if last_value is not None:
+                query = query.where(column > last_value)
+            query = query.order_by(column).limit(batch_size)
+
+            values = [row[0] for row in model.Session.execute(query)]
+            for value in values:
+                yield value
+
+            if len(values) < batch_size:
+                break
+            last_value = values[-1]
+
+    @classmethod
+    def iter_by_user(cls, user_name, batch_size=1000):
+        '''Yields the ids of the active packages the given user has access to, sorted by id.'''
+        table = package_allowed_users_table
+        package_table = model.package_table
+        user_ids = list(get_user_ids([user_name]).values())
+        criteria = sa.and_(_users_criteria([user_name], user_ids), _not_expired(),
+                           package_table.c.state == u'active')
+        from_obj = table.join(package_table, package_table.c.id == table.c.package_id)
+        return cls._iter_column(table.c.package_id, criteria, batch_size, from_obj)
+
+    @classmethod
+    def iter_by_package(cls, package_id, batch_size=1000):
+        '''Yields the (current) names of the users allowed in the given package, sorted by name.'''
+        criteria = sa.and_(package_allowed_users_table.c.package_id == package_id, _not_expired())
+        return cls._iter_column(_current_user_name(), criteria, batch_size, _users_join())
+
+    @classmethod
+    def get_by_user(cls, user_name):
+        '''
+        Returns the (package_id, expires_at) pairs of the grants of the given user
+        that have not expired, loaded with a single query.
+        '''
+        table = package_allowed_users_table
+        user_ids = list(get_user_ids([user_name]).values())
+        query = sa.select([table.c.package_id, table.c.expires_at])\
+            .where(sa.and_(_users_criteria([user_name], user_ids), _not_expired()))
+        return [(package_id, expires_at) for package_id, expires_at in model.Session.execute(query)]
+
+    @classmethod
+    def iter_grants(cls, with_expiry=False):
+        '''
+        Yields the (package_id, user_name) pairs of every grant that has not expired,
+        with the current names of the users (and their expiry dates as a third value
+        when `with_expiry` is True). They are streamed through a dedicated
+        connection, so they are never loaded in memory at once.
+        '''
+        table = package_allowed_users_table
+        columns = [table.c.package_id, _current_user_name()]
+        if with_expiry:
+            columns.append(table.c.expires_at)
+        query = sa.select(columns).select_from(_users_join()).where(_not_expired())
+
+        connection = model.meta.engine.connect()
+        result = connection.execution_options(stream_results=True).execute(query)
+        try:
+            for row in result:
+                yield tuple(row)
+        finally:
+            result.close()
+            connection.close()
+
+    @classmethod
+    def get_existing(cls, grants, user_ids=None, include_expired=True):
+        '''
+        Returns the given (package_id, user_name) pairs that are already stored,
+        including the expired ones unless `include_expired` is False. Only the
+        given users are queried, so the cost does not depend on the number of
+        users allowed in each package.
+        '''
+        grants = set(grants)
+        if not grants:
+            return set()
+
+        table = package_allowed_users_table
+        user_names = set(user_name for _, user_name in grants)
+        if user_ids is None:
+            user_ids = get_user_ids(user_names)
+
+        query = sa.select([table.c.package_id, _current_user_name()]).select_from(_users_join())\
+            .where(sa.and_(table.c.package_id.in_(set(package_id for package_id, _ in grants)),
+                           _users_criteria(user_names, list(user_ids.values()))))
+        if not include_expired:
+            query = query.where(_not_expired())
+        return set(tuple(row) for row in model.Session.execute(query)).intersection(grants)
+
+    @classmethod
+    def bulk_grant(cls, grants, expires_at=None):
+        '''
+        Inserts the given (package_id, user_name) pairs that are not stored yet
+        and returns them. Expired grants that have not been swept yet are kept
+        as they are. Pairs stored by concurrent transactions are skipped instead
+        of aborting the transaction. Changes are not committed.
+        '''
+        table = package_allowed_users_table
+        grants = set(grants)
+        if not grants:
+            return []
+
+        user_ids = get_user_ids(user_name for _, user_name in grants)
+        existing = cls.get_existing(grants, user_ids)
+        new_grants = sorted(grants - existing)
+
+        inserted = _insert_ignore(table, [{'package_id': package_id, 'user_name': user_name,
+                                           'user_id': user_ids.get(user_name), 'expires_at': expires_at}
+                                          for package_id, user_name in new_grants])
+        return [(row['package_id'], row['user_name']) for row in inserted]
+
+    @classmethod
+    def bulk_revoke(cls, grants):
+        '''
+        Deletes the given (package_id, user_name) pairs and returns the number of
+        deleted rows. Changes are not committed.
+        '''
+        table = package_allowed_users_table
+        users_by_package = {}
+        for package_id, user_name in set(grants):
+            users_by_package.setdefault(package_id, []).append(user_name)
+
+        user_ids = get_user_ids(user_name for user_names in users_by_package.values() for user_name in user_names)
+
+        deleted = 0
+        for package_id, user_names in users_by_package.items():
+            ids = [user_ids[user_name] for user_name in user_names if user_name in user_ids]
+            query = table.delete().where(sa.and_(table.c.package_id == package_id,
+                                                 _users_criteria(user_names, ids)))
+            deleted += model.Session.execute(query).rowcount
+        return deleted
+
+    @classmethod
+    def set_expiry(cls, package_id, user_name, expires_at):
+        '''
+        Sets the expiry date (None if it never expires) of the grant of the given
+        user in the given package. Changes are not committed.
+        '''
+        table = package_allowed_users_table
+        user_ids = list(get_user_ids([user_name]).values())
+        query = table.update().values(expires_at=expires_at)\
+            .where(sa.and_(table.c.package_id == package_id, _users_criteria([user_name], user_ids)))
+        return model.Session.execute(query).rowcount
+
+    @classmethod
+    def delete_expired(cls, batch_size=1000, now=None):
+        '''
+        Deletes up to `batch_size` grants that expired before `now` and returns them
+        as (package_id, user_id, user_name) tuples. Changes are not committed, so callers can
+        sweep the table in short transactions.
+        '''
+        table = package_allowed_users_table
+        if now is None:
+            now = datetime.datetime.utcnow()
+        query = sa.select([table.c.package_id, table.c.user_id, table.c.user_name, _current_user_name()])\
+            .select_from(_users_join()).where(table.c.expires_at <= now)\
+            .order_by(table.c.expires_at).limit(batch_size)
+
+        stored_names = {}
+        expired = []
+        for package_id, user_id, user_name, current_name in model.Session.execute(query):
+            stored_names.setdefault(package_id, []).append(user_name)
+            expired.append((package_id, user_id, current_name))
+
+        for package_id, user_names in stored_names.items():
+            model.Session.execute(table.delete().where(sa.and_(
+                table.c.package_id == package_id, table.c.user_name.in_(user_names), table.c.expires_at <= now)))
+
+        return expired
+
+
+class AllowedGroup(object):
+    '''
+    Allows every member of a group in a dataset with a single row, so changing
+    the members of the group does not change any dataset.
+    '''
+
+    @classmethod
+    def get_groups_by_package(cls, package_ids):
+        '''Returns a dict with the ids of the groups allowed in each one of the given packages.'''
+        package_ids = set(package_ids)
+        if not package_ids:
+            return {}
+
+        table = package_allowed_groups_table
+        query = sa.select([table.c.package_id, table.c.group_id]).where(table.c.package_id.in_(package_ids))
+        groups = {}
+        for package_id, group_id in model.Session.execute(query):
+            groups.setdefault(package_id, []).append(group_id)
+        return groups
+
+    @classmethod
+    def get_group_names(cls, package_id):
+        '''Returns the (current) names of the groups allowed in the given package, sorted by name.'''
+        table = package_allowed_groups_table
+        group_table = model.group_table
+        query = sa.select([group_table.c.name])\
+            .select_from(table.join(group_table, group_table.c.id == table.c.group_id))\
+            .where(table.c.package_id == package_id).order_by(group_table.c.name)
+        return [row[0] for row in model.Session.execute(query)]
+
+    @classmethod
+    def set_groups(cls, package_id, group_ids):
+        '''
+        Replaces the groups allowed in the given package and returns the ids of the
+        groups that have been added and removed. Changes are not committed.
+        '''
+        table = package_allowed_groups_table
+        current = set(cls.get_groups_by_package([package_id]).get(package_id, []))
+        group_ids = set(group_ids)
+        added = [row['group_id'] for row in _insert_ignore(table, [{'package_id': package_id, 'group_id': group_id}
+                                                                   for group_id in sorted(group_ids - current)])]
+        removed = sorted(current - group_ids)
+
+        if removed:
+            model.Session.execute(table.delete().where(sa.and_(table.c.package_id == package_id,
+                                                               table.c.group_id.in_(removed))))
+        return added, removed
+
+
+class ScopedGrant(object):
+    '''
+    Grants an user access to every private dataset of an organization, of a
+    creator or of a bundle with a single row, so no row is stored per dataset.
+    '''
+
+    @classmethod
+    def _criteria(cls, scope, target_id, user_name):
+        table = scoped_grants_table
+        user_ids = list(get_user_ids([user_name]).values())
+        return sa.and_(table.c.scope == scope, table.c.target_id == target_id,
+                       _users_criteria([user_name], user_ids, table))
+
+    @classmethod
+    def get_by_user(cls, user_name):
+        '''Returns the (scope, target_id) pairs the given user has been granted.'''
+        table = scoped_grants_table
+        user_ids = list(get_user_ids([user_name]).values())
+        query = sa.select([table.c.scope, table.c.target_id])\
+            .where(sa.and_(_users_criteria([user_name], user_ids, table), _not_expired(table=table)))
+        return set((scope, target_id) for scope, target_id in model.Session.execute(query))
+
+    @classmethod
+    def grant(cls, scope, target_id, user_name, expires_at=None):
+        '''
+        Grants the given user access to the datasets of the given target, or sets
+        the expiry date of the grant if it already exists. Returns whether a new
+        grant has been stored. Changes are not committed.
+        '''
+        table = scoped_grants_table
+        query = table.update().values(expires_at=expires_at).where(cls._criteria(scope, target_id, user_name))
+        if model.Session.execute(query).rowcount:
+            return False
+
+        user_id = get_user_ids([user_name]).get(user_name)
+        if _insert_ignore(table, [{'scope': scope, 'target_id': target_id, 'user_name': user_name,
+                                   'user_id': user_id, 'expires_at': expires_at}]):
+            return True
+
+        # The grant has been stored by a concurrent transaction in the meantime
+        model.Session.execute(query)
+        return False
+
+    @classmethod
+    def revoke(cls, scope, target_id, user_name):
+        '''Deletes the grant and returns whether it existed. Changes are not committed.'''
+        query = scoped_grants_table.delete().where(cls._criteria(scope, target_id, user_name))
+        return model.Session.execute(query).rowcount > 0
+
+    @classmethod
+    def delete_expired(cls, batch_size=1000, now=None):
+        '''
+        Deletes up to `batch_size` grants that expired before `now` and returns
+        the number of deleted grants. Changes are not committed.
+        '''
+        table = scoped_grants_table
+        if now is None:
+            now = datetime.datetime.utcnow()
+        query = sa.select([table.c.scope, table.c.target_id, table.c.user_name])\
+            .where(table.c.expires_at <= now).order_by(table.c.expires_at).limit(batch_size)
+        expired = model.Session.execute(query).fetchall()
+
+        if expired:
+            model.Session.execute(table.delete().where(sa.or_(*[
+                sa.and_(table.c.scope == scope, table.c.target_id == target_id, table.c.user_name == user_name)
+                for scope, target_id, user_name in expired])))
+        return len(expired)
+
+
+class Bundle(object):
+    '''
+    Named set of datasets. Bundles are granted with a single scoped grant, so
+    acquiring a bundle does not depend on the number of datasets it contains.
+    '''
+
+    @classmethod
+    def get(cls, id_or_name):
+        '''Returns the (id, name, title) row of the given bundle or None if it does not exist.'''
+        table = bundles_table
+        query = sa.select([table.c.id, table.c.name, table.c.title])\
+            .where(sa.or_(table.c.id == id_or_name, table.c.name == id_or_name))
+        return model.Session.execute(query).first()
+
+    @classmethod
+    def create(cls, name, title=None):
+        '''Stores a new empty bundle and returns its id. Changes are not committed.'''
+        bundle_id = u'%s' % uuid.uuid4()
+        model.Session.execute(bundles_table.insert().values(id=bundle_id, name=name, title=title))
+        return bundle_id
+
+    @classmethod
+    def update(cls, bundle_id, **values):
+        '''Updates the name and/or title of the given bundle. Changes are not committed.'''
+        model.Session.execute(bundles_table.update().values(**values).where(bundles_table.c.id == bundle_id))
+
+    @classmethod
+    def delete(cls, bundle_id):
+        '''
+        Deletes the given bundle, its datasets and its grants, and returns the ids
+        of the datasets it contained. Changes are not committed.
+        '''
+        package_ids = cls.get_package_ids(bundle_id)
+        grants = scoped_grants_table
+        model.Session.execute(grants.delete().where(sa.and_(grants.c.scope == constants.SCOPE_BUNDLE,
+                                                            grants.c.target_id == bundle_id)))
+        model.Session.execute(bundle_packages_table.delete().where(bundle_packages_table.c.bundle_id == bundle_id))
+        model.Session.execute(bundles_table.delete().where(bundles_table.c.id == bundle_id))
+        return package_ids
+
+    @classmethod
+    def get_package_ids(cls, bundle_id):
+        '''Returns the ids of the datasets of the given bundle, sorted by id.'''
+        table = bundle_packages_table
+        query = sa.select([table.c.package_id]).where(table.c.bundle_id == bundle_id).order_by(table.c.package_id)
+        return [row[0] for row in model.Session.execute(query)]
 
-AllowedUser = None
+    @classmethod
+    def get_by_package(cls, package_ids):
+        '''Returns a dict with the ids of the bundles that contain each one of the given datasets.'''
+        package_ids = set(package_ids)
+        if not package_ids:
+            return {}
 
+        table = bundle_packages_table
+        query = sa.select([table.c.package_id, table.c.bundle_id]).where(table.c.package_id.in_(package_ids))
+        bundles = {}
+        for package_id, bundle_id in model.Session.execute(query):
+            bundles.setdefault(package_id, []).append(bundle_id)
+        return bundles
 
-def init_db(model):
+    @classmethod
+    def set_packages(cls, bundle_id, package_ids):
+        '''
+        Replaces the datasets of the given bundle and returns the ids of the
+        datasets that have been added and removed. Changes are not committed.
+        '''
+        table = bundle_packages_table
+        current = set(cls.get_package_ids(bundle_id))
+        package_ids = set(package_ids)
+        added = [row['package_id'] for row in _insert_ignore(table, [{'bundle_id': bundle_id, 'package_id': package_id}
+                                                                     for package_id in sorted(package_ids - current)])]
+        removed = sorted(current - package_ids)
 
-    global AllowedUser
-    if AllowedUser is None:
+        if removed:
+            model.Session.execute(table.delete().where(sa.and_(table.c.bundle_id == bundle_id,
+                                                               table.c.package_id.in_(removed))))
+        return added, removed
 
-        class _AllowedUser(model.DomainObject):
 
-            @classmethod
-            def get(cls, **kw):
-                '''Finds all the instances required.'''
-                query = model.Session.query(cls).autoflush(False)
-                return query.filter_by(**kw).all()
+model.meta.mapper(AllowedUser, package_allowed_users_table)
 
-        AllowedUser = _AllowedUser
 
-        # FIXME: Maybe a default value should not be included...
-        package_allowed_users_table = sa.Table(
-            'package_allowed_users',
-            model.meta.metadata,
-            sa.Column('package_id', sa.types.UnicodeText, primary_key=True, default=u''),
-            sa.Column('user_name', sa.types.UnicodeText, primary_key=True, default=u''),
-        )
+def init_db(model=None):
+    '''
+    Creates or upgrades the tables of the extension by running the pending
+    migrations. It is run when the plugin is configured and by the
+    `privatedatasets initdb` command, so requests never pay for it. The `model`
+    argument is only kept for backwards compatibility.
+    '''
+    return migration.migrate(_get_engine())
 
-        # Create the table only if it does not exist
-        package_allowed_users_table.create(checkfirst=True)
 
-        model.meta.mapper(AllowedUser, package_allowed_users_table,)
+def _get_engine():
+    return model.meta.engine
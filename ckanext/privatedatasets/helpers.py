@@ -21,24 +21,25 @@
 from __future__ import absolute_import
 
 import logging
-import os
 
 from ckan.common import request
+from ckan.lib import i18n
 import ckan.model as model
 import ckan.plugins.toolkit as tk
 
-from ckanext.privatedatasets import db
+from ckanext.privatedatasets import cache, settings
 
 
 log = logging.getLogger(__name__)
 
+# Rendered acquire buttons indexed by acquire URL and language. Its size is
+# set when the plugin is configured.
+acquire_buttons = cache.LRUCache(name='Acquire buttons')
 
-def is_dataset_acquired(pkg_dict):
-
-    db.init_db(model)
 
+def is_dataset_acquired(pkg_dict):
     if tk.c.user:
-        return len(db.AllowedUser.get(package_id=pkg_dict['id'], user_name=tk.c.user)) > 0
+        return cache.is_granted(pkg_dict['id'], tk.c.user)
     else:
         return False
 
@@ -65,18 +66,78 @@ def can_read(pkg_dict):
         return False
 
 
+def get_acquired_package_ids(packages):
+    '''
+    Return the ids of the given packages that the current user has acquired,
+    intersecting them with the packages acquired by the user at once.
+
+    :param packages: the packages to be checked
+    :type packages: list of dicts
+
+    :returns: the ids of the acquired packages
+    :rtype: frozenset
+
+    '''
+
+    return cache.get_acquired_package_ids([package['id'] for package in packages], tk.c.user)
+
+
+def get_package_list_flags(packages):
+    '''
+    Return the flags required to render a list of packages, so the package item
+    snippet does not have to call one helper per flag and package. The data of
+    the whole list is loaded in bulk.
+
+    :param packages: the packages to be rendered
+    :type packages: list of dicts
+
+    :returns: a dict with the flags of each package (``acquired``, ``owner``,
+        ``readable`` and ``acquire_url``) indexed by package id
+    :rtype: dict
+
+    '''
+
+    user = tk.c.user
+    acquired = get_acquired_package_ids(packages)
+    cache.prefetch([package['id'] for package in packages], user)
+
+    # Sysadmins can read every package
+    user_meta = cache.get_user_meta(user) if user else None
+    sysadmin = user_meta is not None and user_meta.sysadmin
+
+    flags = {}
+    for package in packages:
+        if sysadmin:
+            readable = True
+        else:
+            # Other plugins can override the auth function, so it is not called directly.
+            # The grants of the whole list have already been prefetched
+            context = {'model': model, 'user': user, 'auth_user_obj': tk.c.userobj}
+            try:
+                readable = tk.check_access('package_show', context, {'id': package['id']})
+            except (tk.NotAuthorized, tk.ObjectNotFound):
+                readable = False
+
+        flags[package['id']] = {
+            'acquired': package['id'] in acquired,
+            'owner': is_owner(package),
+            'readable': readable,
+            'acquire_url': package.get('acquire_url', '')
+        }
+
+    return flags
+
+
 def get_config_bool_value(config_name, default_value=False):
-    env_name = config_name.upper().replace('.', '_')
-    value = os.environ.get(env_name, tk.config.get(config_name, default_value))
-    return value if type(value) == bool else value.strip().lower() in ('true', '1', 'on')
+    return settings.get_bool(tk.config, config_name, default_value)
 
 
 def show_acquire_url_on_create():
-    return get_config_bool_value('ckan.privatedatasets.show_acquire_url_on_create')
+    return settings.get().show_acquire_url_on_create
 
 
 def show_acquire_url_on_edit():
-    return get_config_bool_value('ckan.privatedatasets.show_acquire_url_on_edit')
+    return settings.get().show_acquire_url_on_edit
 
 
 def acquire_button(package):
@@ -97,6 +158,8 @@ def acquire_button(package):
             and package['acquire_url'] != '':
         url_dest = package['acquire_url']
         data = {'url_dest': url_dest}
-        return tk.render_snippet('snippets/acquire_button.html', data)
+        # The button only depends on the URL and the language, so it is rendered once
+        return acquire_buttons.get((url_dest, i18n.get_lang()),
+                                   lambda: tk.render_snippet('snippets/acquire_button.html', data))
     else:
         return ''
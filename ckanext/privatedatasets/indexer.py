@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, unicode_literals
+
+import atexit
+from contextlib import contextmanager
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from ckan import model
+from ckan.lib.search.common import SearchIndexError, SolrSettings
+from ckan.plugins import toolkit as tk
+import requests
+
+from ckanext.privatedatasets import constants, db
+
+
+log = logging.getLogger(__name__)
+
+LABELS_FIELD = 'permission_labels'
+
+_local = threading.local()
+
+
+def _dirty_indexers():
+    if not hasattr(_local, 'dirty'):
+        _local.dirty = set()
+    return _local.dirty
+
+
+def user_label(user_id, user_name):
+    '''Returns the permission label of the given grantee.'''
+    if user_id:
+        return constants.ALLOWED_USER_LABEL % user_id
+    return constants.PENDING_USER_LABEL % user_name
+
+
+def _load_grants(package_ids):
+    users = db.AllowedUser.get_users_by_package(package_ids, with_ids=True)
+    bundles = db.Bundle.get_by_package(package_ids)
+    groups = db.AllowedGroup.get_groups_by_package(package_ids)
+    return dict((package_id, {'user_labels': [user_label(*user) for user in users.get(package_id, [])],
+                              'group_ids': groups.get(package_id, []),
+                              'bundle_ids': bundles.get(package_id, [])})
+                for package_id in package_ids)
+
+
+def prefetch_allowed_users(package_ids):
+    '''
+    Loads the grants of the given datasets with a single query per table, so they
+    can be indexed without querying the database once per dataset. Prefetched
+    grants are kept until `clear_prefetched` is called.
+    '''
+    if not hasattr(_local, 'prefetched'):
+        _local.prefetched = {}
+    _local.prefetched.update(_load_grants(package_ids))
+
+
+def clear_prefetched():
+    _local.prefetched = {}
+    _local.document = None
+
+
+def get_grants(package_id, keep=False):
+    '''
+    Returns the grants of a dataset that is being indexed as a dict with the labels
+    of its users (user_labels), the ids of its groups (group_ids) and the ids of
+    its bundles (bundle_ids). Prefetched grants are returned when available.
+    Otherwise, they are loaded from the database. If `keep` is True, the loaded
+    grants are kept for the next call, which uses them only once.
+    '''
+    prefetched = getattr(_local, 'prefetched', {})
+    if package_id in prefetched:
+        return prefetched[package_id]
+
+    document = getattr(_local, 'document', None)
+    _local.document = None
+    if document is not None and document[0] == package_id and not keep:
+        return document[1]
+
+    grants = _load_grants([package_id])[package_id]
+    if keep:
+        _local.document = (package_id, grants)
+    return grants
+
+
+@contextmanager
+def batch():
+    '''
+    Defers the flush of the pending label updates until the end of the block, so
+    all the changes made while processing a notification are sent to Solr in a
+    single request. If the block raises an exception, its changes are rolled back,
+    so the pending updates are discarded instead.
+    '''
+    depth = getattr(_local, 'depth', 0)
+    _local.depth = depth + 1
+    try:
+        yield
+    except Exception:
+        if depth == 0:
+            dirty = _dirty_indexers()
+            while dirty:
+                dirty.pop().discard()
+        raise
+    finally:
+        _local.depth = depth
+        if depth == 0:
+            dirty = _dirty_indexers()
+            while dirty:
+                dirty.pop().flush()
+
+
+class _DeferredReindex(object):
+    # Datasets whose reindex waits until the end of the current batch
+
+    def __init__(self, reindex):
+        self.reindex = reindex
+        self.package_ids = []
+
+    def add(self, package_id):
+        if package_id not in self.package_ids:
+            self.package_ids.append(package_id)
+
+    def flush(self):
+        getattr(_local, 'reindexes', {}).pop(self.reindex, None)
+        if self.package_ids:
+            self.reindex(self.package_ids)
+
+    def discard(self):
+        getattr(_local, 'reindexes', {}).pop(self.reindex, None)
+
+
+def reindex_after_batch(reindex, package_id):
+    '''
+    Calls `reindex` with the given dataset when the current batch ends, so it is
+    not reindexed before the changes of the block are committed. The datasets
+    deferred with the same function are passed to it in a single list, and they
+    are discarded if the block fails. Outside a batch, `reindex` is called now.
+    '''
+    if getattr(_local, 'depth', 0) == 0:
+        reindex([package_id])
+        return
+
+    if not hasattr(_local, 'reindexes'):
+        _local.reindexes = {}
+    if reindex not in _local.reindexes:
+        _local.reindexes[reindex] = _DeferredReindex(reindex)
+    _local.reindexes[reindex].add(package_id)
+    _dirty_indexers().add(_local.reindexes[reindex])
+
+
+class ReindexQueue(object):
+    '''
+    Coalesces the reindexes of the datasets whose grants change. Queued datasets
+    are deduplicated and passed to `reindex` as a single list when `max_size`
+    datasets are pending or `max_delay` seconds after the first one was queued,
+    so a burst of grants of a popular dataset only reindexes it once. Grants are
+    visible in the search results within `max_delay` seconds.
+
+    The queue is kept in memory, so each process has its own one. Datasets that
+    are still pending when the process exits are reindexed before exiting. The
+    timer runs in a thread of its own; if it never runs (e.g. threads are not
+    enabled in uWSGI or the process was forked after starting it), overdue
+    datasets are reindexed by the next call to `add`.
+    '''
+
+    def __init__(self, reindex, max_size=100, max_delay=5):
+        self.reindex = reindex
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._queued_at = None
+        self._timer = None
+        atexit.register(self.flush)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, package_id):
+        now = time.time()
+        with self._lock:
+            if not self._pending:
+                self._queued_at = now
+            self._pending.add(package_id)
+            overdue = now - self._queued_at >= self.max_delay
+            full = len(self._pending) >= self.max_size or overdue
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.max_delay, self._flush_later)
+                self._timer.daemon = True
+                self._timer.start()
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        '''Reindexes the pending datasets in the current thread.'''
+        with self._lock:
+            package_ids = sorted(self._pending)
+            self._pending.clear()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        if package_ids:
+            self.reindex(package_ids)
+
+    def _flush_later(self):
+        # Run by the timer thread, which has its own database session
+        try:
+            self.flush()
+        except Exception:
+            log.exception('Error while reindexing the queued datasets')
+        finally:
+            model.Session.remove()
+
+
+class PermissionLabelsIndexer(object):
+    '''
+    Updates the permission labels of the datasets already indexed by using Solr
+    atomic updates. Only the labels, grantees and acquirers fields are sent to
+    Solr, so the rest of the document does not have to be rebuilt every time an
+    user is granted or revoked.
+
+    Outside a `batch` block updates are sent immediately. Inside it, they are
+    queued per thread and sent when the block ends or when `batch_size` datasets
+    are pending. Solr is asked to make them visible within `commit_within` ms.
+    '''
+
+    def __init__(self, solr_url=None, commit_within=1000, batch_size=100, timeout=30):
+        self._solr_url = solr_url
+        self.commit_within = commit_within
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _pending(self):
+        if not hasattr(self._local, 'pending'):
+            self._local.pending = {}
+        return self._local.pending
+
+    def _get_connection_settings(self):
+        if self._solr_url:
+            return self._solr_url, None, None
+        return SolrSettings.get()
+
+    def _index_id(self, package_id):
+        site_id = tk.config.get('ckan.site_id')
+        return hashlib.md5(('%s%s' % (package_id, site_id)).encode('utf-8')).hexdigest()
+
+    def _queue(self, package_id, labels, operation, opposite, acquirers):
+        pending = self._pending()
+        changes = pending.setdefault(package_id, {'add': [], 'remove': [], 'count': False})
+        changes['count'] = changes['count'] or acquirers
+
+        for label in labels:
+            # The last operation over a label is the one that prevails
+            if label in changes[opposite]:
+                changes[opposite].remove(label)
+            if label not in changes[operation]:
+                changes[operation].append(label)
+
+        if getattr(_local, 'depth', 0) == 0 or len(pending) >= self.batch_size:
+            self.flush()
+        else:
+            _dirty_indexers().add(self)
+
+    def add_labels(self, package_id, labels, acquirers=True):
+        '''Adds the given labels. The acquirers are counted again unless `acquirers` is False.'''
+        self._queue(package_id, labels, 'add', 'remove', acquirers)
+
+    def remove_labels(self, package_id, labels, acquirers=True):
+        '''Removes the given labels. The acquirers are counted again unless `acquirers` is False.'''
+        self._queue(package_id, labels, 'remove', 'add', acquirers)
+
+    def discard(self):
+        '''Discards the pending updates of the current thread.'''
+        self._pending().clear()
+
+    def flush(self):
+        pending = self._pending()
+        if not pending:
+            return
+
+        # The labels may already be indexed (e.g. when an expired grant that has not been
+        # swept is renewed) or already removed (e.g. when it is swept after a reindex), so
+        # labels are added only once and the acquirers are counted again instead of
+        # being incremented
+        counted = [package_id for package_id, changes in pending.items() if changes['count']]
+        counts = db.AllowedUser.count_by_package(counted) if counted else {}
+
+        docs = []
+        for package_id, changes in pending.items():
+            operations = {}
+            if changes['add']:
+                operations['add-distinct'] = changes['add']
+            if changes['remove']:
+                operations['remove'] = changes['remove']
+            if operations:
+                doc = {'index_id': self._index_id(package_id),
+                       LABELS_FIELD: operations,
+                       constants.GRANTEES_FIELD: operations}
+                if changes['count']:
+                    doc[constants.ACQUIRERS_FIELD] = {'set': counts.get(package_id, 0)}
+                docs.append(doc)
+
+        pending.clear()
+
+        if not docs:
+            return
+
+        url, user, password = self._get_connection_settings()
+        try:
+            response = requests.post(
+                url.rstrip('/') + '/update',
+                params={'commitWithin': self.commit_within, 'wt': 'json'},
+                data=json.dumps(docs),
+                headers={'Content-Type': 'application/json'},
+                auth=(user, password) if user else None,
+                timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            log.exception(e)
+            raise SearchIndexError('Unable to update the permission labels: %s' % e)
+
+        log.debug('Permission labels of %d datasets updated', len(docs))
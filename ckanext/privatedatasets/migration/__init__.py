@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import importlib
+import logging
+import os
+import pkgutil
+
+import sqlalchemy as sa
+
+log = logging.getLogger(__name__)
+
+VERSION_TABLE = 'privatedatasets_schema_version'
+
+version_table = sa.Table(
+    VERSION_TABLE,
+    sa.MetaData(),
+    sa.Column('version', sa.types.Integer, nullable=False),
+)
+
+# Key of the advisory lock held while the tables are migrated. Locks with a
+# single key never clash with the (two keys) locks of the packages
+MIGRATION_LOCK_KEY = 0x7064747300000000
+
+_VERSIONS_PACKAGE = __name__ + '.versions'
+_VERSIONS_PATH = os.path.join(os.path.dirname(__file__), 'versions')
+
+
+class Migration(object):
+    '''
+    A migration script of the `versions` package. Its name starts with its version
+    number and it defines the `upgrade(op)` and `downgrade(op)` functions. Scripts
+    that cannot be run inside a transaction (e.g. CREATE INDEX CONCURRENTLY) set
+    `transactional = False`.
+    '''
+
+    def __init__(self, version, name, module):
+        self.version = version
+        self.name = name
+        self.module = module
+
+    @property
+    def transactional(self):
+        return getattr(self.module, 'transactional', True)
+
+    def __repr__(self):
+        return 'Migration(%d, %s)' % (self.version, self.name)
+
+
+class Operations(object):
+    '''
+    Schema operations available to the migration scripts. In offline mode the
+    statements are sent to a mock engine that prints them instead of running them.
+    '''
+
+    def __init__(self, bind, offline=False):
+        self.bind = bind
+        self.offline = offline
+
+    @property
+    def dialect(self):
+        return self.bind.dialect
+
+    def execute(self, statement):
+        return self.bind.execute(statement)
+
+    def has_table(self, table_name):
+        # In offline mode the database is assumed to be at the starting version
+        if self.offline:
+            return False
+        return self.dialect.has_table(self.bind, table_name)
+
+    def create_table(self, table):
+        self.execute(sa.schema.CreateTable(table))
+
+    def drop_table(self, table):
+        self.execute(sa.schema.DropTable(table))
+
+    def add_column(self, table_name, column):
+        column_ddl = str(sa.schema.CreateColumn(column).compile(dialect=self.dialect))
+
+        # Foreign keys are rendered inline, since SQLite cannot add them afterwards
+        for foreign_key in column.foreign_keys:
+            target_table, target_column = foreign_key.target_fullname.split('.')
+            column_ddl += ' REFERENCES %s (%s)' % (self._quote(target_table), self._quote(target_column))
+            if foreign_key.ondelete:
+                column_ddl += ' ON DELETE %s' % foreign_key.ondelete
+
+        self.execute(sa.DDL('ALTER TABLE %s ADD COLUMN %s' % (self._quote(table_name), column_ddl)))
+
+    def drop_column(self, table_name, column_name):
+        self.execute(sa.DDL('ALTER TABLE %s DROP COLUMN %s' % (self._quote(table_name), self._quote(column_name))))
+
+    def create_index(self, index):
+        self.execute(sa.schema.CreateIndex(index))
+
+    def drop_index(self, index):
+        self.execute(sa.schema.DropIndex(index))
+
+    def add_constraint(self, constraint):
+        self.execute(sa.schema.AddConstraint(constraint))
+
+    def drop_constraint(self, constraint):
+        self.execute(sa.schema.DropConstraint(constraint))
+
+    def _quote(self, name):
+        return self.dialect.identifier_preparer.quote(name)
+
+
+def get_migrations():
+    '''Returns the available migrations sorted by version.'''
+    migrations = []
+    for _, name, _ in pkgutil.iter_modules([_VERSIONS_PATH]):
+        module = importlib.import_module('%s.%s' % (_VERSIONS_PACKAGE, name))
+        migrations.append(Migration(int(name.split('_')[0]), name, module))
+    return sorted(migrations, key=lambda migration: migration.version)
+
+
+def get_head_version(migrations=None):
+    '''Returns the version of the latest migration.'''
+    migrations = get_migrations() if migrations is None else migrations
+    return migrations[-1].version if migrations else 0
+
+
+def get_current_version(connection):
+    '''Returns the version of the schema stored in the database (0 if it has not been migrated yet).'''
+    if not connection.dialect.has_table(connection, VERSION_TABLE):
+        return 0
+    return connection.execute(sa.select([sa.func.max(version_table.c.version)])).scalar() or 0
+
+
+def _set_version(bind, version):
+    bind.execute(version_table.delete())
+    bind.execute(version_table.insert().values(version=version))
+
+
+def _run(bind, migration, direction, new_version, offline=False):
+    log.info('Running %s of privatedatasets migration %s' % (direction, migration.name))
+    op = Operations(bind, offline)
+
+    if migration.transactional and not offline:
+        with bind.begin():
+            getattr(migration.module, direction)(op)
+            _set_version(bind, new_version)
+    else:
+        getattr(migration.module, direction)(op)
+        _set_version(bind, new_version)
+
+
+def _plan(migrations, current, target):
+    '''Returns the (migration, direction, new_version) steps needed to go from current to target.'''
+    versions = [0] + [migration.version for migration in migrations]
+    if target not in versions:
+        raise ValueError('Unknown privatedatasets schema version: %s' % target)
+
+    if target >= current:
+        return [(migration, 'upgrade', migration.version)
+                for migration in migrations if current < migration.version <= target]
+
+    steps = []
+    for i in reversed(range(len(migrations))):
+        migration = migrations[i]
+        if target < migration.version <= current:
+            steps.append((migration, 'downgrade', versions[i]))
+    return steps
+
+
+def migrate(engine, target=None):
+    '''
+    Upgrades or downgrades the schema of the extension tables to the target version
+    (the latest one by default). Each migration and the version it leads to are
+    committed together. In PostgreSQL, an advisory lock is held while migrating,
+    so concurrent runners never run the same migration twice. Returns the final
+    version.
+    '''
+    migrations = get_migrations()
+    target = get_head_version(migrations) if target is None else target
+
+    with engine.connect() as connection:
+        # Concurrent runners (e.g. several CKAN processes starting at once) wait for
+        # each other, and then find the migrations already run. The connection that
+        # holds the lock commits each statement on its own, so it never opens the
+        # transaction block that CREATE INDEX CONCURRENTLY cannot be run in
+        postgresql = connection.dialect.name == 'postgresql'
+        if postgresql:
+            connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+            connection.execute(sa.select([sa.func.pg_advisory_lock(MIGRATION_LOCK_KEY)]))
+
+        try:
+            version_table.create(connection, checkfirst=True)
+            current = get_current_version(connection)
+
+            for migration, direction, new_version in _plan(migrations, current, target):
+                if postgresql and migration.transactional:
+                    # Transactions cannot be opened in the connection of the lock
+                    with engine.connect() as transaction_connection:
+                        _run(transaction_connection, migration, direction, new_version)
+                else:
+                    _run(connection, migration, direction, new_version)
+                current = new_version
+        finally:
+            if postgresql:
+                connection.execute(sa.select([sa.func.pg_advisory_unlock(MIGRATION_LOCK_KEY)]))
+
+    return current
+
+
+def _create_mock_engine(url, executor):
+    if hasattr(sa, 'create_mock_engine'):
+        return sa.create_mock_engine(url, executor)
+    return sa.create_engine(url, strategy='mock', executor=executor)
+
+
+def generate_sql(url, start=0, target=None):
+    '''
+    Returns the SQL statements required to migrate a database of the given URL
+    from the start version to the target one, without connecting to it. It can be
+    used to review the migrations or to run them manually.
+    '''
+    migrations = get_migrations()
+    target = get_head_version(migrations) if target is None else target
+    statements = []
+
+    def _executor(statement, *multiparams, **params):
+        # Parameters are rendered inline so the statements can be run as they are
+        compile_kwargs = {} if isinstance(statement, sa.schema.DDLElement) else {'literal_binds': True}
+        compiled = statement.compile(dialect=engine.dialect, compile_kwargs=compile_kwargs)
+        statements.append('%s;' % str(compiled).strip())
+
+    engine = _create_mock_engine(url, _executor)
+
+    if start == 0:
+        _executor(sa.schema.CreateTable(version_table))
+
+    for migration, direction, new_version in _plan(migrations, start, target):
+        _run(engine, migration, direction, new_version, offline=True)
+
+    return statements
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Creates the package_allowed_users table, whose schema was not versioned before.'''
+
+from __future__ import absolute_import
+
+import sqlalchemy as sa
+
+
+def _table():
+    return sa.Table(
+        'package_allowed_users',
+        sa.MetaData(),
+        sa.Column('package_id', sa.types.UnicodeText, primary_key=True, default=u''),
+        sa.Column('user_name', sa.types.UnicodeText, primary_key=True, default=u''),
+    )
+
+
+def upgrade(op):
+    # Databases created by previous versions of the extension already include it
+    if not op.has_table('package_allowed_users'):
+        op.create_table(_table())
+
+
+def downgrade(op):
+    op.drop_table(_table())
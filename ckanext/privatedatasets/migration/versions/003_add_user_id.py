@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Adds the user_id column, which references the user table. Grants keep the user
+name, since users can be granted before they sign up: those grants have no
+user_id and are matched by name. The column of the existing grants is filled
+in batches by migration 010.
+'''
+
+from __future__ import absolute_import
+
+import sqlalchemy as sa
+
+
+def upgrade(op):
+    # The column is nullable and has no default, so it is added without rewriting the table
+    op.add_column('package_allowed_users',
+                  sa.Column('user_id', sa.types.UnicodeText, sa.ForeignKey('user.id', ondelete='CASCADE'),
+                            nullable=True))
+
+
+def downgrade(op):
+    op.drop_column('package_allowed_users', 'user_id')
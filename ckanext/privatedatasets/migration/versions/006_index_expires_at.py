@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Indexes the expiry date, so expired grants can be swept without scanning the table.'''
+
+from __future__ import absolute_import
+
+import sqlalchemy as sa
+
+# CREATE INDEX CONCURRENTLY cannot be run inside a transaction
+transactional = False
+
+
+def _index():
+    table = sa.Table('package_allowed_users', sa.MetaData(), sa.Column('expires_at', sa.types.DateTime))
+    return sa.Index('idx_package_allowed_users_expires_at', table.c.expires_at, postgresql_concurrently=True)
+
+
+def upgrade(op):
+    op.create_index(_index())
+
+
+def downgrade(op):
+    op.drop_index(_index())
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Creates the table of the grants of every dataset of an organization or a
+creator. It is new, so its indexes do not have to be built concurrently.
+'''
+
+from __future__ import absolute_import
+
+import sqlalchemy as sa
+
+
+def _table():
+    metadata = sa.MetaData()
+    sa.Table('user', metadata, sa.Column('id', sa.types.UnicodeText, primary_key=True))
+    return sa.Table(
+        'privatedatasets_scoped_grants',
+        metadata,
+        sa.Column('scope', sa.types.UnicodeText, primary_key=True),
+        sa.Column('target_id', sa.types.UnicodeText, primary_key=True),
+        sa.Column('user_name', sa.types.UnicodeText, primary_key=True),
+        sa.Column('user_id', sa.types.UnicodeText, sa.ForeignKey('user.id', ondelete='CASCADE'), nullable=True),
+        sa.Column('expires_at', sa.types.DateTime, nullable=True),
+        sa.Index('idx_privatedatasets_scoped_grants_user_name', 'user_name'),
+        sa.Index('idx_privatedatasets_scoped_grants_user_id', 'user_id'),
+    )
+
+
+def upgrade(op):
+    table = _table()
+    op.create_table(table)
+    for index in sorted(table.indexes, key=lambda index: index.name):
+        op.create_index(index)
+
+
+def downgrade(op):
+    op.drop_table(_table())
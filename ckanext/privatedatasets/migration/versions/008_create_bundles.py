@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Creates the tables of the bundles (named sets of datasets). Bundles are granted
+through the scoped grants table, so no grant table is created for them.
+'''
+
+from __future__ import absolute_import
+
+import sqlalchemy as sa
+
+
+def _tables():
+    metadata = sa.MetaData()
+    bundles = sa.Table(
+        'privatedatasets_bundles',
+        metadata,
+        sa.Column('id', sa.types.UnicodeText, primary_key=True),
+        sa.Column('name', sa.types.UnicodeText, nullable=False, unique=True),
+        sa.Column('title', sa.types.UnicodeText, nullable=True),
+    )
+    bundle_packages = sa.Table(
+        'privatedatasets_bundle_packages',
+        metadata,
+        sa.Column('bundle_id', sa.types.UnicodeText,
+                  sa.ForeignKey('privatedatasets_bundles.id', ondelete='CASCADE'), primary_key=True),
+        sa.Column('package_id', sa.types.UnicodeText, primary_key=True),
+        sa.Index('idx_privatedatasets_bundle_packages_package_id', 'package_id'),
+    )
+    return bundles, bundle_packages
+
+
+def upgrade(op):
+    bundles, bundle_packages = _tables()
+    op.create_table(bundles)
+    op.create_table(bundle_packages)
+    for index in bundle_packages.indexes:
+        op.create_index(index)
+
+
+def downgrade(op):
+    bundles, bundle_packages = _tables()
+    op.drop_table(bundle_packages)
+    op.drop_table(bundles)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Creates the table of the groups allowed in each dataset. Groups are stored by
+id, so renaming them or changing their members does not change the table.
+'''
+
+from __future__ import absolute_import
+
+import sqlalchemy as sa
+
+
+def _table():
+    return sa.Table(
+        'package_allowed_groups',
+        sa.MetaData(),
+        sa.Column('package_id', sa.types.UnicodeText, primary_key=True),
+        sa.Column('group_id', sa.types.UnicodeText, primary_key=True),
+        sa.Index('idx_package_allowed_groups_group_id', 'group_id'),
+    )
+
+
+def upgrade(op):
+    table = _table()
+    op.create_table(table)
+    for index in table.indexes:
+        op.create_index(index)
+
+
+def downgrade(op):
+    op.drop_table(_table())
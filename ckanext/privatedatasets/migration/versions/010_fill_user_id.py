@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Fills the user_id column of the grants of the users that already existed when
+the column was added. Rows are updated in batches, each one committed on its
+own, so the table is never locked for long.
+'''
+
+from __future__ import absolute_import
+
+import sqlalchemy as sa
+
+# Each batch is committed by the migration itself
+transactional = False
+
+BATCH_SIZE = 1000
+
+
+def _tables():
+    metadata = sa.MetaData()
+    user_table = sa.Table('user', metadata, sa.Column('id', sa.types.UnicodeText), sa.Column('name', sa.types.UnicodeText))
+    table = sa.Table('package_allowed_users', metadata, sa.Column('package_id', sa.types.UnicodeText),
+                     sa.Column('user_name', sa.types.UnicodeText), sa.Column('user_id', sa.types.UnicodeText))
+    return user_table, table
+
+
+def _fill(batch_size=None):
+    user_table, table = _tables()
+    user_id = sa.select([user_table.c.id]).where(user_table.c.name == table.c.user_name).as_scalar()
+
+    if batch_size is None:
+        return table.update().values(user_id=user_id).where(table.c.user_id.is_(None))
+
+    # Only grants of existing users are selected, so each batch makes progress
+    # and the loop ends when every one of them has been filled
+    pending = table.alias('pending')
+    batch = sa.select([pending.c.package_id, pending.c.user_name])\
+        .select_from(pending.join(user_table, user_table.c.name == pending.c.user_name))\
+        .where(pending.c.user_id.is_(None)).limit(batch_size)
+    return table.update().values(user_id=user_id)\
+        .where(sa.tuple_(table.c.package_id, table.c.user_name).in_(batch))
+
+
+def upgrade(op):
+    # The generated SQL fills every grant with a single statement, so it can be
+    # run (or split) as preferred
+    if op.offline:
+        op.execute(_fill())
+        return
+
+    while True:
+        with op.bind.begin():
+            updated = op.execute(_fill(BATCH_SIZE)).rowcount
+        if updated < BATCH_SIZE:
+            break
+
+
+def downgrade(op):
+    # The column is removed by the downgrade of migration 003
+    pass
@@ -25,6 +25,15 @@ import ckan.plugins.toolkit as tk
 import six
 
 
+# Resources can be datasets or every dataset of an organization, an user or a bundle
+RESOURCE_PATTERNS = [
+    ('datasets', re.compile('^/dataset/([^/]+).*$'), 'Dataset'),
+    ('organizations', re.compile('^/organization/([^/]+).*$'), 'Organization'),
+    ('creators', re.compile('^/user/([^/]+).*$'), 'User'),
+    ('bundles', re.compile('^/bundle/([^/]+).*$'), 'Bundle'),
+]
+
+
 class FiWareNotificationParser(object):
 
     def parse_notification(self, request_data):
@@ -39,7 +48,7 @@ class FiWareNotificationParser(object):
         # Parse the body
         resources = request_data['resources']
         user_name = request_data['customer_name']
-        datasets = []
+        targets = dict((field, []) for field, _, _ in RESOURCE_PATTERNS)
 
         if not isinstance(user_name, six.string_types):
             raise tk.ValidationError({'message': 'Invalid customer_name format'})
@@ -50,15 +59,28 @@ class FiWareNotificationParser(object):
         for resource in resources:
             if isinstance(resource, dict) and 'url' in resource:
                 parsed_url = urlparse(resource['url'])
-                dataset_name = re.findall('^/dataset/([^/]+).*$', parsed_url.path)
-
-                if len(dataset_name) == 1:
-                    if parsed_url.netloc == my_host:
-                        datasets.append(dataset_name[0])
-                    else:
-                        raise tk.ValidationError({'message': 'Dataset %s is associated with the CKAN instance located at %s'
-                                                 % (dataset_name[0], parsed_url.netloc)})
+
+                for field, pattern, kind in RESOURCE_PATTERNS:
+                    name = pattern.findall(parsed_url.path)
+
+                    if len(name) == 1:
+                        if parsed_url.netloc == my_host:
+                            targets[field].append(name[0])
+                        else:
+                            raise tk.ValidationError({'message': '%s %s is associated with the CKAN instance located at %s'
+                                                     % (kind, name[0], parsed_url.netloc)})
             else:
                 raise tk.ValidationError({'message': 'Invalid resource format'})
 
-        return {'users_datasets': [{'user': user_name, 'datasets': datasets}]}
+        user_datasets = {'user': user_name, 'datasets': targets['datasets']}
+
+        # Only included when the notification contains them
+        for field in ('organizations', 'creators', 'bundles'):
+            if targets[field]:
+                user_datasets[field] = targets[field]
+
+        # Subscriptions can include the date when the access expires
+        if 'expires_at' in request_data:
+            user_datasets['expires_at'] = request_data['expires_at']
+
+        return {'users_datasets': [user_datasets]}
@@ -20,16 +20,22 @@
 
 from __future__ import absolute_import, unicode_literals
 
+import datetime
+import logging
+
 from ckan import model, plugins as p
 from ckan.lib import search
 from ckan.lib.plugins import DefaultPermissionLabels
 from ckan.plugins import toolkit as tk
 from flask import Blueprint
+from sqlalchemy.exc import SQLAlchemyError
 
-from ckanext.privatedatasets import auth, actions, constants, converters_validators as conv_val, db, helpers
+from ckanext.privatedatasets import auth, actions, bloom, cache, constants, converters_validators as conv_val, db, helpers, indexer, settings
 from ckanext.privatedatasets.views import acquired_datasets
 
-HIDDEN_FIELDS = [constants.ALLOWED_USERS, constants.SEARCHABLE]
+HIDDEN_FIELDS = [constants.ALLOWED_USERS, constants.ALLOWED_GROUPS, constants.SEARCHABLE]
+
+log = logging.getLogger(__name__)
 
 
 class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissionLabels):
@@ -37,6 +43,7 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
     p.implements(p.IDatasetForm)
     p.implements(p.IAuthFunctions)
     p.implements(p.IConfigurer)
+    p.implements(p.IConfigurable)
     p.implements(p.IBlueprint)
     p.implements(p.IRoutes, inherit=True)
     p.implements(p.IActions)
@@ -50,6 +57,8 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
 
     def __init__(self, name=None):
         self.indexer = search.PackageSearchIndex()
+        self.labels_indexer = indexer.PermissionLabelsIndexer()
+        self.reindex_queue = None
 
     def _modify_package_schema(self):
         return {
@@ -61,6 +70,9 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
             constants.ALLOWED_USERS: [conv_val.allowed_users_convert,
                                       tk.get_validator('ignore_missing'),
                                       conv_val.private_datasets_metadata_checker],
+            constants.ALLOWED_GROUPS: [tk.get_validator('ignore_missing'),
+                                       conv_val.allowed_groups_convert,
+                                       conv_val.private_datasets_metadata_checker],
             constants.ACQUIRE_URL: [tk.get_validator('ignore_missing'),
                                     conv_val.private_datasets_metadata_checker,
                                     conv_val.url_checker,
@@ -88,6 +100,8 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
         schema.update({
             constants.ALLOWED_USERS: [conv_val.get_allowed_users,
                                       tk.get_validator('ignore_missing')],
+            constants.ALLOWED_GROUPS: [conv_val.get_allowed_groups,
+                                       tk.get_validator('ignore_missing')],
             constants.ACQUIRE_URL: [tk.get_converter('convert_from_extras'),
                                     tk.get_validator('ignore_missing')],
             constants.SEARCHABLE: [tk.get_converter('convert_from_extras'),
@@ -115,7 +129,13 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
                           # 'resource_show': auth.resource_show,
                           constants.PACKAGE_ACQUIRED: auth.package_acquired,
                           constants.ACQUISITIONS_LIST: auth.acquisitions_list,
-                          constants.PACKAGE_DELETED: auth.revoke_access}
+                          constants.PACKAGE_DELETED: auth.revoke_access,
+                          constants.SCOPED_GRANTS: auth.scoped_grants,
+                          constants.ALLOWED_USERS_PATCH: auth.allowed_users_patch,
+                          constants.BUNDLE_SHOW: auth.manage_bundles,
+                          constants.BUNDLE_CREATE: auth.manage_bundles,
+                          constants.BUNDLE_UPDATE: auth.manage_bundles,
+                          constants.BUNDLE_DELETE: auth.manage_bundles}
 
         # resource_show is not required in CKAN 2.3 because it delegates to
         # package_show
@@ -139,6 +159,29 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
         # Register this plugin's fanstatic directory with CKAN.
         tk.add_resource(b'fanstatic', b'privatedatasets')
 
+        # Settings are resolved only once
+        plugin_settings = settings.load(config)
+
+        helpers.acquire_buttons.maxsize = plugin_settings.acquire_button_cache_size
+        helpers.acquire_buttons.clear()
+        cache.acquired_packages.maxsize = plugin_settings.acquired_cache_size
+        cache.acquired_packages.clear()
+
+    ######################################################################
+    ############################ ICONFIGURABLE ###########################
+    ######################################################################
+
+    def configure(self, config):
+        # Tables are migrated at startup, so requests do not have to check them
+        if not settings.get().auto_migrate:
+            return
+
+        try:
+            db.init_db()
+        except SQLAlchemyError as e:
+            log.warning('Tables of the privatedatasets extension could not be migrated (%s). '
+                        'Run "paster privatedatasets migrate" to migrate them.' % e)
+
     ######################################################################
     ############################# IBLUEPRINT #############################
     ######################################################################
@@ -163,9 +206,15 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
 
     def get_actions(self):
         return {
+            'package_show': actions.package_show,
             constants.PACKAGE_ACQUIRED: actions.package_acquired,
             constants.ACQUISITIONS_LIST: actions.acquisitions_list,
-            constants.PACKAGE_DELETED: actions.revoke_access
+            constants.PACKAGE_DELETED: actions.revoke_access,
+            constants.ALLOWED_USERS_PATCH: actions.allowed_users_patch,
+            constants.BUNDLE_SHOW: actions.bundle_show,
+            constants.BUNDLE_CREATE: actions.bundle_create,
+            constants.BUNDLE_UPDATE: actions.bundle_update,
+            constants.BUNDLE_DELETE: actions.bundle_delete
         }
 
     ######################################################################
@@ -179,66 +228,172 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
 
     def before_index(self, pkg_dict):
 
-        if 'extras_' + constants.SEARCHABLE in pkg_dict:
-            if pkg_dict['extras_searchable'] == 'False':
-                pkg_dict['capacity'] = 'private'
-            else:
-                pkg_dict['capacity'] = 'public'
+        searchable = pkg_dict.get('extras_' + constants.SEARCHABLE)
+        if searchable is not None:
+            pkg_dict['capacity'] = 'private' if searchable == 'False' else 'public'
+
+        # Only private datasets can have allowed users and groups. CKAN calls get_dataset_labels
+        # after before_index, so the grants are kept for it instead of being loaded again
+        private = pkg_dict.get('private') is True
+        grants = indexer.get_grants(pkg_dict['id'], keep=True) if private else {'user_labels': [], 'group_ids': []}
+        user_labels = grants['user_labels']
+
+        pkg_dict[constants.PRIVATE_FIELD] = private
+        pkg_dict[constants.SEARCHABLE_FIELD] = pkg_dict.get('capacity') == 'public'
+        pkg_dict[constants.ACQUIRERS_FIELD] = len(user_labels)
+        pkg_dict[constants.GRANTEES_FIELD] = user_labels + \
+            [constants.ALLOWED_GROUP_LABEL % group_id for group_id in sorted(grants['group_ids'])]
 
         return pkg_dict
 
+    def _update_labels(self, package_id, added_users, removed_users, added_groups=(), removed_groups=()):
+        # Users are given as (user_id, user_name) pairs
+        if added_users:
+            self.labels_indexer.add_labels(package_id, [indexer.user_label(*user) for user in added_users])
+        if removed_users:
+            self.labels_indexer.remove_labels(package_id, [indexer.user_label(*user) for user in removed_users])
+
+        # Groups are not counted as acquirers
+        if added_groups:
+            self.labels_indexer.add_labels(package_id, [constants.ALLOWED_GROUP_LABEL % group_id
+                                                        for group_id in added_groups], acquirers=False)
+        if removed_groups:
+            self.labels_indexer.remove_labels(package_id, [constants.ALLOWED_GROUP_LABEL % group_id
+                                                           for group_id in removed_groups], acquirers=False)
+
     def after_create(self, context, pkg_dict):
         session = context['session']
-        update_cache = False
+        package_id = pkg_dict['id']
+        added_users = []
+        removed_users = []
+        added_groups = []
+        removed_groups = []
 
-        db.init_db(context['model'])
+        # The package may have been made public or private
+        cache.forget_package(pkg_dict['id'])
 
         # Get the users and the package ID
         if constants.ALLOWED_USERS in pkg_dict:
 
             allowed_users = pkg_dict[constants.ALLOWED_USERS]
-            package_id = pkg_dict['id']
 
-            # Get current users
-            users = db.AllowedUser.get(package_id=package_id)
+            # Concurrent updates of the list are serialized until the changes are committed,
+            # so they never insert the same user twice
+            db.lock_package(package_id)
+
+            # Get current users. The list contains their current names, so renamed users
+            # are compared by them and their grants (and expiration dates) are kept
+            users = db.AllowedUser.get_with_names(package_id)
 
             # Delete users and save the list of current users
             current_users = []
-            for user in users:
-                current_users.append(user.user_name)
-                if user.user_name not in allowed_users:
+            now = datetime.datetime.utcnow()
+            for user, user_name in users:
+                current_users.append(user_name)
+                if user_name not in allowed_users:
                     session.delete(user)
-                    update_cache = True
-
-            # Add non existing users
-            for user_name in allowed_users:
-                if user_name not in current_users:
-                    out = db.AllowedUser()
-                    out.package_id = package_id
-                    out.user_name = user_name
-                    out.save()
-                    session.add(out)
-                    update_cache = True
-
-            session.commit()
-
-            # The cache should be updated. Otherwise, the system may return
-            # outdated information in future requests
-            if update_cache:
-                new_pkg_dict = tk.get_action('package_show')(
-                    {'model': context['model'],
-                     'ignore_auth': True,
-                     'validate': False,
-                     'use_cache': False},
-                    {'id': package_id})
-
-                # Prevent acquired datasets jumping to the first position
-                revision = tk.get_action('revision_show')({'ignore_auth': True}, {'id': new_pkg_dict['revision_id']})
-                new_pkg_dict['metadata_modified'] = revision.get('timestamp', '')
-                self.indexer.update_dict(new_pkg_dict)
+                    removed_users.append((user.user_id, user_name))
+                elif user.expires_at is not None and user.expires_at <= now:
+                    # Granting an expired user again renews the grant
+                    user.expires_at = None
+                    added_users.append((user.user_id, user_name))
+
+            # Add non existing users (their ids are loaded with a single query)
+            new_users = [user_name for user_name in allowed_users if user_name not in current_users]
+            user_ids = db.get_user_ids(new_users) if new_users else {}
+            for user_name in new_users:
+                out = db.AllowedUser()
+                out.package_id = package_id
+                out.user_name = user_name
+                out.user_id = user_ids.get(user_name)
+                session.add(out)
+                added_users.append((out.user_id, user_name))
+
+            # Notifications commit the changes of all their datasets at once
+            if not context.get('defer_commit'):
+                session.commit()
+            bloom.add_grants(package_id, [user_name for _, user_name in added_users])
+            cache.forget_acquired([user_name for _, user_name in added_users + removed_users])
+
+        # Groups are stored by id, so changing their members does not change the dataset
+        if constants.ALLOWED_GROUPS in pkg_dict:
+            added_groups, removed_groups = db.AllowedGroup.set_groups(package_id, pkg_dict[constants.ALLOWED_GROUPS])
+            if not context.get('defer_commit'):
+                session.commit()
+
+        # The cache should be updated. Otherwise, the system may return
+        # outdated information in future requests
+        changed = added_users or removed_users or added_groups or removed_groups
+        if changed and settings.get().incremental_index:
+            # Only the permission labels have changed
+            self._update_labels(package_id, added_users, removed_users, added_groups, removed_groups)
+        elif changed:
+            self.reindex_package(package_id, context.get('defer_commit', False))
 
         return pkg_dict
 
+    def reindex_package(self, package_id, defer_commit=False):
+        '''
+        Reindexes a dataset whose grants have changed. If the changes are committed
+        by the caller (`defer_commit`), it is reindexed when the current batch ends.
+        If `reindex_delay` is set, it is queued instead of being reindexed now.
+        '''
+        if defer_commit:
+            # Notifications are committed by the caller, so their datasets are reindexed afterwards
+            indexer.reindex_after_batch(self._reindex_later, package_id)
+        elif settings.get().reindex_delay:
+            # Bursts of grants of the same dataset only reindex it once
+            self._get_reindex_queue().add(package_id)
+        else:
+            # before_index and get_dataset_labels share the grants loaded for this dataset
+            indexer.prefetch_allowed_users([package_id])
+            try:
+                self.indexer.update_dict(self._get_index_dict(model, package_id))
+            finally:
+                indexer.clear_prefetched()
+
+    def _reindex_later(self, package_ids):
+        # Called once the changes of a batch have been committed
+        if settings.get().reindex_delay:
+            for package_id in package_ids:
+                self._get_reindex_queue().add(package_id)
+        else:
+            self._reindex_packages(package_ids)
+
+    def _get_index_dict(self, model, package_id):
+        new_pkg_dict = tk.get_action('package_show')(
+            {'model': model,
+             'ignore_auth': True,
+             'validate': False,
+             'use_cache': False},
+            {'id': package_id})
+
+        # Prevent acquired datasets jumping to the first position
+        revision = tk.get_action('revision_show')({'ignore_auth': True}, {'id': new_pkg_dict['revision_id']})
+        new_pkg_dict['metadata_modified'] = revision.get('timestamp', '')
+        return new_pkg_dict
+
+    def _get_reindex_queue(self):
+        if self.reindex_queue is None:
+            self.reindex_queue = indexer.ReindexQueue(self._reindex_packages, settings.get().reindex_batch_size,
+                                                      settings.get().reindex_delay)
+        return self.reindex_queue
+
+    def _reindex_packages(self, package_ids):
+        # The grants of the queued datasets are loaded with a single query
+        indexer.prefetch_allowed_users(package_ids)
+        try:
+            for package_id in package_ids:
+                try:
+                    self.indexer.update_dict(self._get_index_dict(model, package_id), defer_commit=True)
+                except Exception as e:
+                    # The dataset may have been deleted since it was queued
+                    log.error('Error while indexing dataset %s: %s' % (package_id, e))
+        finally:
+            indexer.clear_prefetched()
+
+        self.indexer.commit()
+
     def after_update(self, context, pkg_dict):
         return self.after_create(context, pkg_dict)
 
@@ -261,19 +416,26 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
     def after_delete(self, context, pkg_dict):
         session = context['session']
         package_id = pkg_dict['id']
+        cache.forget_package(package_id)
 
         # Get current users
-        db.init_db(context['model'])
         users = db.AllowedUser.get(package_id=package_id)
 
-        # Delete all the users
+        # Delete all the users and groups
+        user_names = [user.user_name for user in users]
         for user in users:
             session.delete(user)
+        db.AllowedGroup.set_groups(package_id, [])
         session.commit()
+        cache.forget_acquired(user_names)
 
         return pkg_dict
 
     def after_search(self, search_results, search_params):
+        # Load the data required to check whether the user can read each package
+        # with a fixed number of queries
+        cache.prefetch([result['id'] for result in search_results['results']], tk.c.user)
+
         for result in search_results['results']:
             # Extra fields should not be returned
             # The original list cannot be modified
@@ -309,6 +471,25 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
         if getattr(dataset_obj, 'searchable', False):
             labels.append('searchable')
 
+        # Users included in the list of allowed users get a label of their own, so
+        # Solr can filter private datasets at query time
+        if dataset_obj.private:
+            grants = indexer.get_grants(dataset_obj.id)
+            labels.extend(grants['user_labels'])
+
+            # Members of the allowed groups get the labels of their groups
+            for group_id in sorted(grants['group_ids']):
+                labels.append(constants.ALLOWED_GROUP_LABEL % group_id)
+
+            # Scoped grants are matched through the labels of the users, so datasets
+            # do not have to be reindexed when they change
+            if dataset_obj.owner_org:
+                labels.append(constants.SCOPED_GRANT_LABEL % (constants.SCOPE_ORGANIZATION, dataset_obj.owner_org))
+            if dataset_obj.creator_user_id:
+                labels.append(constants.SCOPED_GRANT_LABEL % (constants.SCOPE_CREATOR, dataset_obj.creator_user_id))
+            for bundle_id in sorted(grants['bundle_ids']):
+                labels.append(constants.SCOPED_GRANT_LABEL % (constants.SCOPE_BUNDLE, bundle_id))
+
         return labels
 
     def get_user_dataset_labels(self, user_obj):
@@ -316,6 +497,17 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
             user_obj)
 
         labels.append('searchable')
+
+        if user_obj:
+            labels.append(constants.ALLOWED_USER_LABEL % user_obj.id)
+            labels.append(constants.PENDING_USER_LABEL % user_obj.name)
+
+            for scope, target_id in sorted(cache.get_scoped_grants(user_obj.name)):
+                labels.append(constants.SCOPED_GRANT_LABEL % (scope, target_id))
+
+            for group_id in sorted(cache.get_user_group_ids(user_obj.name)):
+                labels.append(constants.ALLOWED_GROUP_LABEL % group_id)
+
         return labels
 
     ######################################################################
@@ -327,6 +519,8 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
                 'get_allowed_users_str': helpers.get_allowed_users_str,
                 'is_owner': helpers.is_owner,
                 'can_read': helpers.can_read,
+                'get_acquired_package_ids': helpers.get_acquired_package_ids,
+                'get_package_list_flags': helpers.get_package_list_flags,
                 'show_acquire_url_on_create': helpers.show_acquire_url_on_create,
                 'show_acquire_url_on_edit': helpers.show_acquire_url_on_edit,
                 'acquire_button': helpers.acquire_button
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from collections import namedtuple
+import os
+
+from ckan.plugins import toolkit as tk
+
+from ckanext.privatedatasets import constants
+
+
+Settings = namedtuple('Settings', [
+    'parser',
+    'show_acquire_url_on_create',
+    'show_acquire_url_on_edit',
+    'incremental_index',
+    'acquire_button_cache_size',
+    'auto_migrate',
+    'reindex_delay',
+    'reindex_batch_size',
+    'grants_filter_refresh',
+    'grants_filter_error_rate',
+    'grants_filter_max_memory',
+    'acquired_cache_ttl',
+    'acquired_cache_size',
+    'grants_snapshot',
+    'grants_snapshot_refresh',
+    'notifier_users',
+])
+
+_settings = None
+
+
+def _get_raw_value(config, config_name, default_value):
+    # Environment variables take precedence over the config file
+    env_name = config_name.upper().replace('.', '_')
+    return os.environ.get(env_name, config.get(config_name, default_value))
+
+
+def get_bool(config, config_name, default_value=False):
+    value = _get_raw_value(config, config_name, default_value)
+    return value if isinstance(value, bool) else value.strip().lower() in ('true', '1', 'on')
+
+
+def _get_int(config, config_name, default_value, min_value, description):
+    value = _get_raw_value(config, config_name, default_value)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        value = -1
+
+    if value < min_value:
+        raise ValueError('%s must be a %s integer' % (config_name, description))
+
+    return value
+
+
+def get_positive_int(config, config_name, default_value):
+    return _get_int(config, config_name, default_value, 1, 'positive')
+
+
+def get_non_negative_int(config, config_name, default_value):
+    return _get_int(config, config_name, default_value, 0, 'non-negative')
+
+
+def get_probability(config, config_name, default_value):
+    value = _get_raw_value(config, config_name, default_value)
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        value = -1
+
+    if not 0 < value < 1:
+        raise ValueError('%s must be a number between 0 and 1' % config_name)
+
+    return value
+
+
+def get_list(config, config_name):
+    # Values can be separated by spaces or commas
+    value = _get_raw_value(config, config_name, '')
+    return frozenset(value.replace(',', ' ').split())
+
+
+def load(config=None):
+    '''
+    Resolves the settings of the extension from the environment and the given
+    config (the CKAN one by default) and stores them so they do not have to be
+    parsed again. It is called when the plugin is configured.
+    '''
+    global _settings
+
+    if config is None:
+        config = tk.config
+
+    _settings = Settings(
+        parser=_get_raw_value(config, constants.PARSER, '').strip(),
+        show_acquire_url_on_create=get_bool(config, constants.SHOW_ACQUIRE_URL_ON_CREATE),
+        show_acquire_url_on_edit=get_bool(config, constants.SHOW_ACQUIRE_URL_ON_EDIT),
+        incremental_index=get_bool(config, constants.INCREMENTAL_INDEX),
+        acquire_button_cache_size=get_positive_int(config, constants.ACQUIRE_BUTTON_CACHE_SIZE, 1000),
+        auto_migrate=get_bool(config, constants.AUTO_MIGRATE),
+        reindex_delay=get_non_negative_int(config, constants.REINDEX_DELAY, 0),
+        reindex_batch_size=get_positive_int(config, constants.REINDEX_BATCH_SIZE, 100),
+        grants_filter_refresh=get_non_negative_int(config, constants.GRANTS_FILTER_REFRESH, 0),
+        grants_filter_error_rate=get_probability(config, constants.GRANTS_FILTER_ERROR_RATE, 0.01),
+        grants_filter_max_memory=get_positive_int(config, constants.GRANTS_FILTER_MAX_MEMORY, 16),
+        acquired_cache_ttl=get_non_negative_int(config, constants.ACQUIRED_CACHE_TTL, 0),
+        acquired_cache_size=get_positive_int(config, constants.ACQUIRED_CACHE_SIZE, 1000),
+        grants_snapshot=_get_raw_value(config, constants.GRANTS_SNAPSHOT, '').strip(),
+        grants_snapshot_refresh=get_positive_int(config, constants.GRANTS_SNAPSHOT_REFRESH, 10),
+        notifier_users=get_list(config, constants.NOTIFIER_USERS),
+    )
+
+    return _settings
+
+
+def get():
+    '''Returns the settings of the extension, resolving them the first time it is called.'''
+    if _settings is None:
+        load()
+    return _settings
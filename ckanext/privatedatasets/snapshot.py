@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import absolute_import
+
+import calendar
+import hashlib
+import heapq
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from ckanext.privatedatasets import db, settings
+
+
+log = logging.getLogger(__name__)
+
+# Snapshots start with a header (magic, version and number of grants) followed
+# by one record (key and expiry time) per grant, sorted by key
+MAGIC = b'PDGS'
+VERSION = 1
+HEADER = struct.Struct('>4sB3xQ')
+RECORD = struct.Struct('>QI')
+# Grants that never expire are stored with this expiry time
+NEVER = 0
+MAX_EXPIRY = 0xffffffff
+# Grants are sorted in runs of this many records, which are merged while the
+# snapshot is written, so it can be larger than the memory available
+RUN_SIZE = 500000
+
+_snapshot = None
+_checked_at = 0
+_snapshot_lock = threading.Lock()
+
+# Python 2 has no os.replace, but os.rename already replaces files atomically in POSIX
+_replace = getattr(os, 'replace', os.rename)
+
+
+def grant_key(package_id, user_name):
+    '''
+    Returns the key of a grant: the first 64 bits of the MD5 digest of the
+    package id and the user name. With n grants, the probability of finding a
+    key that has not been stored is close to n / 2^64.
+    '''
+    digest = hashlib.md5(('%s\n%s' % (package_id, user_name)).encode('utf-8')).digest()
+    return struct.unpack('>Q', digest[:8])[0]
+
+
+def _expiry_time(expires_at):
+    if expires_at is None:
+        return NEVER
+    return min(max(calendar.timegm(expires_at.utctimetuple()), 1), MAX_EXPIRY)
+
+
+def _write_run(records, directory):
+    # Packed records are sorted by key (and by expiry time) as byte strings
+    records.sort()
+    run_file = tempfile.TemporaryFile(dir=directory)
+    for start in range(0, len(records), 10000):
+        run_file.write(b''.join(records[start:start + 10000]))
+    run_file.seek(0)
+    return run_file
+
+
+def _read_run(run_file):
+    while True:
+        data = run_file.read(RECORD.size * 10000)
+        if not data:
+            break
+        for start in range(0, len(data), RECORD.size):
+            yield data[start:start + RECORD.size]
+
+
+def _unique(records):
+    # A user renamed to the name of an user that has not signed up yet can have
+    # two grants of the same package, and the one that lasts longer is kept
+    last = None
+    for record in records:
+        key, expires = RECORD.unpack(record)
+        if last is not None and last[0] != key:
+            yield last
+            last = None
+        if last is None or expires == NEVER or last[1] != NEVER and expires > last[1]:
+            last = (key, expires)
+
+    if last is not None:
+        yield last
+
+
+def write(path, grants):
+    '''
+    Writes the given (package_id, user_name, expires_at) grants to a snapshot in
+    `path` and returns the number of grants written. Grants are packed and sorted
+    in runs of `RUN_SIZE` records, which are spilled to temporary files and merged,
+    so only one run is kept in memory. The snapshot is written to a temporary file
+    that replaces `path` once it is complete, so processes never open a partial
+    snapshot.
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    runs = []
+    try:
+        records = []
+        for package_id, user_name, expires_at in grants:
+            records.append(RECORD.pack(grant_key(package_id, user_name), _expiry_time(expires_at)))
+            if len(records) == RUN_SIZE:
+                runs.append(_write_run(records, directory))
+                records = []
+
+        if runs:
+            if records:
+                runs.append(_write_run(records, directory))
+            # The last run is only kept in its file while the runs are merged
+            records = None
+            merged = heapq.merge(*[_read_run(run_file) for run_file in runs])
+        else:
+            records.sort()
+            merged = records
+
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.%s.' % os.path.basename(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as snapshot_file:
+                # The number of grants is written once they have been deduplicated
+                snapshot_file.write(HEADER.pack(MAGIC, VERSION, 0))
+                count = 0
+                chunk = []
+                for key, expires in _unique(merged):
+                    chunk.append(RECORD.pack(key, expires))
+                    if len(chunk) == 10000:
+                        snapshot_file.write(b''.join(chunk))
+                        count += len(chunk)
+                        chunk = []
+                snapshot_file.write(b''.join(chunk))
+                count += len(chunk)
+
+                snapshot_file.seek(0)
+                snapshot_file.write(HEADER.pack(MAGIC, VERSION, count))
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            os.chmod(temp_path, 0o644)
+            _replace(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+    finally:
+        for run_file in runs:
+            run_file.close()
+
+    return count
+
+
+def export(path):
+    '''Exports the grants that have not expired to a snapshot in `path` and returns how many were exported.'''
+    return write(path, db.AllowedUser.iter_grants(with_expiry=True))
+
+
+def _file_identity(stat):
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime
+
+
+class GrantsSnapshot(object):
+    '''
+    Read-only view of a snapshot file. The file is memory mapped, so it is shared
+    by every process that opens it and only the pages that are read are loaded.
+    Each lookup is a binary search over the sorted keys.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as snapshot_file:
+            self._identity = _file_identity(os.fstat(snapshot_file.fileno()))
+            if self._identity[2] < HEADER.size:
+                raise ValueError('%s is not a grants snapshot' % path)
+            self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION or len(self._map) != HEADER.size + self.count * RECORD.size:
+            raise ValueError('%s is not a grants snapshot' % path)
+
+    def __len__(self):
+        return self.count
+
+    def is_outdated(self):
+        '''Returns whether the file has been replaced since it was opened.'''
+        return _file_identity(os.stat(self.path)) != self._identity
+
+    def _record(self, index):
+        return RECORD.unpack_from(self._map, HEADER.size + index * RECORD.size)
+
+    def is_granted(self, package_id, user_name, now=None):
+        '''Returns whether the given user was granted the given package and the grant has not expired.'''
+        key = grant_key(package_id, user_name)
+
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low == self.count:
+            return False
+
+        record_key, expires = self._record(low)
+        if now is None:
+            now = time.time()
+        return record_key == key and (expires == NEVER or expires > now)
+
+
+def is_enabled():
+    '''Returns whether grants are read from a snapshot instead of the database.'''
+    return bool(settings.get().grants_snapshot)
+
+
+def get_snapshot():
+    '''
+    Returns the configured snapshot, or None when it cannot be loaded. Every
+    `grants_snapshot_refresh` seconds the file is checked, and it is opened again
+    when it has been replaced. Lookups that already hold the previous snapshot
+    keep using it, since its file stays mapped until nobody uses it.
+    '''
+    global _snapshot, _checked_at
+
+    config = settings.get()
+    now = time.time()
+    if now - _checked_at < config.grants_snapshot_refresh:
+        return _snapshot
+
+    with _snapshot_lock:
+        if now - _checked_at >= config.grants_snapshot_refresh:
+            try:
+                if _snapshot is None or _snapshot.is_outdated():
+                    _snapshot = GrantsSnapshot(config.grants_snapshot)
+                    log.debug('Grants snapshot %s loaded (%d grants)', config.grants_snapshot, len(_snapshot))
+            except (IOError, OSError, ValueError) as e:
+                # The previous snapshot (if any) is used until the new one can be loaded
+                log.error('Grants snapshot %s could not be loaded: %s', config.grants_snapshot, e)
+            _checked_at = now
+
+    return _snapshot
+
+
+def is_granted(package_id, user_name):
+    '''Returns whether the snapshot contains a grant of the given package to the given user.'''
+    grants_snapshot = get_snapshot()
+    # Nobody is granted while no snapshot has been loaded
+    return grants_snapshot is not None and grants_snapshot.is_granted(package_id, user_name)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import unittest
+import uuid
+
+import sqlalchemy as sa
+
+# URL of a PostgreSQL database where the tests can create (and drop) schemas of their own
+TEST_DB_URL = os.environ.get('PRIVATEDATASETS_TEST_DB_URL')
+
+skip_unless_configured = unittest.skipUnless(TEST_DB_URL, 'PRIVATEDATASETS_TEST_DB_URL is not set')
+
+
+class TemporarySchema(object):
+    '''
+    Schema of the test database that is dropped when the test ends. The
+    connections of its engine only see the tables created in it.
+    '''
+
+    def __init__(self):
+        self.name = 'privatedatasets_test_%s' % uuid.uuid4().hex
+        self._execute('CREATE SCHEMA %s' % self.name)
+        self.engine = sa.create_engine(TEST_DB_URL, connect_args={'options': '-csearch_path=%s' % self.name})
+
+    def _execute(self, statement):
+        admin_engine = sa.create_engine(TEST_DB_URL)
+        try:
+            admin_engine.execute(statement)
+        finally:
+            admin_engine.dispose()
+
+    def drop(self):
+        self.engine.dispose()
+        self._execute('DROP SCHEMA %s CASCADE' % self.name)
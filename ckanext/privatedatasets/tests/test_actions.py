@@ -18,10 +18,19 @@
 # along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
 
 import ckanext.privatedatasets.actions as actions
+import ckanext.privatedatasets.constants as constants
+import ckanext.privatedatasets.db as db
+import ckanext.privatedatasets.plugin as plugin
+from ckanext.privatedatasets.tests import postgresql
+import datetime
+import random
+import threading
 import unittest
 
-from mock import MagicMock
+from mock import MagicMock, call
 from parameterized import parameterized
+import sqlalchemy as sa
+from sqlalchemy import orm
 
 PARSER_CONFIG_PROP = 'ckan.privatedatasets.parser'
 IMPORT_ERROR_MSG = 'Unable to load the module'
@@ -43,11 +52,47 @@ class ActionsTest(unittest.TestCase):
         self._db = actions.db
         actions.db = MagicMock()
 
+        self._bloom = actions.bloom
+        actions.bloom = MagicMock()
+
+        self._request = actions.request
+        actions.request = MagicMock()
+
+        self._helpers = actions.helpers
+        actions.helpers = MagicMock()
+
+        self._settings = actions.settings
+        actions.settings = MagicMock()
+
+        self._model = actions.model
+        actions.model = MagicMock()
+
+        self._search = actions.search
+        actions.search = MagicMock()
+
+        self._cache = actions.cache
+        actions.cache = MagicMock()
+
+        self._indexer = actions.indexer
+        actions.indexer = MagicMock()
+        actions.indexer.user_label.side_effect = self._indexer.user_label
+
+        # Parser classes must be loaded again in each test
+        actions._parser_classes.clear()
+
     def tearDown(self):
         # Unmock
         actions.importlib = self._importlib
         actions.plugins = self._plugins
         actions.db = self._db
+        actions.bloom = self._bloom
+        actions.request = self._request
+        actions.helpers = self._helpers
+        actions.settings = self._settings
+        actions.model = self._model
+        actions.search = self._search
+        actions.cache = self._cache
+        actions.indexer = self._indexer
 
     @parameterized.expand([
         ('',              None,       False, False, '%s not configured' % PARSER_CONFIG_PROP),
@@ -62,7 +107,7 @@ class ActionsTest(unittest.TestCase):
     def test_class_cannot_be_loaded(self, class_path, class_name, path_exist, class_exist, expected_error):
         class_package = class_path
         class_package += ':' + class_name if class_name else ''
-        actions.plugins.toolkit.config = {PARSER_CONFIG_PROP: class_package}
+        actions.settings.get.return_value.parser = class_package
 
         # Recover exception
         actions.plugins.toolkit.ValidationError = self._plugins.toolkit.ValidationError
@@ -86,10 +131,23 @@ class ActionsTest(unittest.TestCase):
         # Checks
         self.assertEquals(0, actions.plugins.toolkit.get_action.call_count)
 
+    def test_parser_class_loaded_once(self):
+        actions.settings.get.return_value.parser = 'valid.path:%s' % CLASS_NAME
+        actions.importlib.import_module.return_value.parser_class.return_value.parse_notification.return_value = {
+            'users_datasets': []
+        }
+
+        actions.package_acquired({}, {})
+        actions.revoke_access({}, {})
+
+        actions.importlib.import_module.assert_called_once_with('valid.path')
+        # A new parser is created for each notification
+        self.assertEquals(2, actions.importlib.import_module.return_value.parser_class.call_count)
+
     def configure_mocks(self, parse_result, datasets_not_found=[], not_updatable_datasets=[],
             allowed_users=None, creator_user={'id': '1234', 'name': 'ckan'}):
 
-        actions.plugins.toolkit.config = {PARSER_CONFIG_PROP: 'valid.path:%s' % CLASS_NAME}
+        actions.settings.get.return_value.parser = 'valid.path:%s' % CLASS_NAME
 
         # Configure mocks
         parser_instance = MagicMock()
@@ -133,6 +191,7 @@ class ActionsTest(unittest.TestCase):
                 return user_show
 
         actions.plugins.toolkit.get_action = _get_action
+        actions.db.get_package_ids.side_effect = lambda dataset_ids: dict((id, id) for id in dataset_ids)
 
         return parser_instance.parse_notification, package_show, package_update, user_show
 
@@ -204,10 +263,181 @@ class ActionsTest(unittest.TestCase):
                     context_update = context.copy()
                     context_update['ignore_auth'] = True
                     context_update['user'] = creator_user['name']
+                    context_update['defer_commit'] = True
 
                     package_update.assert_any_call(context_update, {'id': dataset_id, 'allowed_users': expected_allowed_users, 'private': True, 'creator_user_id': creator_user['id']})
 
 
+    @parameterized.expand([
+        # The expiry date is set even if the user was already allowed
+        ([],         '2018-12-31T23:59:59Z', datetime.datetime(2018, 12, 31, 23, 59, 59)),
+        (['user1'],  '2018-12-31',           datetime.datetime(2018, 12, 31)),
+        (['user1'],  None,                   None),
+    ])
+    def test_add_users_expiry(self, allowed_users, expires_at, expected_expires_at):
+        parse_result = {'users_datasets': [{'user': 'user1', 'datasets': ['ds1', 'ds2', 'ds3'], 'expires_at': expires_at}]}
+        _, _, package_update, _ = self.configure_mocks(parse_result, ['ds2'], ['ds3'], allowed_users)
+
+        context = {'user': 'user1', 'model': 'model', 'auth_obj': {'id': 1}, 'method': 'grant'}
+        actions.package_acquired(context, {})
+
+        # Public and not found datasets are skipped
+        actions.db.AllowedUser.set_expiry.assert_called_once_with('ds1', 'user1', expected_expires_at)
+        actions.cache.forget_acquired.assert_called_once_with(['user1'])
+
+        # Every dataset is locked before any of them is changed
+        actions.db.lock_packages.assert_called_once()
+        self.assertEquals(['ds1', 'ds2', 'ds3'], sorted(actions.db.lock_packages.call_args[0][0]))
+
+    def test_add_users_not_found(self):
+        parse_result = {'users_datasets': [{'user': 'user1', 'datasets': ['ds1']}]}
+        _, package_show, _, _ = self.configure_mocks(parse_result)
+        actions.db.get_package_ids.side_effect = None
+        actions.db.get_package_ids.return_value = {}
+
+        context = {'user': 'user1', 'model': 'model', 'auth_obj': {'id': 1}, 'method': 'grant'}
+        result = actions.package_acquired(context, {})
+
+        # Datasets that do not exist are not locked
+        self.assertEquals({'warns': ['Dataset ds1 was not found in this instance']}, result)
+        actions.db.get_package_ids.assert_called_once_with(['ds1'])
+        self.assertEquals(0, len(list(actions.db.lock_packages.call_args[0][0])))
+        self.assertEquals(0, package_show.call_count)
+
+    def test_single_transaction(self):
+        parse_result = {'users_datasets': [{'user': 'user1', 'datasets': ['ds1', 'ds2', 'ds3', 'ds4']}]}
+        _, _, package_update, _ = self.configure_mocks(parse_result, ['ds2'], ['ds3'], [])
+        savepoints = []
+        actions.model.Session.begin_nested.side_effect = lambda: savepoints.append(MagicMock()) or savepoints[-1]
+
+        context = {'user': 'user1', 'model': 'model', 'auth_obj': {'id': 1}, 'method': 'grant'}
+        actions.package_acquired(context, {})
+
+        # Each dataset has its own savepoint, and the failed ones are rolled back
+        self.assertEquals(4, len(savepoints))
+        self.assertEquals([0, 1, 0, 0], [savepoint.rollback.call_count for savepoint in savepoints])
+        self.assertEquals([1, 0, 1, 1], [savepoint.commit.call_count for savepoint in savepoints])
+
+        # Datasets are updated without committing, and everything is committed at once
+        for args, _ in package_update.call_args_list:
+            self.assertTrue(args[0]['defer_commit'])
+        self.assertEquals(2, package_update.call_count)
+        actions.model.Session.commit.assert_called_once_with()
+        self.assertEquals(0, actions.model.Session.rollback.call_count)
+
+    def test_single_transaction_error(self):
+        parse_result = {'users_datasets': [{'user': 'user1', 'datasets': ['ds1', 'ds2']}]}
+        _, package_show, _, _ = self.configure_mocks(parse_result)
+        package_show.side_effect = [{'id': 'ds1', 'private': True, 'allowed_users': []}, Exception('Database error')]
+
+        context = {'user': 'user1', 'model': 'model', 'auth_obj': {'id': 1}, 'method': 'grant'}
+        self.assertRaises(Exception, actions.package_acquired, context, {})
+
+        # Unexpected errors roll back the whole notification
+        actions.model.Session.rollback.assert_called_once_with()
+        self.assertEquals(0, actions.model.Session.commit.call_count)
+
+    def test_add_users_invalid_expiry(self):
+        parse_result = {'users_datasets': [{'user': 'user1', 'datasets': ['ds1'], 'expires_at': 'tomorrow'}]}
+        _, package_show, _, _ = self.configure_mocks(parse_result)
+
+        context = {'user': 'user1', 'model': 'model', 'auth_obj': {'id': 1}, 'method': 'grant'}
+        self.assertRaises(self._plugins.toolkit.ValidationError, actions.package_acquired, context, {})
+
+        # Nothing is changed
+        self.assertEquals(0, package_show.call_count)
+
+    def test_add_users_without_expiry(self):
+        parse_result = {'users_datasets': [{'user': 'user1', 'datasets': ['ds1']}]}
+        self.configure_mocks(parse_result)
+
+        actions.package_acquired({'user': 'user1', 'model': 'model', 'method': 'grant'}, {})
+
+        self.assertEquals(0, actions.db.AllowedUser.set_expiry.call_count)
+
+    @parameterized.expand([
+        ('grant',),
+        ('revoke',),
+    ])
+    def test_scoped_grants(self, method):
+        expires_at = '2018-12-31T23:59:59Z'
+        parse_result = {'users_datasets': [{'user': 'user1', 'organizations': ['conwet', 'missing', 'user_org'],
+                                            'creators': ['publisher', 'unknown'], 'bundles': ['bundle'],
+                                            'expires_at': expires_at}]}
+        _, package_show, package_update, _ = self.configure_mocks(parse_result)
+
+        organizations = {'conwet': MagicMock(id='org_id', is_organization=True),
+                         'user_org': MagicMock(id='group_id', is_organization=False)}
+        actions.model.Group.get.side_effect = organizations.get
+        actions.model.User.get.side_effect = {'publisher': MagicMock(id='publisher_id')}.get
+        actions.db.Bundle.get.side_effect = {'bundle': MagicMock(id='bundle_id')}.get
+
+        context = {'user': 'user1', 'model': 'model', 'auth_obj': {'id': 1}}
+        action = actions.package_acquired if method == 'grant' else actions.revoke_access
+        result = action(context, {})
+
+        # Scoped grants require further permissions
+        actions.plugins.toolkit.check_access.assert_called_with('scoped_grants', context, {})
+
+        # Organizations (not groups) and users that do not exist are reported
+        self.assertEquals({'warns': ['Creator unknown was not found in this instance',
+                                     'Organization missing was not found in this instance',
+                                     'Organization user_org was not found in this instance']}, result)
+
+        # No dataset is updated
+        self.assertEquals(0, package_show.call_count)
+        self.assertEquals(0, package_update.call_count)
+
+        if method == 'grant':
+            expected_expires_at = actions.conv_val.parse_expires_at(expires_at)
+            self.assertEquals([call('bundle', 'bundle_id', 'user1', expected_expires_at),
+                               call('creator', 'publisher_id', 'user1', expected_expires_at),
+                               call('organization', 'org_id', 'user1', expected_expires_at)],
+                              actions.db.ScopedGrant.grant.call_args_list)
+            self.assertEquals(0, actions.db.ScopedGrant.revoke.call_count)
+        else:
+            self.assertEquals([call('bundle', 'bundle_id', 'user1'), call('creator', 'publisher_id', 'user1'),
+                               call('organization', 'org_id', 'user1')],
+                              actions.db.ScopedGrant.revoke.call_args_list)
+            self.assertEquals(0, actions.db.ScopedGrant.grant.call_count)
+
+        actions.model.Session.commit.assert_called_once_with()
+
+    @parameterized.expand([
+        ('grant',  'organizations'),
+        ('grant',  'creators'),
+        ('revoke', 'bundles'),
+    ])
+    def test_scoped_grants_not_authorized(self, method, field):
+        parse_result = {'users_datasets': [{'user': 'user1', 'datasets': ['ds1']},
+                                           {'user': 'user2', field: ['target']}]}
+        _, package_show, package_update, _ = self.configure_mocks(parse_result)
+
+        # Anonymous notifications are allowed, but they cannot change scoped grants
+        def _check_access(name, context, data_dict):
+            if name == 'scoped_grants':
+                raise self._plugins.toolkit.NotAuthorized()
+
+        actions.plugins.toolkit.check_access.side_effect = _check_access
+
+        action = actions.package_acquired if method == 'grant' else actions.revoke_access
+        self.assertRaises(self._plugins.toolkit.NotAuthorized, action, {'user': None, 'model': 'model'}, {})
+
+        # Nothing is changed
+        self.assertEquals(0, package_show.call_count)
+        self.assertEquals(0, package_update.call_count)
+        self.assertEquals(0, actions.db.ScopedGrant.grant.call_count)
+        self.assertEquals(0, actions.db.ScopedGrant.revoke.call_count)
+        self.assertEquals(0, actions.model.Session.commit.call_count)
+
+    def test_datasets_do_not_check_scoped_grants(self):
+        self.configure_mocks({'users_datasets': [{'user': 'user1', 'datasets': ['ds1'], 'organizations': []}]})
+
+        context = {'user': None, 'model': 'model'}
+        actions.package_acquired(context, {})
+
+        actions.plugins.toolkit.check_access.assert_called_once_with('package_acquired', context, {})
+
     @parameterized.expand([
         (None,               {},),
         ({},                 {2: actions.plugins.toolkit.ObjectNotFound},),
@@ -240,14 +470,7 @@ class ActionsTest(unittest.TestCase):
         actions.plugins.toolkit.get_action.return_value = package_show
 
         # query mock
-        query_res = []
-        for i in pkgs_ids:
-            pkg = MagicMock()
-            pkg.package_id = i
-            pkg.user_name = user
-            query_res.append(pkg)
-
-        actions.db.AllowedUser.get = MagicMock(return_value=query_res)
+        actions.db.AllowedUser.iter_by_user = MagicMock(return_value=iter(pkgs_ids))
 
         # Context
         context = {
@@ -261,14 +484,11 @@ class ActionsTest(unittest.TestCase):
         # Asset that check_access has been called
         actions.plugins.toolkit.chec_access(actions.constants.ACQUISITIONS_LIST, context, data_dict)
 
-        # Check that the database has been initialized properly
-        actions.db.init_db.assert_called_once_with(context['model'])
-
         # Set expected user
         expected_user = data_dict['user'] if data_dict is not None and 'user' in data_dict else context['user']
 
         # Query called correctry
-        actions.db.AllowedUser.get.assert_called_once_with(user_name=expected_user)
+        actions.db.AllowedUser.iter_by_user.assert_called_once_with(expected_user)
 
         # Assert that the package_show has been called properly
         self.assertEquals(len(pkgs_ids), package_show.call_count)
@@ -360,5 +580,382 @@ class ActionsTest(unittest.TestCase):
                     context_update = context.copy()
                     context_update['ignore_auth'] = True
                     context_update['user'] = creator_user['name']
+                    context_update['defer_commit'] = True
 
                     package_update.assert_any_call(context_update, {'id': dataset_id, 'allowed_users': expected_allowed_users, 'private': True, 'creator_user_id': creator_user['id']})
+
+    @parameterized.expand([
+        # Authorized users never see the message
+        (True,  True,  'google.es', '/dataset/testds', False),
+        # Buy URL shown
+        (False, True,  'google.es', '/dataset/testds', True),
+        # Buy URL not shown
+        (False, True,  'google.es', '/',               False),
+        (False, True,  '',          '/dataset/testds', False),
+        (False, True,  None,        '/dataset/testds', False),
+        (False, False, 'google.es', '/dataset/testds', False),
+    ])
+    def test_package_show(self, authorized, for_view, acquire_url, request_path, flash_expected):
+        actions.plugins.toolkit.NotAuthorized = self._plugins.toolkit.NotAuthorized
+        actions.request.path = request_path
+
+        package = MagicMock()
+        package.extras = {}
+        if acquire_url is not None:
+            package.extras['acquire_url'] = acquire_url
+
+        context = {'package': package, 'for_view': for_view}
+        data_dict = {'id': 'package_id'}
+
+        up_func = MagicMock()
+        if not authorized:
+            up_func.side_effect = actions.plugins.toolkit.NotAuthorized()
+
+        if authorized:
+            self.assertEquals(up_func.return_value, actions.package_show(up_func, context, data_dict))
+        else:
+            with self.assertRaises(actions.plugins.toolkit.NotAuthorized):
+                actions.package_show(up_func, context, data_dict)
+
+        up_func.assert_called_once_with(context, data_dict)
+
+        if flash_expected:
+            actions.helpers.flash_notice.assert_called_once()
+        else:
+            self.assertEquals(0, actions.helpers.flash_notice.call_count)
+
+    def _configure_bundles(self, bundles, packages):
+        actions.plugins.toolkit.ObjectNotFound = self._plugins.toolkit.ObjectNotFound
+        actions.plugins.toolkit.ValidationError = self._plugins.toolkit.ValidationError
+        actions.db.Bundle.get.side_effect = lambda id_or_name: next(
+            (bundle for bundle in bundles if id_or_name in (bundle.id, bundle.name)), None)
+        actions.db.Bundle.get_package_ids.return_value = ['pkg_id']
+        actions.model.Package.get.side_effect = lambda id_or_name: MagicMock(id=id_or_name + '_id') \
+            if id_or_name in packages else None
+
+    def _bundle(self, bundle_id, name, title=None):
+        bundle = MagicMock(id=bundle_id, title=title)
+        bundle.name = name
+        return bundle
+
+    def test_bundle_show(self):
+        self._configure_bundles([self._bundle('bundle_id', 'bundle', 'Bundle')], [])
+
+        result = actions.bundle_show({}, {'id': 'bundle'})
+
+        self.assertEquals({'id': 'bundle_id', 'name': 'bundle', 'title': 'Bundle', 'packages': ['pkg_id']}, result)
+        actions.plugins.toolkit.check_access.assert_called_once_with('bundle_show', {}, {'id': 'bundle'})
+        self.assertRaises(self._plugins.toolkit.ObjectNotFound, actions.bundle_show, {}, {'id': 'other'})
+
+    def test_bundle_create(self):
+        bundles = []
+        self._configure_bundles(bundles, ['pkg1', 'pkg2'])
+        actions.db.Bundle.create.side_effect = lambda name, title: bundles.append(self._bundle('new_id', name, title)) or 'new_id'
+        actions.db.Bundle.set_packages.return_value = (['pkg1_id', 'pkg2_id'], [])
+
+        data_dict = {'name': 'bundle', 'title': 'Bundle', 'packages': ['pkg1', 'pkg2']}
+        result = actions.bundle_create({}, data_dict)
+
+        self.assertEquals({'id': 'new_id', 'name': 'bundle', 'title': 'Bundle', 'packages': ['pkg_id']}, result)
+        actions.plugins.toolkit.check_access.assert_called_once_with('bundle_create', {}, data_dict)
+        actions.db.Bundle.create.assert_called_once_with('bundle', 'Bundle')
+        actions.db.Bundle.set_packages.assert_called_once_with('new_id', ['pkg1_id', 'pkg2_id'])
+        actions.model.Session.commit.assert_called_once_with()
+
+        # Datasets are reindexed so they get the label of the bundle
+        self.assertEquals([call('pkg1_id', defer_commit=True), call('pkg2_id', defer_commit=True)],
+                          actions.search.rebuild.call_args_list)
+        actions.search.commit.assert_called_once_with()
+
+    @parameterized.expand([
+        ({},                                         'name'),
+        ({'name': 'existing'},                       'name'),
+        ({'name': 'bundle', 'packages': ['other']},  'packages'),
+    ])
+    def test_bundle_create_invalid(self, data_dict, error_field):
+        self._configure_bundles([self._bundle('existing_id', 'existing')], ['pkg1'])
+
+        with self.assertRaises(self._plugins.toolkit.ValidationError) as cm:
+            actions.bundle_create({}, data_dict)
+
+        self.assertIn(error_field, cm.exception.error_dict)
+        self.assertEquals(0, actions.db.Bundle.create.call_count)
+        self.assertEquals(0, actions.model.Session.commit.call_count)
+
+    @parameterized.expand([
+        ({'id': 'bundle'},                                      {},                                     False),
+        ({'id': 'bundle', 'name': 'bundle', 'title': 'Title'},  {'title': 'Title'},                     False),
+        ({'id': 'bundle_id', 'name': 'new', 'title': None},     {'name': 'new', 'title': None},         False),
+        ({'id': 'bundle', 'packages': ['pkg1']},                {},                                     True),
+    ])
+    def test_bundle_update(self, data_dict, expected_values, update_packages):
+        self._configure_bundles([self._bundle('bundle_id', 'bundle')], ['pkg1'])
+        actions.db.Bundle.set_packages.return_value = (['pkg1_id'], ['pkg2_id'])
+
+        actions.bundle_update({}, data_dict)
+
+        if expected_values:
+            actions.db.Bundle.update.assert_called_once_with('bundle_id', **expected_values)
+        else:
+            self.assertEquals(0, actions.db.Bundle.update.call_count)
+
+        if update_packages:
+            actions.db.Bundle.set_packages.assert_called_once_with('bundle_id', ['pkg1_id'])
+            self.assertEquals([call('pkg1_id', defer_commit=True), call('pkg2_id', defer_commit=True)],
+                              actions.search.rebuild.call_args_list)
+        else:
+            self.assertEquals(0, actions.db.Bundle.set_packages.call_count)
+            self.assertEquals(0, actions.search.rebuild.call_count)
+
+        actions.model.Session.commit.assert_called_once_with()
+
+    def test_bundle_delete(self):
+        self._configure_bundles([self._bundle('bundle_id', 'bundle')], [])
+        actions.db.Bundle.delete.return_value = ['pkg1_id']
+
+        self.assertIsNone(actions.bundle_delete({}, {'id': 'bundle'}))
+
+        actions.db.Bundle.delete.assert_called_once_with('bundle_id')
+        actions.model.Session.commit.assert_called_once_with()
+        actions.search.rebuild.assert_called_once_with('pkg1_id', defer_commit=True)
+        self.assertRaises(self._plugins.toolkit.ObjectNotFound, actions.bundle_delete, {}, {'id': 'other'})
+
+    def _configure_patch(self, private=True, existing=(), expired=()):
+        actions.plugins.toolkit.ObjectNotFound = self._plugins.toolkit.ObjectNotFound
+        actions.plugins.toolkit.ValidationError = self._plugins.toolkit.ValidationError
+        actions.plugins.toolkit.Invalid = InvalidError
+        actions.plugins.toolkit.get_validator.return_value = _name_validator
+        actions.model.Package.get.side_effect = lambda id_or_name: MagicMock(id='package_id', private=private) \
+            if id_or_name in ('package_id', 'package') else None
+
+        # Only the grants that do not exist are inserted
+        actions.db.AllowedUser.bulk_grant.side_effect = lambda grants, expires_at: sorted(
+            grant for grant in grants if grant[1] not in existing and grant[1] not in expired)
+        actions.db.AllowedUser.get_existing.side_effect = lambda grants, include_expired=True: set(
+            grant for grant in grants if grant[1] in existing or (include_expired and grant[1] in expired))
+
+    @parameterized.expand([
+        # Users that were not allowed are added
+        (['a', 'b'],  [],          None,                   [],           {'a': 'added', 'b': 'added'}),
+        # Upsert: users that were already allowed get the new expiry date
+        (['a', 'b'],  [],          '2018-12-31',           ['a'],        {'a': 'updated', 'b': 'added'}),
+        (['a'],       ['b', 'c'],  None,                   ['a', 'b'],   {'a': 'updated', 'b': 'removed',
+                                                                          'c': 'not_allowed'}),
+        ([],          ['a'],       None,                   [],           {'a': 'not_allowed'}),
+        ([],          [],          None,                   [],           {}),
+    ])
+    def test_allowed_users_patch(self, add, remove, expires_at, existing, expected_outcomes):
+        self._configure_patch(existing=existing)
+        actions.settings.get.return_value.incremental_index = False
+        expected_expires_at = actions.conv_val.parse_expires_at(expires_at)
+
+        data_dict = {'id': 'package', 'add': add, 'remove': remove, 'expires_at': expires_at}
+        result = actions.allowed_users_patch({}, data_dict)
+
+        self.assertEquals({'id': 'package_id', 'users': expected_outcomes}, result)
+        actions.plugins.toolkit.check_access.assert_called_once_with('allowed_users_patch', {}, data_dict)
+
+        # Only the given users are read and written, while the lock of the dataset is held
+        actions.db.lock_package.assert_called_once_with('package_id')
+        actions.db.AllowedUser.bulk_grant.assert_called_once_with([('package_id', user) for user in add],
+                                                                  expected_expires_at)
+        actions.db.AllowedUser.bulk_revoke.assert_called_once_with([('package_id', user) for user in remove])
+        self.assertEquals([call('package_id', user, expected_expires_at) for user in add if user in existing],
+                          actions.db.AllowedUser.set_expiry.call_args_list)
+        self.assertEquals(0, actions.db.AllowedUser.get_users_by_package.call_count)
+        actions.model.Session.commit.assert_called_once_with()
+        actions.cache.forget_package.assert_called_once_with('package_id')
+        actions.cache.forget_acquired.assert_called_once_with(add + remove)
+
+        # The dataset is only reindexed (by the plugin) when the list of allowed users changes
+        reindex_package = actions.plugins.get_plugin.return_value.reindex_package
+        if 'added' in expected_outcomes.values() or 'removed' in expected_outcomes.values():
+            actions.plugins.get_plugin.assert_called_once_with('privatedatasets')
+            reindex_package.assert_called_once_with('package_id')
+        else:
+            self.assertEquals(0, reindex_package.call_count)
+        self.assertEquals(0, actions.search.rebuild.call_count)
+
+    def test_allowed_users_patch_incremental_index(self):
+        self._configure_patch(existing=['b'])
+        actions.settings.get.return_value.incremental_index = True
+
+        actions.db.get_user_ids.return_value = {'a': 'id-a', 'b': 'id-b'}
+
+        actions.allowed_users_patch({}, {'id': 'package_id', 'add': ['a'], 'remove': ['b', 'c']})
+
+        # Users may have been granted before signing up, so both of their labels are removed
+        labels_indexer = actions.indexer.PermissionLabelsIndexer.return_value
+        labels_indexer.add_labels.assert_called_once_with('package_id', ['allowed-id-a'])
+        labels_indexer.remove_labels.assert_called_once_with('package_id', ['allowed-id-b', 'allowed_name-b'])
+        self.assertEquals(0, actions.search.rebuild.call_count)
+
+    def test_allowed_users_patch_renews_expired_grants(self):
+        self._configure_patch(existing=['b'], expired=['a'])
+        actions.settings.get.return_value.incremental_index = True
+
+        actions.db.get_user_ids.return_value = {}
+
+        result = actions.allowed_users_patch({}, {'id': 'package_id', 'add': ['a', 'b']})
+
+        # The expired grant is renewed, so the user gets its label again
+        self.assertEquals({'a': 'added', 'b': 'updated'}, result['users'])
+        self.assertEquals([call('package_id', 'a', None), call('package_id', 'b', None)],
+                          actions.db.AllowedUser.set_expiry.call_args_list)
+        actions.bloom.add_grants.assert_called_once_with('package_id', ['a'])
+        labels_indexer = actions.indexer.PermissionLabelsIndexer.return_value
+        labels_indexer.add_labels.assert_called_once_with('package_id', ['allowed_name-a'])
+        self.assertEquals(0, labels_indexer.remove_labels.call_count)
+
+    @parameterized.expand([
+        ({'id': 'other', 'add': ['a']},                   True,  'ObjectNotFound'),
+        ({'id': 'package', 'add': ['a']},                 False, 'ValidationError'),
+        ({'id': 'package', 'add': 'a'},                   True,  'ValidationError'),
+        ({'id': 'package', 'add': ['a', 'in valid']},     True,  'ValidationError'),
+        ({'id': 'package', 'add': ['a'], 'remove': ['a']}, True, 'ValidationError'),
+    ])
+    def test_allowed_users_patch_invalid(self, data_dict, private, exception):
+        self._configure_patch(private=private)
+
+        self.assertRaises(getattr(self._plugins.toolkit, exception), actions.allowed_users_patch, {}, data_dict)
+
+        self.assertEquals(0, actions.db.AllowedUser.bulk_grant.call_count)
+        self.assertEquals(0, actions.model.Session.commit.call_count)
+
+
+@postgresql.skip_unless_configured
+class ConcurrentNotificationsTest(unittest.TestCase):
+    '''
+    Grants and revokes users from several threads through the notifications path:
+    each dataset is read with package_show and its whole list of allowed users is
+    written back with package_update, whose after_update stores the changes.
+    '''
+
+    THREADS = 8
+    NOTIFICATIONS = 15
+    PACKAGES = ['pkg%d' % i for i in range(4)]
+
+    def setUp(self):
+        self.schema = postgresql.TemporarySchema()
+        self.engine = self.schema.engine
+
+        self._db_model = db.model
+        db.model = MagicMock()
+        db.model.Session = orm.scoped_session(orm.sessionmaker(bind=self.engine))
+        db.model.user_table = self._db_model.user_table
+        db.model.package_table = self._db_model.package_table
+
+        for table in (db.model.user_table, db.model.package_table, db.package_allowed_users_table):
+            table.create(bind=self.engine)
+
+        # Each thread grants and revokes its own users, so the final grants are known
+        self.users = [['user%d-%d' % (thread, i) for i in range(3)] for thread in range(self.THREADS)]
+        db.model.Session.execute(db.model.user_table.insert(), [
+            {'id': 'id-%s' % user_name, 'name': user_name} for users in self.users for user_name in users])
+        db.model.Session.execute(db.model.package_table.insert(), [
+            {'id': package_id, 'name': package_id} for package_id in self.PACKAGES])
+        db.model.Session.commit()
+        db.model.Session.remove()
+
+        self._actions_plugins = actions.plugins
+        actions.plugins = MagicMock()
+        actions.plugins.toolkit.ObjectNotFound = self._actions_plugins.toolkit.ObjectNotFound
+        actions.plugins.toolkit.ValidationError = self._actions_plugins.toolkit.ValidationError
+        actions.plugins.toolkit.get_action.side_effect = lambda name: {
+            'package_show': self._package_show, 'package_update': self._package_update,
+            'user_show': lambda context, data_dict: {'name': 'creator'}}[name]
+
+        self._actions_model = actions.model
+        actions.model = db.model
+        self._actions_cache = actions.cache
+        actions.cache = MagicMock()
+
+        self._plugin_mocks = dict((name, getattr(plugin, name)) for name in ('bloom', 'cache', 'search', 'settings'))
+        for name in self._plugin_mocks:
+            setattr(plugin, name, MagicMock())
+        plugin.settings.get.return_value.incremental_index = True
+
+        self.privateDatasets = plugin.PrivateDatasets()
+        self.privateDatasets.labels_indexer = MagicMock()
+
+    def tearDown(self):
+        db.model.Session.remove()
+        db.model = self._db_model
+        actions.plugins = self._actions_plugins
+        actions.model = self._actions_model
+        actions.cache = self._actions_cache
+        for name, value in self._plugin_mocks.items():
+            setattr(plugin, name, value)
+        self.schema.drop()
+
+    def _package_show(self, context, data_dict):
+        # The allowed users are loaded as the show schema does
+        return {'id': data_dict['id'], 'private': True, 'creator_user_id': 'id-creator',
+                constants.ALLOWED_USERS: list(db.AllowedUser.iter_by_package(data_dict['id']))}
+
+    def _package_update(self, context, data_dict):
+        context['session'] = db.model.Session
+        context['model'] = db.model
+        return self.privateDatasets.after_update(context, data_dict)
+
+    def _notify(self, rnd, users):
+        # Returns the grants of the given users once every notification has been applied
+        granted = set()
+        for _ in range(self.NOTIFICATIONS):
+            method = rnd.choice(['grant', 'grant', 'revoke'])
+            user_name = rnd.choice(users)
+            datasets = rnd.sample(self.PACKAGES, rnd.randint(1, len(self.PACKAGES)))
+
+            warns = []
+            try:
+                actions._update_datasets({'method': method}, {'users_datasets': [
+                    {'user': user_name, 'datasets': datasets}]}, warns)
+                db.model.Session.commit()
+            except Exception:
+                db.model.Session.rollback()
+                raise
+            self.assertEquals([], warns)
+
+            for package_id in datasets:
+                if method == 'grant':
+                    granted.add((package_id, user_name))
+                else:
+                    granted.discard((package_id, user_name))
+        return granted
+
+    def test_no_grant_is_lost(self):
+        results = []
+        errors = []
+
+        def _run(thread):
+            try:
+                results.append(self._notify(random.Random(thread), self.users[thread]))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                db.model.Session.remove()
+
+        threads = [threading.Thread(target=_run, args=(thread,)) for thread in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals([], errors)
+        expected = sorted(grant for granted in results for grant in granted)
+        table = db.package_allowed_users_table
+        stored = db.model.Session.execute(sa.select([table.c.package_id, table.c.user_name]))
+        self.assertEquals(expected, sorted(tuple(row) for row in stored))
+
+
+class InvalidError(Exception):
+
+    def __init__(self, error):
+        super(InvalidError, self).__init__(error)
+        self.error = error
+
+
+def _name_validator(value, context):
+    if ' ' in value:
+        raise InvalidError('Must be purely lowercase alphanumeric (ascii) characters and these symbols: -_')
+    return value
@@ -31,28 +31,24 @@ class AuthTest(unittest.TestCase):
         self._logic_auth = auth.logic_auth
         auth.logic_auth = MagicMock()
 
-        self._request = auth.request
-        auth.request = MagicMock()
-
-        self._helpers = auth.helpers
-        auth.helpers = MagicMock()
-
-        self._authz = auth.authz
-        auth.authz = MagicMock()
-
         self._tk = auth.tk
         auth.tk = MagicMock()
 
-        self._db = auth.db
-        auth.db = MagicMock()
+        self._cache = auth.cache
+        auth.cache = MagicMock()
+
+        self._package_update = auth.package_update
+
+        self._settings = auth.settings
+        auth.settings = MagicMock()
+        auth.settings.get.return_value.notifier_users = frozenset(['store'])
+        auth.cache.PackageMeta = self._cache.PackageMeta
 
     def tearDown(self):
         auth.logic_auth = self._logic_auth
-        auth.request = self._request
-        auth.helpers = self._helpers
-        auth.authz = self._authz
         auth.tk = self._tk
-        auth.db = self._db
+        auth.cache = self._cache
+        auth.settings = self._settings
 
         if hasattr(self, '_package_show'):
             auth.package_show = self._package_show
@@ -64,67 +60,45 @@ class AuthTest(unittest.TestCase):
 
     @parameterized.expand([
         # Anonymous user (public)
-        (None, None, None,   False, 'active', None,     None,  None,  None,        None,              True),
+        (None, None, None,   False, 'active', None,     None,  None,  True),
         # Anonymous user (private)
-        (None, None, None,   True,  'active', None,     None,  None,  None,        '/',               False),
-        (None, None, '',     True,  'active', None,     None,  '',    None,        '/',               False),
-        # Anonymous user (private). Buy URL not shown
-        (None, None, None,   True,  'active', None,     None,  None,  'google.es', '/',               False),
-        # Anonymous user (private). Buy URL show
-        (None, None, None,   True,  'active', None,     None,  None,  'google.es', '/dataset/testds', False),
+        (None, None, None,   True,  'active', None,     None,  None,  False),
+        (None, None, '',     True,  'active', None,     None,  '',    False),
         # The creator can always see the dataset
-        (1,    1,    None,   False, 'active', None,     None,  None,  None,        None,              True),
-        (1,    1,    None,   True,  'active', 'conwet', None,  None,  None,        None,              True),
-        (1,    1,    None,   True,  'active', None,     None,  None,  None,        None,              True),
-        (1,    1,    None,   False, 'draft',  None,     None,  None,  None,        None,              True),
+        (1,    1,    None,   False, 'active', None,     None,  None,  True),
+        (1,    1,    None,   True,  'active', 'conwet', None,  None,  True),
+        (1,    1,    None,   True,  'active', None,     None,  None,  True),
+        (1,    1,    None,   False, 'draft',  None,     None,  None,  True),
         # Other user (no organizations)
-        (1,    2,    'test', False, 'active', None,     None,  None,  None,        None,              True),
-        (1,    2,    'test', True,  'active', None,     None,  None,  'google.es', '/',               False),  # Buy MSG not shown
-        (1,    2,    'test', True,  'active', None,     None,  None,  None,        '/dataset/testds', False),  # Buy MSG not shown
-        (1,    2,    'test', True,  'active', None,     None,  None,  'google.es', '/dataset/testds', False),  # Buy MSG shown
-        (1,    2,    'test', False, 'draft',  None,     None,  None,  None,        None, False),
+        (1,    2,    'test', False, 'active', None,     None,  None,  True),
+        (1,    2,    'test', True,  'active', None,     None,  None,  False),
+        (1,    2,    'test', False, 'draft',  None,     None,  None,  False),
         # Other user but authorized in the list of authorized users
-        (1,    2,    'test', True,  'active', None,     None,  True,  None,        None,              True),
+        (1,    2,    'test', True,  'active', None,     None,  True,  True),
         # Other user and not authorized in the list of authorized users
-        (1,    2,    'test', True,  'active', None,     None,  False, 'google.es', '/',               False),
-        (1,    2,    'test', True,  'active', None,     None,  False, 'google.es', '/dataset/testds', False),
+        (1,    2,    'test', True,  'active', None,     None,  False, False),
         # Other user with organizations
-        (1,    2,    'test', False, 'active', 'conwet', False, None,  None,        None,              True),
-        (1,    2,    'test', True,  'active', 'conwet', False, None,  None,        None,              False),
-        (1,    2,    'test', True,  'active', 'conwet', True,  None,  None,        None,              True),
-        (1,    2,    'test', True,  'draft',  'conwet', True,  None,  None,        None,              False),
+        (1,    2,    'test', False, 'active', 'conwet', False, None,  True),
+        (1,    2,    'test', True,  'active', 'conwet', False, None,  False),
+        (1,    2,    'test', True,  'active', 'conwet', True,  None,  True),
+        (1,    2,    'test', True,  'draft',  'conwet', True,  None,  False),
         # Other user with organizations (user is not in the organization)
-        (1,    2,    'test', True,  'active', 'conwet', False, True,  None,        None,              True),
-        (1,    2,    'test', True,  'active', 'conwet', False, False, None,        None,              False),
-        (1,    2,    'test', True,  'active', 'conwet', False, False, 'google.es', '/dataset/testds', False),
-        (1,    2,    'test', True,  'active', 'conwet', False, False, 'google.es', '/',               False)    ])
+        (1,    2,    'test', True,  'active', 'conwet', False, True,  True),
+        (1,    2,    'test', True,  'active', 'conwet', False, False, False),
+    ])
     def test_auth_package_show(self, creator_user_id, user_obj_id, user, private, state, owner_org,
-                               owner_member, db_auth, acquire_url, request_path, authorized):
+                               owner_member, db_auth, authorized):
 
         # Configure the mocks
-        returned_package = MagicMock()
-        returned_package.creator_user_id = creator_user_id
-        returned_package.private = private
-        returned_package.state = state
-        returned_package.owner_org = owner_org
-        returned_package.extras = {}
-
-        # Configure the database
-        db_response = []
-        if db_auth is True:
-            out = auth.db.AllowedUser()
-            out.package_id = 'package_id'
-            out.user_name = user
-            db_response.append(out)
+        returned_package = auth.cache.PackageMeta('package_id', private, state, owner_org, creator_user_id)
 
-        auth.db.AllowedUser.get = MagicMock(return_value=db_response)
+        # Configure the list of allowed users
+        auth.cache.is_granted.return_value = db_auth is True
+        auth.cache.has_group_grant.return_value = False
+        auth.cache.has_scoped_grant.return_value = False
 
-        if acquire_url:
-            returned_package.extras['acquire_url'] = acquire_url
-
-        auth.logic_auth.get_package_object = MagicMock(return_value=returned_package)
-        auth.authz.has_user_permission_for_group_or_org = MagicMock(return_value=owner_member)
-        auth.request.path = request_path
+        auth.cache.get_package_meta.return_value = returned_package
+        auth.cache.has_user_permission_for_group_or_org.return_value = owner_member
 
         # Prepare the context
         context = {'model': MagicMock()}
@@ -135,34 +109,97 @@ class AuthTest(unittest.TestCase):
             context['auth_user_obj'].id = user_obj_id
 
         # Function to be tested
-        result = auth.package_show(context, {})
+        result = auth.package_show(context, {'id': 'package_id'})
 
         # Check the result
         self.assertEquals(authorized, result['success'])
 
+        # Package metadata is retrieved from the cache
+        auth.cache.get_package_meta.assert_called_once_with('package_id')
+        self.assertEquals(0, auth.logic_auth.get_package_object.call_count)
+
         # Premissions for organization are checked when the dataset is private, it belongs to an organization
         # and when the dataset has not been created by the user who is asking for it
         if private and owner_org and state == 'active' and creator_user_id != user_obj_id:
-            auth.authz.has_user_permission_for_group_or_org.assert_called_once_with(owner_org, user, 'read')
+            auth.cache.has_user_permission_for_group_or_org.assert_called_once_with(owner_org, user, 'read')
         else:
-            self.assertEquals(0, auth.authz.has_user_permission_for_group_or_org.call_count)
+            self.assertEquals(0, auth.cache.has_user_permission_for_group_or_org.call_count)
 
-        # The databse is only initialized when:
+        # The list of allowed users is only checked when:
         # * the dataset is private AND
         # * the dataset is active AND
         # * the dataset has no organization OR the user does not belong to that organization AND
-        # * the dataset has not been created by the user who is asking for it OR the user is not specified
-        if private and state == 'active' and (not owner_org or not owner_member) and (creator_user_id != user_obj_id or user_obj_id is None):
-            # Check that the database has been initialized properly
-            auth.db.init_db.assert_called_once_with(context['model'])
+        # * the dataset has not been created by the user who is asking for it OR the user is not specified AND
+        # * the user is not anonymous
+        if private and state == 'active' and (not owner_org or not owner_member) and (creator_user_id != user_obj_id or user_obj_id is None) and user:
+            auth.cache.is_granted.assert_called_once_with('package_id', user)
         else:
-            self.assertEquals(0, auth.db.init_db.call_count)
+            self.assertEquals(0, auth.cache.is_granted.call_count)
 
-        # Conditions to buy a dataset; It should be private, active and should not belong to any organization
-        if not authorized and state == 'active' and request_path and request_path.startswith('/dataset/') and acquire_url:
-            auth.helpers.flash_notice.assert_called_once()
+    @parameterized.expand([
+        ('test', False, True,  True),
+        ('test', False, False, False),
+        # Scoped grants are not checked when the dataset has been granted
+        ('test', True,  False, True),
+        # Anonymous users cannot be granted
+        (None,   False, True,  False),
+    ])
+    def test_auth_package_show_scoped_grant(self, user, granted, scoped_granted, authorized):
+        package = auth.cache.PackageMeta('package_id', True, 'active', 'conwet', 'creator')
+        auth.cache.get_package_meta.return_value = package
+        auth.cache.has_user_permission_for_group_or_org.return_value = False
+        auth.cache.is_granted.return_value = granted
+        auth.cache.has_group_grant.return_value = False
+        auth.cache.has_scoped_grant.return_value = scoped_granted
+
+        context = {'model': MagicMock(), 'user': user}
+        self.assertEquals(authorized, auth.package_show(context, {'id': 'package_id'})['success'])
+
+        if user and not granted:
+            auth.cache.has_scoped_grant.assert_called_once_with(package, user)
         else:
-            self.assertEquals(0, auth.helpers.flash_notice.call_count)
+            self.assertEquals(0, auth.cache.has_scoped_grant.call_count)
+
+    @parameterized.expand([
+        ('test', False, True,  True),
+        ('test', False, False, False),
+        # Groups are not checked when the user has been granted
+        ('test', True,  False, True),
+        # Anonymous users do not belong to any group
+        (None,   False, True,  False),
+    ])
+    def test_auth_package_show_group_grant(self, user, granted, group_granted, authorized):
+        package = auth.cache.PackageMeta('package_id', True, 'active', None, 'creator')
+        auth.cache.get_package_meta.return_value = package
+        auth.cache.is_granted.return_value = granted
+        auth.cache.has_group_grant.return_value = group_granted
+        auth.cache.has_scoped_grant.return_value = False
+
+        context = {'model': MagicMock(), 'user': user}
+        self.assertEquals(authorized, auth.package_show(context, {'id': 'package_id'})['success'])
+
+        if user and not granted:
+            auth.cache.has_group_grant.assert_called_once_with('package_id', user)
+        else:
+            self.assertEquals(0, auth.cache.has_group_grant.call_count)
+
+    def test_auth_package_show_package_in_context(self):
+        package = MagicMock()
+        package.id = 'package_id'
+        package.private = False
+        package.state = 'active'
+
+        context = {'model': MagicMock(), 'package': package}
+        self.assertTrue(auth.package_show(context, {'id': 'package_id'})['success'])
+
+        # The package stored by the package_show action is used
+        self.assertEquals(0, auth.cache.get_package_meta.call_count)
+
+    def test_auth_package_show_not_found(self):
+        auth.tk.ObjectNotFound = self._tk.ObjectNotFound
+        auth.cache.get_package_meta.return_value = None
+
+        self.assertRaises(self._tk.ObjectNotFound, auth.package_show, {'model': MagicMock()}, {'id': 'package_id'})
 
     @parameterized.expand([
         (None, None, None,   None,     None,  False),   # Anonymous user
@@ -179,7 +216,7 @@ class AuthTest(unittest.TestCase):
         returned_package.owner_org = owner_org
 
         auth.logic_auth.get_package_object = MagicMock(return_value=returned_package)
-        auth.authz.has_user_permission_for_group_or_org = MagicMock(return_value=owner_member)
+        auth.cache.has_user_permission_for_group_or_org.return_value = owner_member
 
         # Prepare the context
         context = {}
@@ -198,9 +235,9 @@ class AuthTest(unittest.TestCase):
         # Permissions for organization are checked when the user asking to update the dataset is not the creator
         # and when the dataset has organization
         if creator_user_id != user_obj_id and owner_org:
-            auth.authz.has_user_permission_for_group_or_org.assert_called_once_with(owner_org, user, 'update_dataset')
+            auth.cache.has_user_permission_for_group_or_org.assert_called_once_with(owner_org, user, 'update_dataset')
         else:
-            self.assertEquals(0, auth.authz.has_user_permission_for_group_or_org.call_count)
+            self.assertEquals(0, auth.cache.has_user_permission_for_group_or_org.call_count)
 
     @parameterized.expand([
         (True,  True),
@@ -251,6 +288,17 @@ class AuthTest(unittest.TestCase):
     def test_package_acquired(self):
         self.assertTrue(auth.package_acquired({}, {})['success'])
 
+    @parameterized.expand([
+        ({'user': 'store'},  True),
+        ({'user': 'user_1'}, False),
+        ({'user': None},     False),
+        ({},                 False),
+    ])
+    def test_scoped_grants(self, context, expected_result):
+        # Only the notifier users (and sysadmins, who skip the auth functions) can change scoped grants
+        self.assertEquals(expected_result, auth.scoped_grants(context, {})['success'])
+        self.assertFalse(getattr(auth.scoped_grants, 'auth_allow_anonymous_access', False))
+
     def test_package_deleted(self):
         self.assertTrue(auth.revoke_access({},{})['success'])
 
@@ -261,3 +309,16 @@ class AuthTest(unittest.TestCase):
     def test_acquisitions_list(self, context, data_dict, expected_result):
         self.assertEquals(expected_result, auth.acquisitions_list(context, data_dict)['success'])
 
+
+    def test_manage_bundles(self):
+        # Only sysadmins, who skip the auth functions, can manage bundles
+        self.assertFalse(auth.manage_bundles({'user': 'user_1'}, {})['success'])
+
+    def test_allowed_users_patch(self):
+        # The same users that can update the dataset can change its allowed users
+        auth.package_update = MagicMock(return_value={'success': True})
+        try:
+            self.assertEquals({'success': True}, auth.allowed_users_patch({'user': 'user_1'}, {'id': 'package_id'}))
+            auth.package_update.assert_called_once_with({'user': 'user_1'}, {'id': 'package_id'})
+        finally:
+            auth.package_update = self._package_update
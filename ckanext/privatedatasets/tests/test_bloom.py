@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+import unittest
+
+from mock import MagicMock
+
+import ckanext.privatedatasets.bloom as bloom
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_no_false_negatives(self):
+        bloom_filter = bloom.BloomFilter(1000, 0.01)
+        keys = ['pkg%d\nuser%d' % (i % 37, i) for i in range(1000)]
+        for key in keys:
+            bloom_filter.add(key)
+
+        for key in keys:
+            self.assertIn(key, bloom_filter)
+
+    def test_error_rate(self):
+        bloom_filter = bloom.BloomFilter(5000, 0.01)
+        for i in range(5000):
+            bloom_filter.add('pkg\nuser%d' % i)
+
+        false_positives = sum(1 for i in range(20000) if 'pkg\nother%d' % i in bloom_filter)
+        self.assertTrue(false_positives < 20000 * 0.02)
+        self.assertAlmostEqual(0.01, bloom_filter.error_rate, 2)
+
+    def test_size(self):
+        # About 9.6 bits and 7 hashes per key are needed for a 1% error rate
+        bloom_filter = bloom.BloomFilter(10000, 0.01)
+        self.assertEquals(11982, len(bloom_filter))
+        self.assertEquals(7, bloom_filter.hashes)
+
+    def test_max_bytes(self):
+        bloom_filter = bloom.BloomFilter(10000, 0.01, max_bytes=4096)
+
+        # The filter never exceeds its memory budget, but its error rate is higher
+        self.assertEquals(4096, len(bloom_filter))
+        self.assertTrue(bloom_filter.error_rate > 0.01)
+
+        bloom_filter.add('pkg\nuser')
+        self.assertIn('pkg\nuser', bloom_filter)
+
+
+class GrantsFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self._db = bloom.db
+        bloom.db = MagicMock()
+        bloom.db.AllowedUser.count.return_value = 2
+        bloom.db.AllowedUser.iter_grants.side_effect = lambda: iter([('pkg1', 'a'), ('pkg2', 'b')])
+
+        self._model = bloom.model
+        bloom.model = MagicMock()
+
+        self.grants_filter = bloom.GrantsFilter(refresh=300)
+        self.grants_filter._start_rebuild = MagicMock()
+
+    def tearDown(self):
+        bloom.db = self._db
+        bloom.model = self._model
+
+    def test_not_built(self):
+        # Every user might have been granted until the filter is built
+        self.assertTrue(self.grants_filter.might_be_granted('pkg1', 'b'))
+        self.grants_filter._start_rebuild.assert_called_once_with()
+
+    def test_might_be_granted(self):
+        self.grants_filter.rebuild()
+
+        self.assertTrue(self.grants_filter.might_be_granted('pkg1', 'a'))
+        self.assertTrue(self.grants_filter.might_be_granted('pkg2', 'b'))
+        self.assertFalse(self.grants_filter.might_be_granted('pkg1', 'b'))
+        self.assertFalse(self.grants_filter.might_be_granted('pkg3', 'a'))
+        self.assertEquals(0, self.grants_filter._start_rebuild.call_count)
+
+    def test_expired(self):
+        self.grants_filter.rebuild()
+        self.grants_filter._built_at = time.time() - 300
+
+        # Old filters are not used while they are built again
+        self.assertTrue(self.grants_filter.might_be_granted('pkg1', 'b'))
+        self.grants_filter._start_rebuild.assert_called_once_with()
+
+    def test_add(self):
+        self.grants_filter.rebuild()
+        self.grants_filter.add('pkg1', 'b')
+
+        self.assertTrue(self.grants_filter.might_be_granted('pkg1', 'b'))
+
+    def test_add_while_building(self):
+        # The grant is stored after the filter has read the grants, but before it is used
+        def _iter_grants():
+            yield 'pkg1', 'a'
+            self.grants_filter.add('pkg3', 'c')
+
+        bloom.db.AllowedUser.iter_grants.side_effect = _iter_grants
+        self.grants_filter.rebuild()
+
+        self.assertTrue(self.grants_filter.might_be_granted('pkg3', 'c'))
+        self.assertIsNone(self.grants_filter._added)
+
+    def test_rebuild_later(self):
+        grants_filter = bloom.GrantsFilter(refresh=300)
+
+        self.assertTrue(grants_filter.might_be_granted('pkg1', 'b'))
+        for _ in range(100):
+            if grants_filter._filter is not None:
+                break
+            time.sleep(0.05)
+
+        # The filter is built by a background thread, which removes its session
+        self.assertFalse(grants_filter.might_be_granted('pkg1', 'b'))
+        self.assertTrue(grants_filter.might_be_granted('pkg1', 'a'))
+        bloom.model.Session.remove.assert_called_once_with()
+
+    def test_rebuild_later_error(self):
+        grants_filter = bloom.GrantsFilter(refresh=300)
+        bloom.db.AllowedUser.iter_grants.side_effect = Exception('Database error')
+
+        grants_filter._added = []
+        grants_filter._rebuild_later()
+
+        # It is built again the next time it is used
+        self.assertIsNone(grants_filter._filter)
+        self.assertIsNone(grants_filter._added)
+        bloom.model.Session.remove.assert_called_once_with()
+
+
+class GrantsFilterSettingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self._settings = bloom.settings
+        bloom.settings = MagicMock()
+        bloom._grants_filter = None
+
+    def tearDown(self):
+        bloom.settings = self._settings
+        bloom._grants_filter = None
+
+    def test_disabled(self):
+        bloom.settings.get.return_value.grants_filter_refresh = 0
+
+        self.assertIsNone(bloom.get_grants_filter())
+        self.assertTrue(bloom.might_be_granted('pkg1', 'a'))
+        bloom.add_grants('pkg1', ['a'])
+
+    def test_enabled(self):
+        config = bloom.settings.get.return_value
+        config.grants_filter_refresh = 300
+        config.grants_filter_error_rate = 0.001
+        config.grants_filter_max_memory = 4
+
+        grants_filter = bloom.get_grants_filter()
+        self.assertIs(grants_filter, bloom.get_grants_filter())
+        self.assertEquals((300, 0.001, 4), (grants_filter.refresh, grants_filter.error_rate, grants_filter.max_memory))
+
+        grants_filter.might_be_granted = MagicMock(return_value=False)
+        grants_filter.add = MagicMock()
+        self.assertFalse(bloom.might_be_granted('pkg1', 'a'))
+        bloom.add_grants('pkg1', ['a', 'b'])
+        self.assertEquals([(('pkg1', 'a'),), (('pkg1', 'b'),)], grants_filter.add.call_args_list)
@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import unittest
+
+from mock import MagicMock, patch
+from parameterized import parameterized
+import sqlalchemy as sa
+
+import ckanext.privatedatasets.cache as cache
+
+
+class FakeContext(object):
+    pass
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tk = cache.tk
+        cache.tk = MagicMock()
+        cache.tk.c = FakeContext()
+
+        self._model = cache.model
+        cache.model = MagicMock()
+
+        self._db = cache.db
+        cache.db = MagicMock()
+
+        self._bloom = cache.bloom
+        cache.bloom = MagicMock()
+        cache.bloom.might_be_granted.return_value = True
+
+        self._authz = cache.authz
+        cache.authz = MagicMock()
+        cache.authz.get_roles_with_permission.side_effect = lambda permission: {
+            'read': ['admin', 'editor', 'member'],
+            'update_dataset': ['admin', 'editor']
+        }[permission]
+        cache.authz.check_config_permission.return_value = ['admin']
+
+        self._settings = cache.settings
+        cache.settings = MagicMock()
+        cache.settings.get.return_value.acquired_cache_ttl = 0
+
+        self._acquired_packages = cache.acquired_packages
+        cache.acquired_packages = cache.LRUCache()
+
+        self._snapshot = cache.snapshot
+        cache.snapshot = MagicMock()
+        cache.snapshot.is_enabled.return_value = False
+
+    def tearDown(self):
+        cache.settings = self._settings
+        cache.snapshot = self._snapshot
+        cache.acquired_packages = self._acquired_packages
+        cache.tk = self._tk
+        cache.model = self._model
+        cache.authz = self._authz
+        cache.db = self._db
+        cache.bloom = self._bloom
+
+    def _configure_packages(self, rows, user=None):
+        # Packages and users are loaded with the same chain of calls
+        result = MagicMock()
+        result.__iter__.side_effect = lambda: iter(rows)
+        result.first.return_value = user
+        cache.model.Session.query.return_value.autoflush.return_value.filter.return_value = result
+        return cache.model.Session.query.return_value.autoflush.return_value.filter
+
+    def _configure_user(self, user, memberships):
+        query = cache.model.Session.query.return_value.autoflush.return_value
+        query.filter.return_value.first.return_value = user
+        query.join.return_value.filter.return_value = memberships
+
+    def test_memoize(self):
+        loader = MagicMock(return_value='value')
+
+        self.assertEquals('value', cache.memoize('namespace', 'key', loader))
+        self.assertEquals('value', cache.memoize('namespace', 'key', loader))
+        loader.assert_called_once_with()
+
+    def test_memoize_outside_request(self):
+        # Accessing c outside a request raises an exception
+        cache.tk.c = None
+        loader = MagicMock(return_value='value')
+
+        self.assertEquals('value', cache.memoize('namespace', 'key', loader))
+        self.assertEquals('value', cache.memoize('namespace', 'key', loader))
+        self.assertEquals(2, loader.call_count)
+
+    def test_forget_package(self):
+        meta = cache.PackageMeta('package_id', True, 'active', None, 'creator')
+        cache.memoize(cache.PACKAGES, 'package_name', lambda: meta)
+        cache.memoize(cache.PACKAGES, 'other', lambda: None)
+        cache.memoize(cache.GRANTS, ('package_id', 'user'), lambda: True)
+        cache.memoize(cache.GRANTS, ('other', 'user'), lambda: True)
+        cache.memoize(cache.BUNDLES, 'package_id', lambda: frozenset())
+        cache.memoize(cache.ALLOWED_GROUPS, 'package_id', lambda: frozenset())
+
+        cache.forget_package('package_id')
+
+        self.assertEquals({'other': None}, cache._request_cache()[cache.PACKAGES])
+        self.assertEquals({('other', 'user'): True}, cache._request_cache()[cache.GRANTS])
+        self.assertEquals({}, cache._request_cache()[cache.BUNDLES])
+        self.assertEquals({}, cache._request_cache()[cache.ALLOWED_GROUPS])
+
+    @parameterized.expand([
+        (False,),
+        (True,),
+    ])
+    def test_is_granted(self, granted):
+        cache.db.AllowedUser.is_granted.return_value = granted
+
+        self.assertEquals(granted, cache.is_granted('package_id', 'user'))
+        self.assertEquals(granted, cache.is_granted('package_id', 'user'))
+
+        cache.db.AllowedUser.is_granted.assert_called_once_with('package_id', 'user')
+
+    def test_is_granted_filtered(self):
+        cache.bloom.might_be_granted.return_value = False
+
+        # Users that have not been granted for sure are answered without querying the database
+        self.assertFalse(cache.is_granted('package_id', 'user'))
+        cache.bloom.might_be_granted.assert_called_once_with('package_id', 'user')
+        self.assertEquals(0, cache.db.AllowedUser.is_granted.call_count)
+
+    @parameterized.expand([
+        (False,),
+        (True,),
+    ])
+    def test_is_granted_snapshot(self, granted):
+        cache.snapshot.is_enabled.return_value = True
+        cache.snapshot.is_granted.return_value = granted
+
+        # The database is not queried when grants are read from a snapshot
+        self.assertEquals(granted, cache.is_granted('package_id', 'user'))
+        cache.snapshot.is_granted.assert_called_once_with('package_id', 'user')
+        self.assertEquals(0, cache.bloom.might_be_granted.call_count)
+        self.assertEquals(0, cache.db.AllowedUser.is_granted.call_count)
+
+    def test_prefetch_snapshot(self):
+        self._configure_packages([])
+        cache.snapshot.is_enabled.return_value = True
+        cache.snapshot.is_granted.side_effect = lambda package_id, user_name: package_id == 'pkg1'
+
+        cache.prefetch(['pkg1', 'pkg2'], 'user')
+
+        self.assertTrue(cache.is_granted('pkg1', 'user'))
+        self.assertFalse(cache.is_granted('pkg2', 'user'))
+        self.assertEquals(2, cache.snapshot.is_granted.call_count)
+        self.assertEquals(0, cache.db.AllowedUser.get_users_by_package.call_count)
+
+    def test_get_acquired_package_ids_snapshot(self):
+        cache.settings.get.return_value.acquired_cache_ttl = 60
+        cache.snapshot.is_enabled.return_value = True
+        cache.snapshot.is_granted.side_effect = lambda package_id, user_name: package_id == 'pkg1'
+        self._configure_packages([])
+
+        # Snapshots cannot list the packages of an user, so each package is checked
+        self.assertEquals(frozenset(['pkg1']), cache.get_acquired_package_ids(['pkg1', 'pkg2'], 'user'))
+        self.assertEquals(0, cache.db.AllowedUser.get_by_user.call_count)
+
+    def test_prefetch_filtered(self):
+        self._configure_packages([])
+        cache.bloom.might_be_granted.side_effect = lambda package_id, user_name: package_id == 'pkg1'
+        cache.db.AllowedUser.get_users_by_package.return_value = {}
+
+        cache.prefetch(['pkg1', 'pkg2'], 'user')
+
+        # Only the packages that might have been granted are queried
+        cache.db.AllowedUser.get_users_by_package.assert_called_once_with(['pkg1'], user_name='user')
+        self.assertFalse(cache.is_granted('pkg1', 'user'))
+        self.assertFalse(cache.is_granted('pkg2', 'user'))
+
+        # Nothing is queried when no package might have been granted
+        cache.bloom.might_be_granted.side_effect = None
+        cache.bloom.might_be_granted.return_value = False
+        cache.prefetch(['pkg3'], 'user')
+        self.assertEquals(1, cache.db.AllowedUser.get_users_by_package.call_count)
+        self.assertEquals(0, cache.db.AllowedUser.is_granted.call_count)
+
+    def _new_request(self):
+        cache.tk.c = FakeContext()
+
+    def test_get_acquired_packages(self):
+        cache.db.AllowedUser.get_by_user.return_value = [('pkg1', None), ('pkg2', None)]
+
+        self.assertEquals(frozenset(['pkg1', 'pkg2']), cache.get_acquired_packages('user'))
+        self.assertEquals(frozenset(['pkg1', 'pkg2']), cache.get_acquired_packages('user'))
+        cache.db.AllowedUser.get_by_user.assert_called_once_with('user')
+
+        # They are loaded again in each request when they are not kept in memory
+        self._new_request()
+        cache.get_acquired_packages('user')
+        self.assertEquals(2, cache.db.AllowedUser.get_by_user.call_count)
+        self.assertEquals(0, len(cache.acquired_packages))
+
+    def test_get_acquired_packages_kept_in_memory(self):
+        cache.settings.get.return_value.acquired_cache_ttl = 60
+        cache.db.AllowedUser.get_by_user.return_value = [('pkg1', None)]
+
+        self.assertEquals(frozenset(['pkg1']), cache.get_acquired_packages('user'))
+        self._new_request()
+        self.assertEquals(frozenset(['pkg1']), cache.get_acquired_packages('user'))
+        cache.db.AllowedUser.get_by_user.assert_called_once_with('user')
+
+        # They are loaded again when they change
+        cache.db.AllowedUser.get_by_user.return_value = [('pkg1', None), ('pkg2', None)]
+        cache.forget_acquired(['user'])
+        self.assertEquals(frozenset(['pkg1', 'pkg2']), cache.get_acquired_packages('user'))
+        self.assertEquals(2, cache.db.AllowedUser.get_by_user.call_count)
+
+    @patch('ckanext.privatedatasets.cache.time')
+    def test_get_acquired_packages_expired(self, time):
+        cache.settings.get.return_value.acquired_cache_ttl = 60
+        time.time.return_value = 1000000000
+        # The grant of pkg2 expires 30 seconds later
+        expires_at = datetime.datetime.utcfromtimestamp(1000000030)
+        cache.db.AllowedUser.get_by_user.return_value = [('pkg1', None), ('pkg2', expires_at)]
+
+        cache.get_acquired_packages('user')
+        self._new_request()
+        time.time.return_value = 1000000029
+        cache.get_acquired_packages('user')
+        self.assertEquals(1, cache.db.AllowedUser.get_by_user.call_count)
+
+        # They are loaded again when one of the grants expires, even if the TTL has not expired yet
+        self._new_request()
+        time.time.return_value = 1000000030
+        cache.db.AllowedUser.get_by_user.return_value = [('pkg1', None)]
+        self.assertEquals(frozenset(['pkg1']), cache.get_acquired_packages('user'))
+        self.assertEquals(2, cache.db.AllowedUser.get_by_user.call_count)
+
+    @parameterized.expand([
+        (0,),
+        (60,),
+    ])
+    def test_get_acquired_package_ids(self, ttl):
+        cache.settings.get.return_value.acquired_cache_ttl = ttl
+        self._configure_packages([])
+        cache.db.AllowedUser.get_by_user.return_value = [('pkg1', None), ('pkg3', None)]
+        cache.db.AllowedUser.get_users_by_package.return_value = {'pkg1': ['user']}
+
+        self.assertEquals(frozenset(['pkg1']), cache.get_acquired_package_ids(['pkg1', 'pkg2'], 'user'))
+        self.assertEquals(frozenset(), cache.get_acquired_package_ids(['pkg1', 'pkg2'], None))
+
+        if ttl:
+            # The acquired packages kept in memory are intersected with the given ones
+            self.assertEquals(0, cache.db.AllowedUser.get_users_by_package.call_count)
+        else:
+            # The grants of the given packages are loaded with a single query
+            cache.db.AllowedUser.get_users_by_package.assert_called_once_with(['pkg1', 'pkg2'], user_name='user')
+            self.assertEquals(0, cache.db.AllowedUser.get_by_user.call_count)
+
+    @parameterized.expand([
+        (set(),                                                  False),
+        (set([('organization', 'conwet')]),                       True),
+        (set([('creator', 'creator')]),                           True),
+        (set([('organization', 'other'), ('creator', 'other')]),  False),
+    ])
+    def test_has_scoped_grant(self, scoped_grants, expected):
+        cache.db.ScopedGrant.get_by_user.return_value = scoped_grants
+        package = cache.PackageMeta('package_id', True, 'active', 'conwet', 'creator')
+        other_package = cache.PackageMeta('other_id', True, 'active', 'conwet', 'creator')
+
+        self.assertEquals(expected, cache.has_scoped_grant(package, 'user'))
+        self.assertEquals(expected, cache.has_scoped_grant(other_package, 'user'))
+
+        # The grants of the user are loaded once per request
+        cache.db.ScopedGrant.get_by_user.assert_called_once_with('user')
+        self.assertEquals(frozenset(scoped_grants), cache.get_scoped_grants('user'))
+
+    @parameterized.expand([
+        (set([('bundle', 'b1')]),                     ['b2', 'b1'],  True),
+        (set([('bundle', 'b1')]),                     ['b2'],        False),
+        (set([('bundle', 'b1')]),                     [],            False),
+    ])
+    def test_has_scoped_grant_bundles(self, scoped_grants, package_bundles, expected):
+        cache.db.ScopedGrant.get_by_user.return_value = scoped_grants
+        cache.db.Bundle.get_by_package.return_value = {'package_id': package_bundles}
+        package = cache.PackageMeta('package_id', True, 'active', 'conwet', 'creator')
+
+        self.assertEquals(expected, cache.has_scoped_grant(package, 'user'))
+        self.assertEquals(expected, cache.has_scoped_grant(package, 'user'))
+
+        # The bundles of each package are loaded once per request
+        cache.db.Bundle.get_by_package.assert_called_once_with(['package_id'])
+
+    def test_has_scoped_grant_without_bundles(self):
+        cache.db.ScopedGrant.get_by_user.return_value = set([('organization', 'other')])
+        package = cache.PackageMeta('package_id', True, 'active', 'conwet', 'creator')
+
+        # The bundles of the package are not loaded when the user has not acquired any bundle
+        self.assertFalse(cache.has_scoped_grant(package, 'user'))
+        self.assertEquals(0, cache.db.Bundle.get_by_package.call_count)
+
+    @parameterized.expand([
+        (('user_id', False), {'g1': 'member'},                ['g2', 'g1'],  True),
+        (('user_id', False), {'g1': 'member'},                ['g2'],        False),
+        (None,               {},                              ['g1'],        False),
+    ])
+    def test_has_group_grant(self, user, memberships, allowed_groups, expected):
+        self._configure_user(user, memberships.items())
+        cache.db.AllowedGroup.get_groups_by_package.return_value = {'package_id': allowed_groups}
+
+        self.assertEquals(expected, cache.has_group_grant('package_id', 'user'))
+        self.assertEquals(expected, cache.has_group_grant('package_id', 'user'))
+
+        # The memberships of the user and the groups of the package are loaded once per request
+        self.assertEquals(2 if user else 1, cache.model.Session.query.call_count)
+        if user:
+            cache.db.AllowedGroup.get_groups_by_package.assert_called_once_with(['package_id'])
+        else:
+            # Users that do not belong to any group cannot be granted through groups
+            self.assertEquals(0, cache.db.AllowedGroup.get_groups_by_package.call_count)
+
+    def test_prefetch_allowed_groups(self):
+        self._configure_user(('user_id', False), [('g1', 'member')])
+        self._configure_packages([], ('user_id', False))
+        cache.db.AllowedUser.get_users_by_package.return_value = {}
+        cache.db.ScopedGrant.get_by_user.return_value = set()
+        cache.db.AllowedGroup.get_groups_by_package.return_value = {'pkg1': ['g1']}
+
+        cache.prefetch(['pkg1', 'pkg2'], 'user')
+        cache.prefetch(['pkg1', 'pkg2'], 'user')
+
+        # The groups of the packages are loaded with a single query
+        cache.db.AllowedGroup.get_groups_by_package.assert_called_once_with(['pkg1', 'pkg2'])
+        self.assertTrue(cache.has_group_grant('pkg1', 'user'))
+        self.assertFalse(cache.has_group_grant('pkg2', 'user'))
+        self.assertEquals(1, cache.db.AllowedGroup.get_groups_by_package.call_count)
+
+    @parameterized.expand([
+        (None,),
+        ('user',),
+    ])
+    def test_prefetch(self, user):
+        query = self._configure_packages([('pkg1', True, 'active', 'org', 'creator')])
+        cache.db.AllowedUser.get_users_by_package.return_value = {'pkg1': ['user']}
+
+        cache.prefetch(['pkg1', 'pkg2'], user)
+        # Cached packages are not loaded again
+        cache.prefetch(['pkg1', 'pkg2'], user)
+
+        self.assertEquals(2 if user else 1, query.call_count)
+        self.assertEquals(cache.PackageMeta('pkg1', True, 'active', 'org', 'creator'), cache.get_package_meta('pkg1'))
+        self.assertIsNone(cache.get_package_meta('pkg2'))
+
+        if user:
+            cache.db.AllowedUser.get_users_by_package.assert_called_once_with(['pkg1', 'pkg2'], user_name=user)
+            self.assertTrue(cache.is_granted('pkg1', user))
+            self.assertFalse(cache.is_granted('pkg2', user))
+        else:
+            self.assertEquals(0, cache.db.AllowedUser.get_users_by_package.call_count)
+
+        self.assertEquals(0, cache.db.AllowedUser.is_granted.call_count)
+
+    def test_prefetch_bundles(self):
+        self._configure_packages([])
+        cache.db.AllowedUser.get_users_by_package.return_value = {}
+        cache.db.ScopedGrant.get_by_user.return_value = set([('bundle', 'b1')])
+        cache.db.Bundle.get_by_package.return_value = {'pkg1': ['b1']}
+
+        cache.prefetch(['pkg1', 'pkg2'], 'user')
+        cache.prefetch(['pkg1', 'pkg2'], 'user')
+
+        # The bundles of the packages are loaded with a single query
+        cache.db.Bundle.get_by_package.assert_called_once_with(['pkg1', 'pkg2'])
+        self.assertTrue(cache.has_scoped_grant(cache.PackageMeta('pkg1', True, 'active', None, None), 'user'))
+        self.assertFalse(cache.has_scoped_grant(cache.PackageMeta('pkg2', True, 'active', None, None), 'user'))
+        self.assertEquals(1, cache.db.Bundle.get_by_package.call_count)
+
+    @parameterized.expand([
+        # No organization or no user
+        (None,  'user', ('user_id', False), [],                       'read',           False),
+        ('org', None,   ('user_id', False), [],                       'read',           False),
+        # Not existing user
+        ('org', 'user', None,               [],                       'read',           False),
+        # Sysadmins have every permission
+        ('org', 'user', ('user_id', True),  [],                       'update_dataset', True),
+        # Direct memberships
+        ('org', 'user', ('user_id', False), [('org', 'member')],      'read',           True),
+        ('org', 'user', ('user_id', False), [('org', 'member')],      'update_dataset', False),
+        ('org', 'user', ('user_id', False), [('other', 'admin')],     'read',           False),
+        # Roles granted through the parent organization
+        ('org', 'user', ('user_id', False), [('parent', 'admin')],    'update_dataset', True),
+        ('org', 'user', ('user_id', False), [('parent', 'editor')],   'update_dataset', False),
+    ])
+    def test_has_user_permission_for_group_or_org(self, group_id, user_name, user, memberships, permission, expected):
+        self._configure_user(user, memberships)
+        parent = MagicMock()
+        parent.id = 'parent'
+        cache.model.Group.get.return_value.get_parent_group_hierarchy.return_value = [parent]
+
+        self.assertEquals(expected, cache.has_user_permission_for_group_or_org(group_id, user_name, permission))
+
+    def test_memberships_loaded_once_per_request(self):
+        self._configure_user(('user_id', False), [('org1', 'member')])
+
+        for org in ['org1', 'org2', 'org1', 'org3']:
+            cache.has_user_permission_for_group_or_org(org, 'user', 'read')
+
+        # One query to get the user and another one to get his/her memberships
+        self.assertEquals(2, cache.model.Session.query.call_count)
+        cache.authz.get_roles_with_permission.assert_called_once_with('read')
+
+
+    @parameterized.expand([
+        ([('pkg1', True, 'active', 'org', 'creator')],       1),
+        ([None, ('pkg1', True, 'active', 'org', 'creator')], 2),
+        ([None, None],                                       2),
+    ])
+    def test_get_package_meta(self, rows, expected_queries):
+        cache.model.Package.id = sa.column('id')
+        cache.model.Package.name = sa.column('name')
+        query = cache.model.Session.query.return_value.autoflush.return_value
+        query.filter.return_value.first.side_effect = rows
+
+        expected = cache.PackageMeta(*rows[-1]) if rows[-1] else None
+        self.assertEquals(expected, cache.get_package_meta('pkg1'))
+        self.assertEquals(expected, cache.get_package_meta('pkg1'))
+
+        # The package is looked up by id and then by name, once per request
+        self.assertEquals(expected_queries, query.filter.return_value.first.call_count)
+        self.assertEquals(['id = :id_1', 'name = :name_1'][:expected_queries],
+                          [str(args[0]) for args, _ in query.filter.call_args_list])
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_values_loaded_once(self):
+        lru = cache.LRUCache(maxsize=2)
+        loader = MagicMock(return_value='value')
+
+        self.assertEquals('value', lru.get('key', loader))
+        self.assertEquals('value', lru.get('key', loader))
+
+        loader.assert_called_once_with()
+        self.assertEquals(1, lru.hits)
+        self.assertEquals(1, lru.misses)
+        self.assertEquals(0.5, lru.hit_rate)
+
+    @patch('ckanext.privatedatasets.cache.log')
+    def test_stats_logged(self, log):
+        lru = cache.LRUCache(name='Test', stats_interval=2)
+        for key in ('a', 'a', 'b'):
+            lru.get(key, lambda: 1)
+
+        # The stats are logged every stats_interval lookups
+        log.debug.assert_called_once_with('%s cache: %.1f%% hit rate (%d hits, %d misses), %d values',
+                                          'Test', 50.0, 1, 1, 1)
+
+    def test_least_recently_used_evicted(self):
+        lru = cache.LRUCache(maxsize=2)
+        lru.get('a', lambda: 1)
+        lru.get('b', lambda: 2)
+        # a becomes the most recently used value
+        lru.get('a', lambda: 1)
+        lru.get('c', lambda: 3)
+
+        self.assertEquals(2, len(lru))
+        self.assertEquals(1, lru.get('a', lambda: None))
+        self.assertEquals(None, lru.get('b', lambda: None))
+
+    def test_pop(self):
+        lru = cache.LRUCache()
+        lru.get('a', lambda: 1)
+        lru.pop('a')
+        lru.pop('b')
+
+        self.assertEquals(0, len(lru))
+        self.assertEquals(2, lru.get('a', lambda: 2))
+
+    def test_clear(self):
+        lru = cache.LRUCache()
+        lru.get('a', lambda: 1)
+        lru.clear()
+
+        self.assertEquals(0, len(lru))
+        self.assertEquals(0.0, lru.hit_rate)
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from mock import DEFAULT, MagicMock, call, patch
+from parameterized import parameterized
+
+import ckanext.privatedatasets.commands as commands
+
+
+class CommandsTest(unittest.TestCase):
+
+    def setUp(self):
+        self._model = commands.model
+        commands.model = MagicMock()
+
+        self._search = commands.search
+        commands.search = MagicMock()
+
+        self._tk = commands.tk
+        commands.tk = MagicMock()
+
+        self._indexer = commands.indexer
+        commands.indexer = MagicMock()
+        commands.indexer.user_label.side_effect = self._indexer.user_label
+
+    def tearDown(self):
+        commands.model = self._model
+        commands.search = self._search
+        commands.tk = self._tk
+        commands.indexer = self._indexer
+
+    @parameterized.expand([
+        ([],                     2, []),
+        (['a'],                  2, [['a']]),
+        (['a', 'b'],             2, [['a', 'b']]),
+        (['a', 'b', 'c', 'd', 'e'], 2, [['a', 'b'], ['c', 'd'], ['e']]),
+    ])
+    @patch('ckanext.privatedatasets.commands._package_ids_query')
+    def test_iter_package_ids(self, ids, batch_size, expected_batches, _package_ids_query):
+        rows = [(package_id,) for package_id in ids]
+        result = MagicMock()
+        result.fetchmany.side_effect = lambda size: [rows.pop(0) for _ in range(min(size, len(rows)))]
+
+        connection = commands.model.meta.engine.connect.return_value
+        connection.execution_options.return_value.execute.return_value = result
+
+        self.assertEquals(expected_batches, list(commands.iter_package_ids(batch_size)))
+
+        connection.execution_options.assert_called_once_with(stream_results=True)
+        result.close.assert_called_once_with()
+        connection.close.assert_called_once_with()
+
+    def test_reindex_packages(self):
+        package_show = MagicMock(side_effect=[{'id': 'a'}, ValueError(), {'id': 'c'}])
+        commands.tk.get_action.return_value = package_show
+
+        self.assertEquals(3, commands.reindex_packages(['a', 'b', 'c']))
+
+        package_index = commands.search.index_for.return_value
+        self.assertEquals([call({'id': 'a'}, defer_commit=True), call({'id': 'c'}, defer_commit=True)],
+                          package_index.update_dict.call_args_list)
+        self.assertEquals(0, package_index.commit.call_count)
+        commands.model.Session.remove.assert_called_once_with()
+
+        # Grants are loaded once per batch
+        commands.indexer.prefetch_allowed_users.assert_called_once_with(['a', 'b', 'c'])
+        commands.indexer.clear_prefetched.assert_called_once_with()
+
+    @parameterized.expand([
+        (False,),
+        (True,),
+    ])
+    @patch.multiple('ckanext.privatedatasets.commands', count_package_ids=DEFAULT, iter_package_ids=DEFAULT,
+                    reindex_packages=DEFAULT)
+    def test_reindex_command_single_worker(self, all_datasets, count_package_ids, iter_package_ids, reindex_packages):
+        count_package_ids.return_value = 3
+        iter_package_ids.return_value = iter([['a', 'b'], ['c']])
+        reindex_packages.side_effect = lambda package_ids: len(package_ids)
+
+        command = commands.PrivateDatasetsCommand('privatedatasets')
+        command.options = MagicMock(all_datasets=all_datasets, batch_size=2, commit_interval=1000, workers=1)
+        command.reindex()
+
+        count_package_ids.assert_called_once_with(all_datasets)
+        iter_package_ids.assert_called_once_with(2, all_datasets)
+        self.assertEquals([call(['a', 'b']), call(['c'])], reindex_packages.call_args_list)
+        commands.search.index_for.return_value.commit.assert_called_once_with()
+
+    @patch('ckanext.privatedatasets.commands.db')
+    def test_initdb_command(self, db):
+        command = commands.PrivateDatasetsCommand('privatedatasets')
+        command.args = ['initdb']
+        command._load_config = MagicMock()
+
+        command.command()
+
+        db.init_db.assert_called_once_with()
+
+    @parameterized.expand([
+        (['migrate'],      None),
+        (['migrate', '1'], 1),
+    ])
+    @patch('ckanext.privatedatasets.commands.migration')
+    def test_migrate_command(self, args, target, migration):
+        migration.migrate.return_value = 2
+        command = commands.PrivateDatasetsCommand('privatedatasets')
+        command.args = args
+        command.options = MagicMock(sql=False)
+        command._load_config = MagicMock()
+
+        command.command()
+
+        command._load_config.assert_called_once_with()
+        migration.migrate.assert_called_once_with(commands.model.meta.engine, target)
+
+    @parameterized.expand([
+        (['migrate'],      0, None),
+        (['migrate', '2'], 1, 2),
+    ])
+    @patch('ckanext.privatedatasets.commands.migration')
+    def test_migrate_sql_command(self, args, from_version, target, migration):
+        migration.generate_sql.return_value = ['CREATE TABLE a;']
+        command = commands.PrivateDatasetsCommand('privatedatasets')
+        command.args = args
+        command.options = MagicMock(sql=True, from_version=from_version)
+        command._load_config = MagicMock()
+        command._get_config = MagicMock(return_value={'sqlalchemy.url': 'postgresql://ckan@localhost/ckan'})
+
+        command.command()
+
+        # The environment is not loaded, so no connection to the database is required
+        self.assertEquals(0, command._load_config.call_count)
+        migration.generate_sql.assert_called_once_with('postgresql://ckan@localhost/ckan', from_version, target)
+        self.assertEquals(0, migration.migrate.call_count)
+
+    @parameterized.expand([
+        (False,),
+        (True,),
+    ])
+    @patch.multiple('ckanext.privatedatasets.commands', db=DEFAULT, settings=DEFAULT, reindex_packages=DEFAULT)
+    def test_sweep_command(self, incremental_index, db, settings, reindex_packages):
+        settings.get.return_value.incremental_index = incremental_index
+        db.AllowedUser.delete_expired.side_effect = [[('a', 'id1', 'user1'), ('b', 'id1', 'user1')],
+                                                     [('a', None, 'user2')]]
+        db.ScopedGrant.delete_expired.side_effect = [2, 0]
+
+        command = commands.PrivateDatasetsCommand('privatedatasets')
+        command.args = ['sweep']
+        command.options = MagicMock(batch_size=2)
+        command._load_config = MagicMock()
+        command.command()
+
+        # Expired grants are deleted in batches until a batch is not full
+        self.assertEquals([call(2), call(2)], db.AllowedUser.delete_expired.call_args_list)
+        self.assertEquals([call(2), call(2)], db.ScopedGrant.delete_expired.call_args_list)
+        self.assertEquals(4, commands.model.Session.commit.call_count)
+
+        labels_indexer = commands.indexer.PermissionLabelsIndexer.return_value
+        if incremental_index:
+            # Users that had not signed up are labelled by name
+            self.assertEquals([call('a', ['allowed-id1']), call('b', ['allowed-id1']), call('a', ['allowed_name-user2'])],
+                              labels_indexer.remove_labels.call_args_list)
+            self.assertEquals(0, reindex_packages.call_count)
+        else:
+            self.assertEquals([call(['a', 'b']), call(['a'])], reindex_packages.call_args_list)
+            self.assertEquals(0, labels_indexer.remove_labels.call_count)
+
+    @patch('ckanext.privatedatasets.commands.db')
+    def test_sweep_command_nothing_expired(self, db):
+        db.AllowedUser.delete_expired.return_value = []
+        db.ScopedGrant.delete_expired.return_value = 0
+
+        command = commands.PrivateDatasetsCommand('privatedatasets')
+        command.args = ['sweep']
+        command.options = MagicMock(batch_size=100)
+        command._load_config = MagicMock()
+        command.command()
+
+        db.AllowedUser.delete_expired.assert_called_once_with(100)
+        self.assertEquals(0, commands.search.index_for.return_value.commit.call_count)
+
+    @patch('ckanext.privatedatasets.commands.snapshot')
+    def test_snapshot_command(self, snapshot):
+        snapshot.export.return_value = 3
+
+        command = commands.PrivateDatasetsCommand('privatedatasets')
+        command.args = ['snapshot', '/tmp/grants.snapshot']
+        command._load_config = MagicMock()
+        command.command()
+
+        snapshot.export.assert_called_once_with('/tmp/grants.snapshot')
+
+    @patch('ckanext.privatedatasets.commands.snapshot')
+    def test_snapshot_command_without_path(self, snapshot):
+        command = commands.PrivateDatasetsCommand('privatedatasets')
+        command.args = ['snapshot']
+        command._load_config = MagicMock()
+
+        self.assertRaises(SystemExit, command.command)
+        self.assertEquals(0, snapshot.export.call_count)
+
+    def test_command_not_recognized(self):
+        command = commands.PrivateDatasetsCommand('privatedatasets')
+        command.args = ['invalid']
+        command._load_config = MagicMock()
+
+        self.assertRaises(SystemExit, command.command)
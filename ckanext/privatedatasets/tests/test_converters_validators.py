@@ -17,6 +17,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
 
+import datetime
 import unittest
 import ckanext.privatedatasets.converters_validators as conv_val
 
@@ -34,8 +35,12 @@ class ConvertersValidatorsTest(unittest.TestCase):
         self._db = conv_val.db
         conv_val.db = MagicMock()
 
+        self._model = conv_val.model
+        conv_val.model = MagicMock()
+
     def tearDown(self):
         conv_val.db = self._db
+        conv_val.model = self._model
         conv_val.toolkit = self._toolkit
 
     @parameterized.expand([
@@ -165,15 +170,7 @@ class ConvertersValidatorsTest(unittest.TestCase):
         key = 'allowed_users'
         data = {('id',): 'package_id'}
 
-        # Create the users
-        db_res = []
-        for user in users:
-            db_row = MagicMock()
-            db_row.package_id = 'package_id'
-            db_row.user_name = user
-            db_res.append(db_row)
-
-        conv_val.db.AllowedUser.get = MagicMock(return_value=db_res)
+        conv_val.db.AllowedUser.iter_by_package = MagicMock(return_value=iter(users))
 
         # Call the function
         context = {'model': MagicMock()}
@@ -183,8 +180,39 @@ class ConvertersValidatorsTest(unittest.TestCase):
         for i, user in enumerate(users):
             self.assertEquals(user, data[(key, i)])
 
-        # Check that the table has been initialized properly
-        conv_val.db.init_db.assert_called_once_with(context['model'])
+        # Check that the users have been retrieved
+        conv_val.db.AllowedUser.iter_by_package.assert_called_once_with('package_id')
+
+    @parameterized.expand([
+        (['g1', 'g2'],        ['id-g1', 'id-g2'],  []),
+        ('g1, g2,, g1',       ['id-g1', 'id-g2'],  []),
+        (['id-g1', 'g1'],     ['id-g1'],           []),
+        ([],                  [],                  []),
+        ('',                  [],                  []),
+        (['g1', 'unknown'],   ['id-g1'],           ['Group unknown does not exist']),
+        (['deleted'],         [],                  ['Group deleted does not exist']),
+    ])
+    def test_allowed_groups_convert(self, value, expected_ids, expected_errors):
+        groups = {'g1': MagicMock(id='id-g1', state='active'), 'id-g1': MagicMock(id='id-g1', state='active'),
+                  'g2': MagicMock(id='id-g2', state='active'), 'deleted': MagicMock(id='id-d', state='deleted')}
+        conv_val.model.Group.get.side_effect = groups.get
+
+        key = ('allowed_groups',)
+        data = {key: value}
+        errors = {key: []}
+        conv_val.allowed_groups_convert(key, data, errors, {})
+
+        self.assertEquals(expected_ids, data[key])
+        self.assertEquals(expected_errors, errors[key])
+
+    def test_get_allowed_groups(self):
+        conv_val.db.AllowedGroup.get_group_names.return_value = ['g1', 'g2']
+        data = {('id',): 'package_id'}
+
+        conv_val.get_allowed_groups(('allowed_groups',), data, {}, {})
+
+        self.assertEquals(['g1', 'g2'], data[('allowed_groups',)])
+        conv_val.db.AllowedGroup.get_group_names.assert_called_once_with('package_id')
 
     @parameterized.expand([
         (None, False),
@@ -228,3 +256,22 @@ class ConvertersValidatorsTest(unittest.TestCase):
             expected_length = 0
 
         self.assertEquals(expected_length, len(errors[key]))
+
+    @parameterized.expand([
+        (None,                                     None),
+        (datetime.datetime(2018, 1, 2, 3, 4, 5),   datetime.datetime(2018, 1, 2, 3, 4, 5)),
+        ('2018-01-02',                             datetime.datetime(2018, 1, 2)),
+        ('2018-01-02T03:04:05',                    datetime.datetime(2018, 1, 2, 3, 4, 5)),
+        (' 2018-01-02T03:04:05Z ',                 datetime.datetime(2018, 1, 2, 3, 4, 5)),
+        ('2018-01-02T03:04:05.250Z',               datetime.datetime(2018, 1, 2, 3, 4, 5, 250000)),
+        ('02/01/2018',                             ValueError),
+        ('2018-01-02T03:04:05+02:00',              ValueError),
+        (20180102,                                 ValueError),
+    ])
+    def test_parse_expires_at(self, value, expected):
+        conv_val.toolkit.ValidationError = ValueError
+
+        if expected is ValueError:
+            self.assertRaises(ValueError, conv_val.parse_expires_at, value)
+        else:
+            self.assertEquals(expected, conv_val.parse_expires_at(value))
@@ -17,43 +17,569 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
 
+import datetime
+import os
+import random
+import shutil
+import tempfile
+import threading
 import unittest
 import ckanext.privatedatasets.db as db
 
-from mock import MagicMock
+from mock import MagicMock, patch
+from parameterized import parameterized
+import sqlalchemy as sa
+from sqlalchemy import orm
+from sqlalchemy.dialects import postgresql
 
 
 class DBTest(unittest.TestCase):
 
     def setUp(self):
-        # Restart databse initial status
-        db.AllowedUser = None
+        self._model = db.model
+        db.model = MagicMock()
 
-        # Create mocks
-        self._sa = db.sa
-        db.sa = MagicMock()
+        self._migration = db.migration
+        db.migration = MagicMock()
 
     def tearDown(self):
-        db.AllowedUser = None
-        db.sa = self._sa
+        db.model = self._model
+        db.migration = self._migration
 
-    def test_initdb_not_initialized(self):
+    def test_initdb(self):
+        self.assertEquals(db.migration.migrate.return_value, db.init_db())
 
-        # Call the function
-        model = MagicMock()
-        db.init_db(model)
+        # Pending migrations are run against the CKAN database
+        db.migration.migrate.assert_called_once_with(db.model.meta.engine)
 
-        # Assert that table method has been called
-        db.sa.Table.assert_called_once()
-        model.meta.mapper.assert_called_once()
+    def _set_dialect(self, name):
+        db.model.Session.get_bind.return_value.dialect.name = name
 
-    def test_initdb_initialized(self):
-        db.AllowedUser = MagicMock()
+    def _executed_sql(self):
+        return [str(args[0].compile(dialect=postgresql.dialect()))
+                for args, _ in db.model.Session.execute.call_args_list]
 
-        # Call the function
-        model = MagicMock()
-        db.init_db(model)
+    @parameterized.expand([
+        ('pkg1',),
+        (u'dataset-with-a-long-name-' * 10,),
+    ])
+    def test_lock_key(self, package_id):
+        # Keys are stable and fit in the int4 argument of the advisory locks
+        key = db._lock_key(package_id)
+        self.assertEquals(key, db._lock_key(package_id))
+        self.assertTrue(-2 ** 31 <= key < 2 ** 31)
 
-        # Assert that table method has been called
-        self.assertEquals(0, db.sa.Table.call_count)
-        self.assertEquals(0, model.meta.mapper.call_count)
+    def test_lock_package(self):
+        self._set_dialect('postgresql')
+        db.lock_package('pkg1')
+
+        self.assertEquals(1, len(self._executed_sql()))
+        self.assertIn('pg_advisory_xact_lock', self._executed_sql()[0])
+
+    def test_lock_package_sqlite(self):
+        self._set_dialect('sqlite')
+        db.lock_package('pkg1')
+
+        # SQLite already serializes the write transactions
+        self.assertEquals(0, db.model.Session.execute.call_count)
+
+    @patch('ckanext.privatedatasets.db.lock_package')
+    def test_lock_packages(self, lock_package):
+        db.lock_packages(['pkg2', 'pkg1', 'pkg2'])
+
+        # Packages are always locked in the same order
+        self.assertEquals([(('pkg1',),), (('pkg2',),)], lock_package.call_args_list)
+
+    def test_insert_ignore_postgresql(self):
+        self._set_dialect('postgresql')
+        db.model.Session.execute.return_value = [('pkg2', 'b')]
+        rows = [{'package_id': 'pkg1', 'user_name': 'a'}, {'package_id': 'pkg2', 'user_name': 'b'}]
+
+        # Only the rows returned by the database have been inserted
+        self.assertEquals([rows[1]], db._insert_ignore(db.package_allowed_users_table, rows))
+        sql = self._executed_sql()[0]
+        self.assertIn('ON CONFLICT DO NOTHING', sql)
+        self.assertIn('RETURNING package_allowed_users.package_id, package_allowed_users.user_name', sql)
+
+        self.assertEquals([], db._insert_ignore(db.package_allowed_users_table, []))
+        self.assertEquals(1, db.model.Session.execute.call_count)
+
+
+class AllowedUserQueriesTest(unittest.TestCase):
+    '''Runs the queries against an in-memory SQLite database'''
+
+    GRANTS = [('pkg1', 'a'), ('pkg1', 'b'), ('pkg1', 'c'), ('pkg2', 'a'), ('pkg3', 'b')]
+    # User c has not signed up yet, so its grants have no user id
+    USER_IDS = {'a': 'id-a', 'b': 'id-b'}
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://')
+
+        self._model = db.model
+        db.model = MagicMock()
+        db.model.Session = orm.scoped_session(orm.sessionmaker(bind=self.engine))
+        db.model.user_table = self._model.user_table
+        db.model.package_table = self._model.package_table
+        db.model.group_table = self._model.group_table
+        db.AllowedUser._is_granted_statement = None
+
+        for table in (db.model.user_table, db.model.package_table, db.model.group_table,
+                      db.package_allowed_users_table, db.package_allowed_groups_table, db.scoped_grants_table,
+                      db.bundles_table, db.bundle_packages_table):
+            table.create(bind=self.engine)
+
+        db.model.Session.execute(db.model.user_table.insert(),
+                                 [{'id': user_id, 'name': name} for name, user_id in self.USER_IDS.items()])
+        db.model.Session.execute(db.model.package_table.insert(),
+                                 [{'id': package_id, 'name': package_id, 'state': 'active'}
+                                  for package_id in ('pkg1', 'pkg2', 'pkg3', 'pkg4')])
+        db.model.Session.execute(db.package_allowed_users_table.insert(),
+                                 [{'package_id': package_id, 'user_name': user_name,
+                                   'user_id': self.USER_IDS.get(user_name)}
+                                  for package_id, user_name in self.GRANTS])
+
+    def tearDown(self):
+        db.model.Session.remove()
+        db.model = self._model
+        db.AllowedUser._is_granted_statement = None
+        self.engine.dispose()
+
+    def _rename_user(self, old_name, new_name):
+        user_table = db.model.user_table
+        db.model.Session.execute(user_table.update().values(name=new_name).where(user_table.c.name == old_name))
+
+    def _grants(self):
+        table = db.package_allowed_users_table
+        query = sa.select([table.c.package_id, table.c.user_name]).order_by(table.c.package_id, table.c.user_name)
+        return [tuple(row) for row in db.model.Session.execute(query)]
+
+    @parameterized.expand([
+        ({},                                       5),
+        ({'package_id': 'pkg1'},                   3),
+        ({'user_name': 'a'},                       2),
+        ({'package_id': 'pkg1', 'user_name': 'a'}, 1),
+        ({'package_id': 'pkg4'},                   0),
+    ])
+    def test_count_exists(self, criteria, expected_count):
+        self.assertEquals(expected_count, db.AllowedUser.count(**criteria))
+        self.assertEquals(expected_count > 0, db.AllowedUser.exists(**criteria))
+
+    @parameterized.expand([
+        (1,),
+        (2,),
+        (3,),
+        (1000,),
+    ])
+    def test_iter_keyset_pagination(self, batch_size):
+        self.assertEquals(['a', 'b', 'c'], list(db.AllowedUser.iter_by_package('pkg1', batch_size=batch_size)))
+        self.assertEquals(['pkg1', 'pkg3'], list(db.AllowedUser.iter_by_user('b', batch_size=batch_size)))
+        self.assertEquals([], list(db.AllowedUser.iter_by_user('z', batch_size=batch_size)))
+
+    def test_get_users_by_package(self):
+        self.assertEquals({'pkg1': ['a', 'b', 'c'], 'pkg2': ['a']},
+                          dict((k, sorted(v)) for k, v in db.AllowedUser.get_users_by_package(['pkg1', 'pkg2']).items()))
+        self.assertEquals({'pkg1': ['a'], 'pkg2': ['a']},
+                          db.AllowedUser.get_users_by_package(['pkg1', 'pkg2', 'pkg3'], user_name='a'))
+
+    def test_count_by_package(self):
+        self._expire('pkg1', 'b', datetime.datetime(2000, 1, 1))
+
+        # Expired grants are not counted
+        self.assertEquals({'pkg1': 2, 'pkg2': 1}, db.AllowedUser.count_by_package(['pkg1', 'pkg2', 'pkg4']))
+        self.assertEquals({}, db.AllowedUser.count_by_package([]))
+
+    @parameterized.expand([
+        ('pkg1', 'a', True),
+        ('pkg1', 'd', False),
+        ('pkg4', 'a', False),
+    ])
+    def test_is_granted(self, package_id, user_name, expected):
+        self.assertEquals(expected, db.AllowedUser.is_granted(package_id, user_name))
+
+        # The statement is built once and reused
+        statement = db.AllowedUser._is_granted_statement
+        self.assertIsNotNone(statement)
+        self.assertEquals(expected, db.AllowedUser.is_granted(package_id, user_name))
+        self.assertIs(statement, db.AllowedUser._is_granted_statement)
+        self.assertTrue(len(db._compiled_cache) > 0)
+
+    def test_bulk_grant(self):
+        # Existing and repeated grants are ignored
+        inserted = db.AllowedUser.bulk_grant([('pkg1', 'a'), ('pkg2', 'c'), ('pkg2', 'c'), ('pkg4', 'a')])
+
+        self.assertEquals([('pkg2', 'c'), ('pkg4', 'a')], inserted)
+        self.assertEquals(sorted(self.GRANTS + [('pkg2', 'c'), ('pkg4', 'a')]), self._grants())
+        self.assertEquals([], db.AllowedUser.bulk_grant([]))
+
+    def test_bulk_grant_expires_at(self):
+        expires_at = datetime.datetime(3000, 1, 1)
+        db.AllowedUser.bulk_grant([('pkg1', 'a'), ('pkg2', 'd')], expires_at)
+
+        # Only the new grants get the expiry date
+        table = db.package_allowed_users_table
+        query = sa.select([table.c.package_id, table.c.user_name, table.c.expires_at])\
+            .where(table.c.expires_at.isnot(None))
+        self.assertEquals([('pkg2', 'd', expires_at)], [tuple(row) for row in db.model.Session.execute(query)])
+
+    def test_get_existing(self):
+        self._rename_user('a', 'x')
+        self._expire('pkg1', 'b', datetime.datetime(2000, 1, 1))
+
+        # Expired grants are also returned, and users are matched by their current names
+        self.assertEquals(set([('pkg1', 'x'), ('pkg1', 'b'), ('pkg1', 'c')]), db.AllowedUser.get_existing(
+            [('pkg1', 'x'), ('pkg1', 'b'), ('pkg1', 'c'), ('pkg1', 'a'), ('pkg3', 'x'), ('pkg4', 'b')]))
+        self.assertEquals(set(), db.AllowedUser.get_existing([]))
+
+        # Unless they are excluded
+        self.assertEquals(set([('pkg1', 'x'), ('pkg1', 'c')]), db.AllowedUser.get_existing(
+            [('pkg1', 'x'), ('pkg1', 'b'), ('pkg1', 'c')], include_expired=False))
+
+    def test_bulk_revoke(self):
+        deleted = db.AllowedUser.bulk_revoke([('pkg1', 'a'), ('pkg1', 'c'), ('pkg3', 'a'), ('pkg1', 'a')])
+
+        self.assertEquals(2, deleted)
+        self.assertEquals([('pkg1', 'b'), ('pkg2', 'a'), ('pkg3', 'b')], self._grants())
+
+    def test_get_user_ids(self):
+        self.assertEquals({'a': 'id-a'}, db.get_user_ids(['a', 'c']))
+        self.assertEquals({}, db.get_user_ids([]))
+
+    def test_bulk_grant_stores_user_ids(self):
+        db.AllowedUser.bulk_grant([('pkg2', 'b'), ('pkg2', 'd')])
+
+        table = db.package_allowed_users_table
+        query = sa.select([table.c.user_name, table.c.user_id]).where(table.c.package_id == 'pkg2')
+        self.assertEquals({'a': 'id-a', 'b': 'id-b', 'd': None}, dict(db.model.Session.execute(query).fetchall()))
+
+    def test_renamed_user(self):
+        self._rename_user('a', 'x')
+
+        # Grants follow the user, so the new name is the one returned
+        self.assertTrue(db.AllowedUser.is_granted('pkg1', 'x'))
+        self.assertFalse(db.AllowedUser.is_granted('pkg1', 'a'))
+        self.assertEquals(['pkg1', 'pkg2'], list(db.AllowedUser.iter_by_user('x')))
+        self.assertEquals(['b', 'c', 'x'], list(db.AllowedUser.iter_by_package('pkg1')))
+        self.assertEquals({'pkg2': ['x']}, db.AllowedUser.get_users_by_package(['pkg2']))
+        self.assertEquals({'pkg1': [('id-b', 'b'), (None, 'c'), ('id-a', 'x')]},
+                          db.AllowedUser.get_users_by_package(['pkg1'], with_ids=True))
+
+        # The stored grants are returned with the current names of their users
+        self.assertEquals([('a', 'x'), ('b', 'b'), ('c', 'c')],
+                          sorted((user.user_name, user_name) for user, user_name in db.AllowedUser.get_with_names('pkg1')))
+
+        # A new user that takes the old name does not get the grants
+        db.model.Session.execute(db.model.user_table.insert().values(id='id-new', name='a'))
+        self.assertFalse(db.AllowedUser.is_granted('pkg1', 'a'))
+        self.assertEquals([], list(db.AllowedUser.iter_by_user('a')))
+
+        # Grants are revoked by the current name
+        self.assertEquals(0, db.AllowedUser.bulk_revoke([('pkg1', 'a')]))
+        self.assertEquals(1, db.AllowedUser.bulk_revoke([('pkg1', 'x')]))
+        self.assertEquals([], db.AllowedUser.bulk_grant([('pkg2', 'x')]))
+
+    def test_iter_by_user_active_packages(self):
+        package_table = db.model.package_table
+        db.model.Session.execute(package_table.update().values(state='deleted').where(package_table.c.id == 'pkg1'))
+
+        # Deleted packages are skipped
+        self.assertEquals(['pkg2'], list(db.AllowedUser.iter_by_user('a')))
+
+    def _expire(self, package_id, user_name, expires_at):
+        table = db.package_allowed_users_table
+        db.model.Session.execute(table.update().values(expires_at=expires_at).where(
+            sa.and_(table.c.package_id == package_id, table.c.user_name == user_name)))
+
+    def test_expired_grants_are_ignored(self):
+        now = datetime.datetime.utcnow()
+        self._expire('pkg1', 'a', now - datetime.timedelta(minutes=1))
+        self._expire('pkg1', 'b', now + datetime.timedelta(days=1))
+
+        self.assertFalse(db.AllowedUser.is_granted('pkg1', 'a'))
+        self.assertTrue(db.AllowedUser.is_granted('pkg1', 'b'))
+        self.assertEquals(['b', 'c'], list(db.AllowedUser.iter_by_package('pkg1')))
+        self.assertEquals(['pkg2'], list(db.AllowedUser.iter_by_user('a')))
+        self.assertEquals({'pkg1': ['b', 'c']}, dict((k, sorted(v)) for k, v in
+                                                     db.AllowedUser.get_users_by_package(['pkg1']).items()))
+        self.assertEquals({'pkg1': ['a', 'b', 'c']}, dict((k, sorted(v)) for k, v in
+                                                          db.AllowedUser.get_users_by_package(['pkg1'], include_expired=True).items()))
+
+        # Expired grants that have not been swept are not inserted again
+        self.assertEquals([], db.AllowedUser.bulk_grant([('pkg1', 'a')]))
+
+    def test_get_by_user(self):
+        now = datetime.datetime.utcnow()
+        tomorrow = now + datetime.timedelta(days=1)
+        self._expire('pkg1', 'b', now - datetime.timedelta(minutes=1))
+        self._expire('pkg3', 'b', tomorrow)
+        self._rename_user('a', 'x')
+
+        # Expired grants are skipped and users are found by their current name
+        self.assertEquals([('pkg3', tomorrow)], db.AllowedUser.get_by_user('b'))
+        self.assertEquals([('pkg1', None), ('pkg2', None)], sorted(db.AllowedUser.get_by_user('x')))
+        self.assertEquals([('pkg1', None)], db.AllowedUser.get_by_user('c'))
+        self.assertEquals([], db.AllowedUser.get_by_user('a'))
+
+    def test_iter_grants(self):
+        tomorrow = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        self._expire('pkg1', 'a', datetime.datetime.utcnow() - datetime.timedelta(minutes=1))
+        self._expire('pkg3', 'b', tomorrow)
+        self._rename_user('b', 'x')
+        # Grants are streamed through another connection, so they must be committed
+        db.model.Session.commit()
+        db.model.meta.engine = self.engine
+
+        self.assertEquals([('pkg1', 'c'), ('pkg1', 'x'), ('pkg2', 'a'), ('pkg3', 'x')],
+                          sorted(db.AllowedUser.iter_grants()))
+        self.assertEquals([('pkg1', 'c', None), ('pkg1', 'x', None), ('pkg2', 'a', None), ('pkg3', 'x', tomorrow)],
+                          sorted(db.AllowedUser.iter_grants(with_expiry=True)))
+
+    def test_set_expiry(self):
+        expires_at = datetime.datetime(2000, 1, 1)
+        self._rename_user('a', 'x')
+
+        self.assertEquals(1, db.AllowedUser.set_expiry('pkg1', 'x', expires_at))
+        self.assertEquals(1, db.AllowedUser.set_expiry('pkg1', 'c', expires_at))
+        self.assertEquals(0, db.AllowedUser.set_expiry('pkg1', 'z', expires_at))
+        self.assertEquals(['b'], list(db.AllowedUser.iter_by_package('pkg1')))
+
+        # Grants can be renewed
+        self.assertEquals(1, db.AllowedUser.set_expiry('pkg1', 'x', None))
+        self.assertEquals(['b', 'x'], list(db.AllowedUser.iter_by_package('pkg1')))
+
+    def test_delete_expired(self):
+        now = datetime.datetime(2018, 6, 1)
+        self._expire('pkg1', 'a', datetime.datetime(2018, 1, 1))
+        self._expire('pkg1', 'c', datetime.datetime(2018, 2, 1))
+        self._expire('pkg2', 'a', datetime.datetime(2018, 3, 1))
+        self._expire('pkg3', 'b', datetime.datetime(2018, 7, 1))
+        self._rename_user('a', 'x')
+
+        # The oldest grants are deleted first, and they are returned with the current user names
+        self.assertEquals([('pkg1', 'id-a', 'x'), ('pkg1', None, 'c')], db.AllowedUser.delete_expired(2, now))
+        self.assertEquals([('pkg2', 'id-a', 'x')], db.AllowedUser.delete_expired(2, now))
+        self.assertEquals([], db.AllowedUser.delete_expired(2, now))
+        self.assertEquals([('pkg1', 'b'), ('pkg3', 'b')], self._grants())
+
+
+    def test_scoped_grants(self):
+        self.assertTrue(db.ScopedGrant.grant('organization', 'org1', 'a'))
+        self.assertTrue(db.ScopedGrant.grant('creator', 'id-b', 'a', datetime.datetime(2000, 1, 1)))
+        self.assertTrue(db.ScopedGrant.grant('organization', 'org1', 'c'))
+        self.assertEquals(set([('organization', 'org1')]), db.ScopedGrant.get_by_user('a'))
+
+        # Granting it again renews the grant
+        self.assertFalse(db.ScopedGrant.grant('creator', 'id-b', 'a'))
+        self.assertEquals(set([('organization', 'org1'), ('creator', 'id-b')]), db.ScopedGrant.get_by_user('a'))
+
+        # Grants are kept when users are renamed
+        self._rename_user('a', 'x')
+        self.assertEquals(set([('organization', 'org1'), ('creator', 'id-b')]), db.ScopedGrant.get_by_user('x'))
+        self.assertEquals(set(), db.ScopedGrant.get_by_user('a'))
+
+        self.assertTrue(db.ScopedGrant.revoke('organization', 'org1', 'x'))
+        self.assertFalse(db.ScopedGrant.revoke('organization', 'org1', 'x'))
+        self.assertEquals(set([('creator', 'id-b')]), db.ScopedGrant.get_by_user('x'))
+        self.assertEquals(set([('organization', 'org1')]), db.ScopedGrant.get_by_user('c'))
+
+    def test_delete_expired_scoped_grants(self):
+        now = datetime.datetime(2018, 6, 1)
+        db.ScopedGrant.grant('organization', 'org1', 'a', datetime.datetime(2018, 1, 1))
+        db.ScopedGrant.grant('organization', 'org2', 'a', datetime.datetime(2018, 2, 1))
+        db.ScopedGrant.grant('creator', 'id-a', 'b', datetime.datetime(2018, 7, 1))
+        db.ScopedGrant.grant('creator', 'id-a', 'c')
+
+        self.assertEquals(1, db.ScopedGrant.delete_expired(1, now))
+        self.assertEquals(1, db.ScopedGrant.delete_expired(1, now))
+        self.assertEquals(0, db.ScopedGrant.delete_expired(1, now))
+        table = db.scoped_grants_table
+        self.assertEquals([('b',), ('c',)], [tuple(row) for row in db.model.Session.execute(
+            sa.select([table.c.user_name]).order_by(table.c.user_name))])
+
+    def test_bundles(self):
+        bundle_id = db.Bundle.create('bundle', 'Bundle')
+        other_id = db.Bundle.create('other')
+
+        self.assertEquals((bundle_id, 'bundle', 'Bundle'), tuple(db.Bundle.get('bundle')))
+        self.assertEquals((bundle_id, 'bundle', 'Bundle'), tuple(db.Bundle.get(bundle_id)))
+        self.assertIsNone(db.Bundle.get('unknown'))
+
+        self.assertEquals((['pkg1', 'pkg2'], []), db.Bundle.set_packages(bundle_id, ['pkg2', 'pkg1']))
+        self.assertEquals((['pkg3'], ['pkg1']), db.Bundle.set_packages(bundle_id, ['pkg2', 'pkg3']))
+        db.Bundle.set_packages(other_id, ['pkg2'])
+
+        self.assertEquals(['pkg2', 'pkg3'], db.Bundle.get_package_ids(bundle_id))
+        self.assertEquals({'pkg2': [bundle_id, other_id], 'pkg3': [bundle_id]},
+                          dict((k, sorted(v, key=[bundle_id, other_id].index))
+                               for k, v in db.Bundle.get_by_package(['pkg1', 'pkg2', 'pkg3']).items()))
+        self.assertEquals({}, db.Bundle.get_by_package([]))
+
+        db.Bundle.update(bundle_id, name='renamed', title=None)
+        self.assertEquals((bundle_id, 'renamed', None), tuple(db.Bundle.get('renamed')))
+
+    def test_delete_bundle(self):
+        bundle_id = db.Bundle.create('bundle')
+        db.Bundle.set_packages(bundle_id, ['pkg1', 'pkg2'])
+        db.ScopedGrant.grant('bundle', bundle_id, 'a')
+        db.ScopedGrant.grant('organization', bundle_id, 'a')
+
+        self.assertEquals(['pkg1', 'pkg2'], db.Bundle.delete(bundle_id))
+
+        # Its datasets and its grants are also deleted
+        self.assertIsNone(db.Bundle.get(bundle_id))
+        self.assertEquals({}, db.Bundle.get_by_package(['pkg1', 'pkg2']))
+        self.assertEquals(set([('organization', bundle_id)]), db.ScopedGrant.get_by_user('a'))
+
+    def test_allowed_groups(self):
+        db.model.Session.execute(db.model.group_table.insert(), [{'id': 'g1', 'name': 'team'},
+                                                                 {'id': 'g2', 'name': 'partners'}])
+
+        self.assertEquals((['g1', 'g2'], []), db.AllowedGroup.set_groups('pkg1', ['g2', 'g1']))
+        self.assertEquals((['g1'], []), db.AllowedGroup.set_groups('pkg2', ['g1']))
+        self.assertEquals(([], ['g1']), db.AllowedGroup.set_groups('pkg1', ['g2']))
+        self.assertEquals(([], []), db.AllowedGroup.set_groups('pkg1', ['g2']))
+
+        self.assertEquals({'pkg1': ['g2'], 'pkg2': ['g1']},
+                          db.AllowedGroup.get_groups_by_package(['pkg1', 'pkg2', 'pkg3']))
+        self.assertEquals({}, db.AllowedGroup.get_groups_by_package([]))
+
+        # Groups are stored by id, so they are shown with their current names
+        db.model.Session.execute(db.model.group_table.update().values(name='renamed')
+                                 .where(db.model.group_table.c.id == 'g2'))
+        self.assertEquals(['renamed'], db.AllowedGroup.get_group_names('pkg1'))
+
+    def test_get_package_ids(self):
+        db.model.Session.execute(db.model.package_table.update().values(name='dataset')
+                                 .where(db.model.package_table.c.id == 'pkg2'))
+
+        self.assertEquals({'pkg1': 'pkg1', 'dataset': 'pkg2'}, db.get_package_ids(['pkg1', 'dataset', 'missing']))
+        self.assertEquals({}, db.get_package_ids([]))
+
+    def test_insert_ignore(self):
+        table = db.package_allowed_users_table
+        rows = [{'package_id': 'pkg1', 'user_name': 'a'}, {'package_id': 'pkg4', 'user_name': 'a'}]
+
+        # Stored rows are skipped instead of aborting the transaction
+        self.assertEquals([rows[1]], db._insert_ignore(table, rows))
+        self.assertEquals([], db._insert_ignore(table, rows))
+        self.assertEquals(sorted(self.GRANTS + [('pkg4', 'a')]), self._grants())
+
+    def test_set_groups_concurrent_insert(self):
+        table = db.package_allowed_groups_table
+        with patch.object(db.AllowedGroup, 'get_groups_by_package', return_value={}):
+            # Another transaction stored g1 after the current groups were read
+            db.model.Session.execute(table.insert().values(package_id='pkg1', group_id='g1'))
+            self.assertEquals((['g2'], []), db.AllowedGroup.set_groups('pkg1', ['g1', 'g2']))
+
+    def test_scoped_grant_concurrent_insert(self):
+        table = db.scoped_grants_table
+        update = MagicMock(rowcount=0)
+        execute = db.model.Session.execute
+
+        # Another transaction stores the grant between the update and the insert
+        def _execute(query, *args, **kwargs):
+            if isinstance(query, sa.sql.Update) and update.call_count == 0:
+                update()
+                execute(table.insert().values(scope='organization', target_id='org1', user_name='a'))
+                return update
+            return execute(query, *args, **kwargs)
+
+        db.model.Session.execute = MagicMock(side_effect=_execute)
+        self.assertFalse(db.ScopedGrant.grant('organization', 'org1', 'a', datetime.datetime(3000, 1, 1)))
+
+        # The expiry date of the stored grant is updated
+        self.assertEquals([(datetime.datetime(3000, 1, 1),)], [tuple(row) for row in execute(
+            sa.select([table.c.expires_at]))])
+
+
+class ConcurrentGrantsTest(unittest.TestCase):
+    '''Grants the same users from several threads, each one with its own connection'''
+
+    THREADS = 8
+    PACKAGES = ['pkg%d' % i for i in range(5)]
+    USERS = ['user%d' % i for i in range(20)]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = sa.create_engine('sqlite:///' + os.path.join(self.directory, 'test.db'),
+                                       connect_args={'timeout': 60})
+
+        self._model = db.model
+        db.model = MagicMock()
+        db.model.Session = orm.scoped_session(orm.sessionmaker(bind=self.engine))
+        db.model.user_table = self._model.user_table
+
+        for table in (db.model.user_table, db.package_allowed_users_table, db.scoped_grants_table):
+            table.create(bind=self.engine)
+
+        db.model.Session.execute(db.model.user_table.insert(),
+                                 [{'id': 'id-%s' % name, 'name': name} for name in self.USERS])
+        db.model.Session.commit()
+        db.model.Session.remove()
+
+    def tearDown(self):
+        db.model.Session.remove()
+        db.model = self._model
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def _run_threads(self, target):
+        results = []
+        errors = []
+
+        def _run(seed):
+            try:
+                results.extend(target(random.Random(seed)))
+                db.model.Session.commit()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                db.model.Session.remove()
+
+        threads = [threading.Thread(target=_run, args=(seed,)) for seed in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals([], errors)
+        return results
+
+    def test_bulk_grant(self):
+        grants = [(package_id, user_name) for package_id in self.PACKAGES for user_name in self.USERS]
+
+        # Every thread grants every pair, in its own order and in small transactions
+        def _grant(rnd):
+            pending = list(grants)
+            rnd.shuffle(pending)
+            inserted = []
+            while pending:
+                size = rnd.randint(1, 10)
+                inserted.extend(db.AllowedUser.bulk_grant(pending[:size]))
+                db.model.Session.commit()
+                pending = pending[size:]
+            return inserted
+
+        inserted = self._run_threads(_grant)
+
+        # No grant is lost, and each one is reported as inserted by a single thread
+        self.assertEquals(sorted(grants), sorted(inserted))
+        table = db.package_allowed_users_table
+        stored = db.model.Session.execute(sa.select([table.c.package_id, table.c.user_name, table.c.user_id]))
+        self.assertEquals(sorted((package_id, user_name, 'id-%s' % user_name) for package_id, user_name in grants),
+                          sorted(tuple(row) for row in stored))
+
+    def test_scoped_grants(self):
+        def _grant(rnd):
+            users = list(self.USERS)
+            rnd.shuffle(users)
+            created = []
+            for user_name in users:
+                if db.ScopedGrant.grant('organization', 'org1', user_name):
+                    created.append(user_name)
+                db.model.Session.commit()
+            return created
+
+        # Each grant is created once and the rest of the threads renew it
+        self.assertEquals(sorted(self.USERS), sorted(self._run_threads(_grant)))
+        self.assertEquals(len(self.USERS), db.model.Session.execute(
+            sa.select([sa.func.count()]).select_from(db.scoped_grants_table)).scalar())
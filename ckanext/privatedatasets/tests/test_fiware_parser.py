@@ -36,6 +36,29 @@ TEST_CASES = {
                 {"url": "http://localhost/dataset/ds2"}]},
         'result': {'users_datasets': [{'user': 'test', 'datasets': ['ds1', 'ds2']}]}
     },
+    'expires_at': {
+        'host': 'localhost',
+        'json': {"customer_name": "test", "resources": [{"url": "http://localhost/dataset/ds1"}],
+                 "expires_at": "2018-12-31T23:59:59Z"},
+        'result': {'users_datasets': [{'user': 'test', 'datasets': ['ds1'], 'expires_at': '2018-12-31T23:59:59Z'}]}
+    },
+    'organization_and_user': {
+        'host': 'localhost',
+        'json': {"customer_name": "test", "resources": [{"url": "http://localhost/dataset/ds1"},
+                {"url": "http://localhost/organization/conwet"}, {"url": "http://localhost/user/publisher"}]},
+        'result': {'users_datasets': [{'user': 'test', 'datasets': ['ds1'], 'organizations': ['conwet'],
+                                       'creators': ['publisher']}]}
+    },
+    'bundle': {
+        'host': 'localhost',
+        'json': {"customer_name": "test", "resources": [{"url": "http://localhost/bundle/premium"}]},
+        'result': {'users_datasets': [{'user': 'test', 'datasets': [], 'bundles': ['premium']}]}
+    },
+    'error_organization': {
+        'host': 'localhost',
+        'json': {"customer_name": "test", "resources": [{"url": "http://localhosta/organization/conwet"}]},
+        'error': 'Organization conwet is associated with the CKAN instance located at localhosta',
+    },
     'error': {
         'host': 'localhost',
         'json': {"customer_name": "test", "resources": [{"url": "http://localhosta/dataset/ds1"}]},
@@ -112,6 +135,10 @@ class FiWareParserTest(unittest.TestCase):
     @parameterized.expand([
         ('one_ds',),
         ('two_ds',),
+        ('expires_at',),
+        ('organization_and_user',),
+        ('bundle',),
+        ('error_organization',),
         ('error',),
         ('error_one_ds',),
         ('two_errors',),
@@ -36,18 +36,27 @@ class HelpersTest(unittest.TestCase):
         helpers.tk = MagicMock()
         helpers.tk.config = {}
 
-        self._db = helpers.db
-        helpers.db = MagicMock()
-
 
         self._request = helpers.request
         helpers.request = MagicMock()
 
+        self._cache = helpers.cache
+        helpers.cache = MagicMock()
+
+        self._i18n = helpers.i18n
+        helpers.i18n = MagicMock()
+        helpers.i18n.get_lang.return_value = 'en'
+
+        self._acquire_buttons = helpers.acquire_buttons
+        helpers.acquire_buttons = self._cache.LRUCache()
+
     def tearDown(self):
         helpers.model = self._model
         helpers.tk = self._tk
-        helpers.db = self._db
         helpers.request = self._request
+        helpers.cache = self._cache
+        helpers.i18n = self._i18n
+        helpers.acquire_buttons = self._acquire_buttons
 
     @parameterized.expand([
         (False, 'user', False),
@@ -60,20 +69,16 @@ class HelpersTest(unittest.TestCase):
         helpers.tk.c.user = user
         pkg_dict = {'id': 'package_id'}
 
-        db_response = []
-        if db_acquired is True:
-            out = helpers.db.AllowedUser()
-            out.package_id = 'package_id'
-            out.user_name = user
-            db_response.append(out)
-
-        helpers.db.AllowedUser.get = MagicMock(return_value=db_response)
+        helpers.cache.is_granted.return_value = db_acquired
 
         # Check the function returns the expected result
         self.assertEquals(acquired, helpers.is_dataset_acquired(pkg_dict))
 
-        # Check that the database has been initialized properly
-        helpers.db.init_db.assert_called_once_with(helpers.model)
+        # Anonymous users cannot acquire datasets
+        if user:
+            helpers.cache.is_granted.assert_called_once_with('package_id', user)
+        else:
+            self.assertEquals(0, helpers.cache.is_granted.call_count)
 
     @parameterized.expand([
         (1, 1,    True),
@@ -128,62 +133,15 @@ class HelpersTest(unittest.TestCase):
         helpers.tk.check_access.assert_called_once_with('package_show', context, package)
 
     @parameterized.expand([
-        (None,    False, None),
-        ('True',  True,  None),
-        ('False', False, None),
-        ('afa  ', False, None),
-        (True,    True,  None),
-        (False,   False, None),
-        (False,   True , 'true'),
-        (False,   True , 'on'),
-        (False,   True , '1'),
-        (True,    False, '0'),
-        (True,    False, 'off'),
-        (True,    False, 'fAlsE'),
-        (True,    False, 'fAlsE'),
+        ('show_acquire_url_on_create', True),
+        ('show_acquire_url_on_create', False),
+        ('show_acquire_url_on_edit',   True),
+        ('show_acquire_url_on_edit',   False),
     ])
-    @patch("ckanext.privatedatasets.helpers.os.environ", new={})
-    def test_show_acquire_url_on_create(self, config_value, expected_value, env_val):
-        # {} is shared between tests, so we have clear it each time
-        helpers.os.environ.clear()
-
-        if config_value is not None:
-            helpers.tk.config['ckan.privatedatasets.show_acquire_url_on_create'] = config_value
-
-        if env_val:
-            helpers.os.environ['CKAN_PRIVATEDATASETS_SHOW_ACQUIRE_URL_ON_CREATE'] = env_val
-
-        # Call the function
-        self.assertEquals(expected_value, helpers.show_acquire_url_on_create())
-
-    @parameterized.expand([
-        (None,    False, None),
-        ('True',  True,  None),
-        (' tRUe', True,  None),
-        ('False', False, None),
-        (True,    True,  None),
-        (False,   False, None),
-        (False,   True , 'trUe'),
-        (False,   True , 'on'),
-        (False,   True , '1'),
-        (True,    False, '0'),
-        (True,    False, 'off'),
-        (True,    False, 'fAlsE'),
-        (True,    False, 'potato'),
-    ])
-    @patch("ckanext.privatedatasets.helpers.os.environ", new={})
-    def test_show_acquire_url_on_edit(self, config_value, expected_value, env_val):
-        # {} is shared between tests, so we have clear it each time
-        helpers.os.environ.clear()
-
-        if config_value is not None:
-            helpers.tk.config['ckan.privatedatasets.show_acquire_url_on_edit'] = config_value
-
-        if env_val:
-            helpers.os.environ['CKAN_PRIVATEDATASETS_SHOW_ACQUIRE_URL_ON_EDIT'] = env_val
-
-        # Call the function
-        self.assertEquals(expected_value, helpers.show_acquire_url_on_edit())
+    def test_show_acquire_url(self, function_name, value):
+        with patch.object(helpers.settings, 'get') as get_settings:
+            setattr(get_settings.return_value, function_name, value)
+            self.assertEquals(value, getattr(helpers, function_name)())
 
     @parameterized.expand([
         ({}, '/dataset', False),
@@ -205,3 +163,85 @@ class HelpersTest(unittest.TestCase):
             self.assertEquals(result, helpers.tk.render_snippet.return_value)
         else:
             self.assertEquals(result, '')
+
+    def test_acquire_button_cached(self):
+        helpers.request.path = '/dataset'
+        helpers.tk.render_snippet.side_effect = lambda snippet, data: 'button-%s' % data['url_dest']
+
+        for _ in range(3):
+            self.assertEquals('button-http://a.org', helpers.acquire_button({'acquire_url': 'http://a.org'}))
+        self.assertEquals('button-http://b.org', helpers.acquire_button({'acquire_url': 'http://b.org'}))
+
+        # The button is rendered again for other languages
+        helpers.i18n.get_lang.return_value = 'es'
+        self.assertEquals('button-http://a.org', helpers.acquire_button({'acquire_url': 'http://a.org'}))
+
+        self.assertEquals(3, helpers.tk.render_snippet.call_count)
+        self.assertEquals(2, helpers.acquire_buttons.hits)
+        self.assertEquals(3, helpers.acquire_buttons.misses)
+
+    @parameterized.expand([
+        # Anonymous user
+        (None,   False, {'pkg1': False, 'pkg2': True}, set(),    {'pkg1': False, 'pkg2': True}),
+        # Regular users
+        ('user', False, {'pkg1': False, 'pkg2': True}, set(),    {'pkg1': False, 'pkg2': True}),
+        ('user', False, {'pkg1': True,  'pkg2': True}, {'pkg1'}, {'pkg1': True,  'pkg2': True}),
+        # Sysadmins can read every package
+        ('user', True,  {'pkg1': False, 'pkg2': False}, set(),   {'pkg1': True,  'pkg2': True}),
+    ])
+    def test_get_package_list_flags(self, user, sysadmin, auth_results, granted, expected_readable):
+        helpers.tk.c.user = user
+        helpers.tk.c.userobj = MagicMock()
+        helpers.tk.c.userobj.id = 'creator'
+        helpers.tk.ObjectNotFound = self._tk.ObjectNotFound
+        helpers.tk.NotAuthorized = self._tk.NotAuthorized
+        helpers.cache.get_user_meta.return_value = MagicMock(sysadmin=sysadmin)
+        helpers.cache.get_acquired_package_ids.side_effect = lambda package_ids, user_name: granted.intersection(package_ids)
+
+        def _check_access(action, context, data_dict):
+            if not auth_results[data_dict['id']]:
+                raise self._tk.NotAuthorized()
+            return True
+
+        helpers.tk.check_access.side_effect = _check_access
+
+        packages = [
+            {'id': 'pkg1', 'creator_user_id': 'other', 'acquire_url': 'http://example.com'},
+            {'id': 'pkg2', 'creator_user_id': 'creator'}
+        ]
+
+        flags = helpers.get_package_list_flags(packages)
+
+        # The data of every package is loaded at once
+        helpers.cache.prefetch.assert_called_once_with(['pkg1', 'pkg2'], user)
+        helpers.cache.get_acquired_package_ids.assert_called_once_with(['pkg1', 'pkg2'], user)
+
+        self.assertEquals({
+            'pkg1': {'acquired': 'pkg1' in granted, 'owner': False, 'readable': expected_readable['pkg1'],
+                     'acquire_url': 'http://example.com'},
+            'pkg2': {'acquired': 'pkg2' in granted, 'owner': True, 'readable': expected_readable['pkg2'],
+                     'acquire_url': ''}
+        }, flags)
+
+        # Access is checked through CKAN, so other plugins can override the auth function
+        if sysadmin:
+            self.assertEquals(0, helpers.tk.check_access.call_count)
+        else:
+            self.assertEquals(['package_show', 'package_show'],
+                              [args[0] for args, _ in helpers.tk.check_access.call_args_list])
+
+    def test_get_acquired_package_ids(self):
+        helpers.tk.c.user = 'user'
+        helpers.cache.get_acquired_package_ids.return_value = frozenset(['pkg2'])
+
+        self.assertEquals(frozenset(['pkg2']), helpers.get_acquired_package_ids([{'id': 'pkg1'}, {'id': 'pkg2'}]))
+        helpers.cache.get_acquired_package_ids.assert_called_once_with(['pkg1', 'pkg2'], 'user')
+
+    def test_get_package_list_flags_not_found(self):
+        helpers.tk.c.user = None
+        helpers.tk.ObjectNotFound = self._tk.ObjectNotFound
+        helpers.tk.NotAuthorized = self._tk.NotAuthorized
+        helpers.tk.check_access.side_effect = self._tk.ObjectNotFound()
+
+        flags = helpers.get_package_list_flags([{'id': 'pkg1', 'creator_user_id': 'other'}])
+        self.assertFalse(flags['pkg1']['readable'])
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import threading
+import unittest
+
+from mock import MagicMock, patch
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+import ckanext.privatedatasets.db as db
+import ckanext.privatedatasets.indexer as indexer
+from ckanext.privatedatasets.tests.fake_solr import FakeSolr
+
+SITE_ID = 'site'
+
+
+def _index_id(package_id):
+    return hashlib.md5(('%s%s' % (package_id, SITE_ID)).encode('utf-8')).hexdigest()
+
+
+class IndexerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tk = indexer.tk
+        indexer.tk = MagicMock()
+        indexer.tk.config = {'ckan.site_id': SITE_ID}
+
+        self._db = indexer.db
+        indexer.db = MagicMock()
+        indexer.db.AllowedUser.count_by_package.side_effect = lambda package_ids: dict(
+            (package_id, 2) for package_id in package_ids)
+
+        self.solr = FakeSolr().start()
+        self.labels_indexer = indexer.PermissionLabelsIndexer(solr_url=self.solr.url, commit_within=500, batch_size=3)
+
+    def tearDown(self):
+        indexer.tk = self._tk
+        indexer.db = self._db
+        self.solr.stop()
+
+    def test_add_labels_outside_batch(self):
+        self.labels_indexer.add_labels('pkg1', ['allowed-a', 'allowed-b'])
+
+        self.assertEquals(1, len(self.solr.requests))
+        request = self.solr.requests[0]
+        self.assertEquals('/solr/ckan/update', request['path'])
+        self.assertEquals('500', request['params']['commitWithin'])
+        self.assertEquals([{'index_id': _index_id('pkg1'),
+                            'permission_labels': {'add-distinct': ['allowed-a', 'allowed-b']},
+                            'vocab_privatedatasets_grantees': {'add-distinct': ['allowed-a', 'allowed-b']},
+                            'privatedatasets_acquirers_i': {'set': 2}}], request['body'])
+
+        # The acquirers are counted again, since the labels may have already been indexed
+        indexer.db.AllowedUser.count_by_package.assert_called_once_with(['pkg1'])
+
+    def test_remove_labels_outside_batch(self):
+        self.labels_indexer.remove_labels('pkg1', ['allowed-a'])
+
+        self.assertEquals(1, len(self.solr.requests))
+        self.assertEquals([{'index_id': _index_id('pkg1'),
+                            'permission_labels': {'remove': ['allowed-a']},
+                            'vocab_privatedatasets_grantees': {'remove': ['allowed-a']},
+                            'privatedatasets_acquirers_i': {'set': 2}}], self.solr.requests[0]['body'])
+
+    def test_remove_last_acquirer(self):
+        indexer.db.AllowedUser.count_by_package.side_effect = lambda package_ids: {}
+        self.labels_indexer.remove_labels('pkg1', ['allowed-a'])
+
+        # The count never goes below zero, even if the label had already been removed
+        self.assertEquals({'set': 0}, self.solr.requests[0]['body'][0]['privatedatasets_acquirers_i'])
+
+    def test_labels_not_counted_as_acquirers(self):
+        self.labels_indexer.add_labels('pkg1', ['allowed_group-g1'], acquirers=False)
+
+        self.assertEquals([{'index_id': _index_id('pkg1'),
+                            'permission_labels': {'add-distinct': ['allowed_group-g1']},
+                            'vocab_privatedatasets_grantees': {'add-distinct': ['allowed_group-g1']}}],
+                          self.solr.requests[0]['body'])
+        self.assertEquals(0, indexer.db.AllowedUser.count_by_package.call_count)
+
+    def test_batch_sends_one_request(self):
+        with indexer.batch():
+            self.labels_indexer.add_labels('pkg1', ['allowed-a'])
+            self.labels_indexer.add_labels('pkg2', ['allowed-a'])
+            self.labels_indexer.remove_labels('pkg1', ['allowed-b'])
+            self.assertEquals(0, len(self.solr.requests))
+
+        self.assertEquals(1, len(self.solr.requests))
+        docs = sorted(self.solr.requests[0]['body'], key=lambda doc: doc['index_id'])
+        expected = sorted([
+            {'index_id': _index_id('pkg1'),
+             'permission_labels': {'add-distinct': ['allowed-a'], 'remove': ['allowed-b']},
+             'vocab_privatedatasets_grantees': {'add-distinct': ['allowed-a'], 'remove': ['allowed-b']},
+             'privatedatasets_acquirers_i': {'set': 2}},
+            {'index_id': _index_id('pkg2'),
+             'permission_labels': {'add-distinct': ['allowed-a']},
+             'vocab_privatedatasets_grantees': {'add-distinct': ['allowed-a']},
+             'privatedatasets_acquirers_i': {'set': 2}}
+        ], key=lambda doc: doc['index_id'])
+        self.assertEquals(expected, docs)
+
+    def test_batch_discarded_on_error(self):
+        with self.assertRaises(ValueError):
+            with indexer.batch():
+                self.labels_indexer.add_labels('pkg1', ['allowed-a'])
+                raise ValueError()
+
+        # The changes of the block have been rolled back, so they are not sent
+        self.assertEquals(0, len(self.solr.requests))
+        with indexer.batch():
+            self.labels_indexer.add_labels('pkg2', ['allowed-b'])
+        self.assertEquals([_index_id('pkg2')], [doc['index_id'] for doc in self.solr.requests[0]['body']])
+
+    def test_batch_last_operation_prevails(self):
+        with indexer.batch():
+            self.labels_indexer.add_labels('pkg1', ['allowed-a'])
+            self.labels_indexer.remove_labels('pkg1', ['allowed-a'])
+
+        # The acquirers are counted once the changes have been applied
+        self.assertEquals([{'index_id': _index_id('pkg1'),
+                            'permission_labels': {'remove': ['allowed-a']},
+                            'vocab_privatedatasets_grantees': {'remove': ['allowed-a']},
+                            'privatedatasets_acquirers_i': {'set': 2}}], self.solr.requests[0]['body'])
+
+    def test_batch_flushed_when_full(self):
+        with indexer.batch():
+            for i in range(4):
+                self.labels_indexer.add_labels('pkg%d' % i, ['allowed-a'])
+            self.assertEquals(1, len(self.solr.requests))
+            self.assertEquals(3, len(self.solr.requests[0]['body']))
+
+        self.assertEquals(2, len(self.solr.requests))
+        self.assertEquals(1, len(self.solr.requests[1]['body']))
+
+    def test_nested_batches(self):
+        with indexer.batch():
+            with indexer.batch():
+                self.labels_indexer.add_labels('pkg1', ['allowed-a'])
+            self.assertEquals(0, len(self.solr.requests))
+
+        self.assertEquals(1, len(self.solr.requests))
+
+    def test_reindex_after_batch(self):
+        reindex = MagicMock()
+        indexer.reindex_after_batch(reindex, 'pkg1')
+        reindex.assert_called_once_with(['pkg1'])
+
+        reindex.reset_mock()
+        with indexer.batch():
+            for package_id in ('pkg1', 'pkg2', 'pkg1'):
+                indexer.reindex_after_batch(reindex, package_id)
+            self.assertEquals(0, reindex.call_count)
+
+        # Datasets are reindexed once, when the block ends
+        reindex.assert_called_once_with(['pkg1', 'pkg2'])
+
+    def test_reindex_after_batch_discarded_on_error(self):
+        reindex = MagicMock()
+        with self.assertRaises(ValueError):
+            with indexer.batch():
+                indexer.reindex_after_batch(reindex, 'pkg1')
+                raise ValueError()
+
+        self.assertEquals(0, reindex.call_count)
+        with indexer.batch():
+            indexer.reindex_after_batch(reindex, 'pkg2')
+        reindex.assert_called_once_with(['pkg2'])
+
+    def test_solr_error(self):
+        self.solr.status = 500
+        self.assertRaises(indexer.SearchIndexError, self.labels_indexer.add_labels, 'pkg1', ['allowed-a'])
+
+
+class PrefetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self._db = indexer.db
+        indexer.db = MagicMock()
+        indexer.clear_prefetched()
+
+    def tearDown(self):
+        indexer.db = self._db
+        indexer.clear_prefetched()
+
+    def test_prefetched_grants(self):
+        # User b has not signed up yet, so it is labelled by name
+        indexer.db.AllowedUser.get_users_by_package.return_value = {'pkg1': [('id-a', 'a'), (None, 'b')]}
+        indexer.db.Bundle.get_by_package.return_value = {'pkg2': ['bundle']}
+        indexer.db.AllowedGroup.get_groups_by_package.return_value = {'pkg1': ['g1']}
+
+        indexer.prefetch_allowed_users(['pkg1', 'pkg2'])
+        indexer.db.AllowedUser.get_users_by_package.assert_called_once_with(['pkg1', 'pkg2'], with_ids=True)
+        indexer.db.Bundle.get_by_package.assert_called_once_with(['pkg1', 'pkg2'])
+        indexer.db.AllowedGroup.get_groups_by_package.assert_called_once_with(['pkg1', 'pkg2'])
+
+        for keep in (True, False, False):
+            self.assertEquals({'user_labels': ['allowed-id-a', 'allowed_name-b'], 'group_ids': ['g1'], 'bundle_ids': []},
+                              indexer.get_grants('pkg1', keep=keep))
+            self.assertEquals({'user_labels': [], 'group_ids': [], 'bundle_ids': ['bundle']},
+                              indexer.get_grants('pkg2', keep=keep))
+
+        self.assertEquals(1, indexer.db.AllowedUser.get_users_by_package.call_count)
+        self.assertEquals(1, indexer.db.Bundle.get_by_package.call_count)
+        self.assertEquals(1, indexer.db.AllowedGroup.get_groups_by_package.call_count)
+
+    def test_grants_not_prefetched(self):
+        indexer.db.AllowedUser.get_users_by_package.return_value = {'pkg1': [('id-a', 'a')]}
+
+        # Grants are not kept between calls, so they are never outdated
+        self.assertEquals(['allowed-id-a'], indexer.get_grants('pkg1')['user_labels'])
+        self.assertEquals(['allowed-id-a'], indexer.get_grants('pkg1')['user_labels'])
+        self.assertEquals(2, indexer.db.AllowedUser.get_users_by_package.call_count)
+        indexer.db.AllowedUser.get_users_by_package.assert_called_with(['pkg1'], with_ids=True)
+        indexer.db.Bundle.get_by_package.assert_called_with(['pkg1'])
+        indexer.db.AllowedGroup.get_groups_by_package.assert_called_with(['pkg1'])
+
+    def test_kept_grants(self):
+        indexer.db.AllowedUser.get_users_by_package.return_value = {'pkg1': [('id-a', 'a')]}
+
+        # Kept grants are only used by the next call for the same dataset
+        grants = indexer.get_grants('pkg1', keep=True)
+        self.assertIs(grants, indexer.get_grants('pkg1'))
+        self.assertIsNot(grants, indexer.get_grants('pkg1'))
+        self.assertEquals(2, indexer.db.AllowedUser.get_users_by_package.call_count)
+
+        indexer.get_grants('pkg1', keep=True)
+        indexer.get_grants('pkg2')
+        indexer.get_grants('pkg1')
+        self.assertEquals(5, indexer.db.AllowedUser.get_users_by_package.call_count)
+
+        # Grants are always loaded again when they are going to be kept
+        indexer.get_grants('pkg1', keep=True)
+        indexer.get_grants('pkg1', keep=True)
+        self.assertEquals(7, indexer.db.AllowedUser.get_users_by_package.call_count)
+
+    def test_clear_prefetched(self):
+        indexer.db.AllowedUser.get_users_by_package.return_value = {'pkg1': [('id-a', 'a')]}
+
+        indexer.prefetch_allowed_users(['pkg1'])
+        indexer.get_grants('pkg2', keep=True)
+        indexer.clear_prefetched()
+
+        indexer.db.AllowedUser.get_users_by_package.return_value = {}
+        self.assertEquals([], indexer.get_grants('pkg1')['user_labels'])
+        indexer.get_grants('pkg2')
+        self.assertEquals(4, indexer.db.AllowedUser.get_users_by_package.call_count)
+
+
+class GrantsQueriesTest(unittest.TestCase):
+    '''Counts the queries run against an in-memory SQLite database to index a dataset'''
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://')
+        self.statements = []
+        sa.event.listen(self.engine, 'before_cursor_execute',
+                        lambda conn, cursor, statement, *args: self.statements.append(statement))
+
+        self._model = db.model
+        db.model = MagicMock()
+        db.model.Session = orm.scoped_session(orm.sessionmaker(bind=self.engine))
+        db.model.user_table = self._model.user_table
+        db.model.package_table = self._model.package_table
+
+        for table in (db.model.user_table, db.package_allowed_users_table, db.package_allowed_groups_table,
+                      db.bundles_table, db.bundle_packages_table):
+            table.create(bind=self.engine)
+
+        db.model.Session.execute(db.model.user_table.insert().values(id='id-a', name='a'))
+        db.model.Session.execute(db.package_allowed_users_table.insert(), [
+            {'package_id': 'pkg1', 'user_name': 'a', 'user_id': 'id-a'},
+            {'package_id': 'pkg1', 'user_name': 'b', 'user_id': None}])
+        db.model.Session.execute(db.package_allowed_groups_table.insert().values(package_id='pkg1', group_id='g1'))
+        db.Bundle.set_packages(db.Bundle.create('bundle'), ['pkg1'])
+
+        indexer.clear_prefetched()
+        del self.statements[:]
+
+    def tearDown(self):
+        indexer.clear_prefetched()
+        db.model.Session.remove()
+        db.model = self._model
+        self.engine.dispose()
+
+    def test_grants_loaded_once_per_dataset(self):
+        # before_index keeps the grants it loads for get_dataset_labels
+        grants = indexer.get_grants('pkg1', keep=True)
+        self.assertEquals(3, len(self.statements))
+        self.assertEquals(grants, indexer.get_grants('pkg1'))
+        self.assertEquals(3, len(self.statements))
+
+        self.assertEquals(['allowed-id-a', 'allowed_name-b'], grants['user_labels'])
+        self.assertEquals(['g1'], grants['group_ids'])
+        self.assertEquals(1, len(grants['bundle_ids']))
+
+        # The next dataset loads its own grants
+        indexer.get_grants('pkg2', keep=True)
+        indexer.get_grants('pkg2')
+        self.assertEquals(6, len(self.statements))
+
+    def test_prefetched_grants(self):
+        indexer.prefetch_allowed_users(['pkg1', 'pkg2', 'pkg3'])
+        self.assertEquals(3, len(self.statements))
+
+        for package_id in ('pkg1', 'pkg2', 'pkg3'):
+            indexer.get_grants(package_id, keep=True)
+            indexer.get_grants(package_id)
+        self.assertEquals(3, len(self.statements))
+
+
+class ReindexQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self._atexit = indexer.atexit
+        indexer.atexit = MagicMock()
+
+        self._model = indexer.model
+        indexer.model = MagicMock()
+
+        self.reindex = MagicMock()
+        self.queue = indexer.ReindexQueue(self.reindex, max_size=3, max_delay=10)
+
+    def tearDown(self):
+        indexer.atexit = self._atexit
+        indexer.model = self._model
+
+    @patch('ckanext.privatedatasets.indexer.threading.Timer')
+    def test_coalesce(self, timer):
+        for package_id in ['pkg2', 'pkg1', 'pkg2', 'pkg2', 'pkg1']:
+            self.queue.add(package_id)
+
+        # Repeated datasets are only queued once and a single timer is started
+        self.assertEquals(2, len(self.queue))
+        self.assertEquals(0, self.reindex.call_count)
+        timer.assert_called_once_with(10, self.queue._flush_later)
+        timer.return_value.start.assert_called_once_with()
+
+        self.queue.flush()
+        self.reindex.assert_called_once_with(['pkg1', 'pkg2'])
+        timer.return_value.cancel.assert_called_once_with()
+        self.assertEquals(0, len(self.queue))
+
+        # Nothing is reindexed when the queue is empty
+        self.queue.flush()
+        self.assertEquals(1, self.reindex.call_count)
+
+    @patch('ckanext.privatedatasets.indexer.threading.Timer')
+    def test_flush_when_full(self, timer):
+        for package_id in ['pkg1', 'pkg2', 'pkg3', 'pkg4']:
+            self.queue.add(package_id)
+
+        self.reindex.assert_called_once_with(['pkg1', 'pkg2', 'pkg3'])
+        self.assertEquals(1, len(self.queue))
+
+        # The timer of the flushed datasets is cancelled and a new one is started
+        self.assertEquals(2, timer.call_count)
+        timer.return_value.cancel.assert_called_once_with()
+
+    @patch('ckanext.privatedatasets.indexer.time')
+    @patch('ckanext.privatedatasets.indexer.threading.Timer')
+    def test_flush_overdue(self, timer, time):
+        # The timer never runs, so the datasets are reindexed when another one is queued after the delay
+        time.time.return_value = 100
+        self.queue.add('pkg1')
+        time.time.return_value = 109
+        self.queue.add('pkg1')
+        self.assertEquals(0, self.reindex.call_count)
+
+        time.time.return_value = 110
+        self.queue.add('pkg2')
+        self.reindex.assert_called_once_with(['pkg1', 'pkg2'])
+        self.assertEquals(0, len(self.queue))
+
+        # The delay of the next datasets starts when they are queued
+        time.time.return_value = 115
+        self.queue.add('pkg3')
+        self.assertEquals(1, self.reindex.call_count)
+        self.assertEquals(1, len(self.queue))
+
+    def test_flush_on_exit(self):
+        indexer.atexit.register.assert_called_once_with(self.queue.flush)
+
+    def test_flush_later(self):
+        flushed = threading.Event()
+        self.reindex.side_effect = lambda package_ids: flushed.set()
+        queue = indexer.ReindexQueue(self.reindex, max_size=3, max_delay=0.01)
+
+        queue.add('pkg1')
+        timer = queue._timer
+        self.assertTrue(flushed.wait(5))
+        timer.join(5)
+
+        # Datasets are reindexed by the timer thread, which removes its session
+        self.reindex.assert_called_once_with(['pkg1'])
+        indexer.model.Session.remove.assert_called_once_with()
+
+    def test_flush_later_error(self):
+        self.reindex.side_effect = Exception('Solr is down')
+        self.queue.add('pkg1')
+        self.queue._timer.cancel()
+
+        # Errors are logged, and the session of the timer thread is always removed
+        self.queue._flush_later()
+        self.reindex.assert_called_once_with(['pkg1'])
+        indexer.model.Session.remove.assert_called_once_with()
+        self.assertEquals(0, len(self.queue))
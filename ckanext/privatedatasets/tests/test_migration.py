@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from mock import DEFAULT, MagicMock, patch
+from parameterized import parameterized
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+import ckanext.privatedatasets.migration as migration
+from ckanext.privatedatasets.tests import postgresql as test_postgresql
+
+
+class MigrationTest(unittest.TestCase):
+    '''Runs the migrations against an in-memory SQLite database'''
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://')
+        self.engine.execute('CREATE TABLE "user" (id TEXT PRIMARY KEY, name TEXT)')
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def _tables(self):
+        return sorted(sa.inspect(self.engine).get_table_names())
+
+    def _indexes(self):
+        return sorted(index['name'] for index in sa.inspect(self.engine).get_indexes('package_allowed_users'))
+
+    def _version(self):
+        with self.engine.connect() as connection:
+            return migration.get_current_version(connection)
+
+    def test_get_migrations(self):
+        migrations = migration.get_migrations()
+
+        self.assertEquals([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], [m.version for m in migrations])
+        self.assertEquals(10, migration.get_head_version(migrations))
+
+        # Indexes are created concurrently, so they cannot be run in a transaction
+        self.assertEquals([True, False, True, False, True, False, True, True, True, False], [m.transactional for m in migrations])
+
+    def test_get_head_version_no_migrations(self):
+        self.assertEquals(0, migration.get_head_version([]))
+
+    def test_upgrade(self):
+        self.assertEquals(0, self._version())
+        self.assertEquals(10, migration.migrate(self.engine))
+
+        self.assertEquals(['package_allowed_groups', 'package_allowed_users', 'privatedatasets_bundle_packages',
+                           'privatedatasets_bundles', migration.VERSION_TABLE, 'privatedatasets_scoped_grants',
+                           'user'], self._tables())
+        self.assertEquals(['idx_package_allowed_users_expires_at', 'idx_package_allowed_users_user_id',
+                           'idx_package_allowed_users_user_name'], self._indexes())
+        self.assertEquals(10, self._version())
+
+        # Running the migrations again does nothing
+        self.assertEquals(10, migration.migrate(self.engine))
+        self.assertEquals(10, self._version())
+
+    def test_upgrade_existing_table(self):
+        # Tables created by previous versions of the extension are kept
+        self.engine.execute('CREATE TABLE package_allowed_users (package_id TEXT, user_name TEXT)')
+        self.engine.execute("INSERT INTO package_allowed_users VALUES ('pkg', 'user'), ('pkg', 'unknown')")
+        self.engine.execute("INSERT INTO \"user\" VALUES ('user-id', 'user')")
+
+        self.assertEquals(10, migration.migrate(self.engine))
+
+        # The ids of the existing users are filled
+        self.assertEquals([('pkg', 'unknown', None, None), ('pkg', 'user', 'user-id', None)],
+                          list(self.engine.execute('SELECT * FROM package_allowed_users ORDER BY user_name')))
+
+    def test_fill_user_id_in_batches(self):
+        self.assertEquals(2, migration.migrate(self.engine, 2))
+        self.engine.execute("INSERT INTO \"user\" VALUES ('id-a', 'a'), ('id-b', 'b'), ('id-c', 'c')")
+        for package_id in ('pkg1', 'pkg2'):
+            for user_name in ('a', 'b', 'c', 'unknown'):
+                self.engine.execute("INSERT INTO package_allowed_users VALUES ('%s', '%s')" % (package_id, user_name))
+
+        fill = next(m for m in migration.get_migrations() if m.version == 10).module
+        with patch.object(fill, 'BATCH_SIZE', 2), patch.object(fill, '_fill', wraps=fill._fill) as _fill:
+            self.assertEquals(10, migration.migrate(self.engine))
+
+        # Each batch is committed on its own, and the grants of unknown users do not prevent the loop from ending
+        self.assertEquals(4, _fill.call_count)
+        self.assertEquals([('a', 'id-a'), ('b', 'id-b'), ('c', 'id-c'), ('unknown', None)] * 2,
+                          list(self.engine.execute('SELECT user_name, user_id FROM package_allowed_users '
+                                                   'ORDER BY package_id, user_name')))
+
+    @parameterized.expand([
+        (8, ['package_allowed_users', 'privatedatasets_bundle_packages', 'privatedatasets_bundles',
+             migration.VERSION_TABLE, 'privatedatasets_scoped_grants', 'user'], None),
+        (7, ['package_allowed_users', migration.VERSION_TABLE, 'privatedatasets_scoped_grants', 'user'], None),
+        (6, ['package_allowed_users', migration.VERSION_TABLE, 'user'], ['idx_package_allowed_users_expires_at',
+                                                                          'idx_package_allowed_users_user_id',
+                                                                          'idx_package_allowed_users_user_name']),
+        (2, ['package_allowed_users', migration.VERSION_TABLE, 'user'], ['idx_package_allowed_users_user_name']),
+        (1, ['package_allowed_users', migration.VERSION_TABLE, 'user'], []),
+        (0, [migration.VERSION_TABLE, 'user'], None),
+    ])
+    def test_downgrade(self, target, expected_tables, expected_indexes):
+        migration.migrate(self.engine)
+
+        self.assertEquals(target, migration.migrate(self.engine, target))
+
+        self.assertEquals(expected_tables, self._tables())
+        self.assertEquals(target, self._version())
+        if expected_indexes is not None:
+            self.assertEquals(expected_indexes, self._indexes())
+
+    def test_upgrade_step_by_step(self):
+        self.assertEquals(1, migration.migrate(self.engine, 1))
+        self.assertEquals([], self._indexes())
+
+        self.assertEquals(2, migration.migrate(self.engine, 2))
+        self.assertEquals(['idx_package_allowed_users_user_name'], self._indexes())
+
+        self.assertEquals(10, migration.migrate(self.engine))
+        columns = [column['name'] for column in sa.inspect(self.engine).get_columns('package_allowed_users')]
+        self.assertEquals(['package_id', 'user_name', 'user_id', 'expires_at'], columns)
+
+    def test_unknown_version(self):
+        self.assertRaises(ValueError, migration.migrate, self.engine, 42)
+        self.assertEquals(0, self._version())
+
+    def test_failed_migration_is_rolled_back(self):
+        self.engine.execute('CREATE TABLE other (id INTEGER)')
+        module = MagicMock(transactional=True)
+        module.upgrade.side_effect = lambda op: (op.execute('INSERT INTO other VALUES (1)'),
+                                                 op.execute('INVALID SQL'))
+        migrations = [migration.Migration(1, '001_invalid', module)]
+
+        with patch('ckanext.privatedatasets.migration.get_migrations', return_value=migrations):
+            self.assertRaises(sa.exc.DBAPIError, migration.migrate, self.engine)
+
+        # Neither the changes nor the version are stored
+        self.assertEquals(0, self._version())
+        self.assertEquals([], list(self.engine.execute('SELECT * FROM other')))
+
+    def _postgresql_engine(self):
+        engine = MagicMock()
+        engine.connect.return_value.__enter__.return_value.dialect.name = 'postgresql'
+        return engine
+
+    def _autocommit_connection(self, engine):
+        return engine.connect.return_value.__enter__.return_value.execution_options.return_value
+
+    def _executed_sql(self, engine):
+        connection = self._autocommit_connection(engine)
+        return [str(args[0].compile(dialect=postgresql.dialect())) for args, _ in connection.execute.call_args_list]
+
+    @patch.multiple(migration, version_table=DEFAULT, get_migrations=DEFAULT, get_current_version=DEFAULT)
+    def test_migrate_lock(self, version_table, get_migrations, get_current_version):
+        get_migrations.return_value = []
+        get_current_version.return_value = 0
+        engine = self._postgresql_engine()
+
+        migration.migrate(engine)
+
+        # The lock is taken and released in autocommit mode, and the version is read while it is held
+        connection = engine.connect.return_value.__enter__.return_value
+        connection.execution_options.assert_called_once_with(isolation_level='AUTOCOMMIT')
+        statements = self._executed_sql(engine)
+        self.assertEquals(2, len(statements))
+        self.assertIn('pg_advisory_lock', statements[0])
+        self.assertIn('pg_advisory_unlock', statements[1])
+        get_current_version.assert_called_once_with(self._autocommit_connection(engine))
+
+    @patch.multiple(migration, version_table=DEFAULT, get_migrations=DEFAULT, get_current_version=DEFAULT,
+                    _run=DEFAULT)
+    def test_migrate_connections(self, version_table, get_migrations, get_current_version, _run):
+        get_migrations.return_value = [migration.Migration(1, '001_table', MagicMock(transactional=True)),
+                                       migration.Migration(2, '002_index', MagicMock(transactional=False))]
+        get_current_version.return_value = 0
+        engine = self._postgresql_engine()
+
+        self.assertEquals(2, migration.migrate(engine))
+
+        # Only the migrations that cannot be run in a transaction use the autocommit connection
+        connection = engine.connect.return_value.__enter__.return_value
+        self.assertEquals([connection, self._autocommit_connection(engine)],
+                          [args[0] for args, _ in _run.call_args_list])
+
+    @patch.multiple(migration, version_table=DEFAULT, get_migrations=DEFAULT, get_current_version=DEFAULT)
+    def test_migrate_lock_released_on_error(self, version_table, get_migrations, get_current_version):
+        get_migrations.return_value = []
+        get_current_version.side_effect = sa.exc.OperationalError('SELECT', {}, Exception('error'))
+        engine = self._postgresql_engine()
+
+        self.assertRaises(sa.exc.OperationalError, migration.migrate, engine)
+        self.assertIn('pg_advisory_unlock', self._executed_sql(engine)[-1])
+
+    def test_add_and_drop_column(self):
+        migration.migrate(self.engine)
+
+        with self.engine.connect() as connection:
+            op = migration.Operations(connection)
+            op.add_column('package_allowed_users', sa.Column('other', sa.types.DateTime))
+            columns = [column['name'] for column in sa.inspect(self.engine).get_columns('package_allowed_users')]
+            self.assertEquals(['package_id', 'user_name', 'user_id', 'expires_at', 'other'], columns)
+
+            op.drop_column('package_allowed_users', 'other')
+            columns = [column['name'] for column in sa.inspect(self.engine).get_columns('package_allowed_users')]
+            self.assertEquals(['package_id', 'user_name', 'user_id', 'expires_at'], columns)
+
+    def test_generate_sql(self):
+        statements = migration.generate_sql('postgresql://ckan@localhost/ckan')
+
+        self.assertEquals(36, len(statements))
+        self.assertIn('CREATE TABLE %s' % migration.VERSION_TABLE, statements[0])
+        self.assertIn('CREATE TABLE package_allowed_users', statements[1])
+        self.assertEquals('INSERT INTO %s (version) VALUES (1);' % migration.VERSION_TABLE, statements[3])
+        self.assertEquals('CREATE INDEX CONCURRENTLY idx_package_allowed_users_user_name '
+                          'ON package_allowed_users (user_name);', statements[4])
+        self.assertEquals('INSERT INTO %s (version) VALUES (2);' % migration.VERSION_TABLE, statements[6])
+        self.assertEquals('ALTER TABLE package_allowed_users ADD COLUMN user_id TEXT '
+                          'REFERENCES "user" (id) ON DELETE CASCADE;', statements[7])
+        self.assertEquals('CREATE INDEX CONCURRENTLY idx_package_allowed_users_user_id '
+                          'ON package_allowed_users (user_id);', statements[10])
+        self.assertIn('CREATE TABLE privatedatasets_scoped_grants', statements[19])
+        self.assertEquals('CREATE INDEX idx_privatedatasets_scoped_grants_user_id '
+                          'ON privatedatasets_scoped_grants (user_id);', statements[20])
+        self.assertEquals('INSERT INTO %s (version) VALUES (7);' % migration.VERSION_TABLE, statements[23])
+        self.assertIn('CREATE TABLE privatedatasets_bundles', statements[24])
+        self.assertIn('CREATE TABLE privatedatasets_bundle_packages', statements[25])
+        self.assertEquals('CREATE INDEX idx_privatedatasets_bundle_packages_package_id '
+                          'ON privatedatasets_bundle_packages (package_id);', statements[26])
+        self.assertIn('CREATE TABLE package_allowed_groups', statements[29])
+        self.assertEquals('CREATE INDEX idx_package_allowed_groups_group_id '
+                          'ON package_allowed_groups (group_id);', statements[30])
+        # The user ids are filled with a single statement, which can be split when run manually
+        self.assertEquals('UPDATE package_allowed_users SET user_id=(SELECT "user".id \nFROM "user" \n'
+                          'WHERE "user".name = package_allowed_users.user_name) WHERE package_allowed_users.user_id IS NULL;',
+                          statements[33])
+        self.assertEquals('INSERT INTO %s (version) VALUES (10);' % migration.VERSION_TABLE, statements[35])
+
+    def test_generate_sql_from_version(self):
+        statements = migration.generate_sql('postgresql://ckan@localhost/ckan', 2, 0)
+
+        self.assertEquals(['DROP INDEX CONCURRENTLY idx_package_allowed_users_user_name;',
+                           'DELETE FROM %s;' % migration.VERSION_TABLE,
+                           'INSERT INTO %s (version) VALUES (1);' % migration.VERSION_TABLE,
+                           'DROP TABLE package_allowed_users;',
+                           'DELETE FROM %s;' % migration.VERSION_TABLE,
+                           'INSERT INTO %s (version) VALUES (0);' % migration.VERSION_TABLE], statements)
+
+
+@test_postgresql.skip_unless_configured
+class PostgreSQLMigrationTest(unittest.TestCase):
+    '''Runs the migrations against a PostgreSQL database, where indexes are created concurrently'''
+
+    def setUp(self):
+        self.schema = test_postgresql.TemporarySchema()
+        self.engine = self.schema.engine
+        self.engine.execute('CREATE TABLE "user" (id TEXT PRIMARY KEY, name TEXT)')
+
+    def tearDown(self):
+        self.schema.drop()
+
+    def test_upgrade_and_downgrade(self):
+        self.engine.execute('CREATE TABLE package_allowed_users (package_id TEXT, user_name TEXT, '
+                            'PRIMARY KEY (package_id, user_name))')
+        self.engine.execute("INSERT INTO \"user\" VALUES ('id-a', 'a')")
+        self.engine.execute("INSERT INTO package_allowed_users VALUES ('pkg', 'a'), ('pkg', 'unknown')")
+
+        self.assertEquals(10, migration.migrate(self.engine))
+
+        indexes = sorted(index['name'] for index in sa.inspect(self.engine).get_indexes('package_allowed_users'))
+        self.assertEquals(['idx_package_allowed_users_expires_at', 'idx_package_allowed_users_user_id',
+                           'idx_package_allowed_users_user_name'], indexes)
+        self.assertEquals([('a', 'id-a'), ('unknown', None)], list(self.engine.execute(
+            'SELECT user_name, user_id FROM package_allowed_users ORDER BY user_name')))
+
+        self.assertEquals(1, migration.migrate(self.engine, 1))
+        self.assertEquals([], sa.inspect(self.engine).get_indexes('package_allowed_users'))
+
+        # The lock has been released
+        self.assertEquals(0, self.engine.execute('SELECT count(*) FROM pg_locks WHERE locktype = \'advisory\'').scalar())
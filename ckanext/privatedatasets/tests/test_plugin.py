@@ -17,11 +17,12 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
 
-import unittest
 import copy
+import datetime
+import unittest
 
 from flask import Blueprint
-from mock import MagicMock
+from mock import MagicMock, patch
 from parameterized import parameterized
 
 import ckanext.privatedatasets.plugin as plugin
@@ -38,21 +39,41 @@ class PluginTest(unittest.TestCase):
         self._db = plugin.db
         plugin.db = MagicMock()
 
+        self._bloom = plugin.bloom
+        plugin.bloom = MagicMock()
+
         self._search = plugin.search
         plugin.search = MagicMock()
 
+        self._indexer = plugin.indexer
+        plugin.indexer = MagicMock()
+        plugin.indexer.user_label.side_effect = self._indexer.user_label
+
+        self._cache = plugin.cache
+        plugin.cache = MagicMock()
+
+        self._settings = plugin.settings
+        plugin.settings = MagicMock()
+        plugin.settings.get.return_value.incremental_index = False
+        plugin.settings.get.return_value.reindex_delay = 0
+
         # Create the plugin
         self.privateDatasets = plugin.PrivateDatasets()
 
     def tearDown(self):
         plugin.tk = self._tk
         plugin.db = self._db
+        plugin.bloom = self._bloom
         plugin.search = self._search
+        plugin.indexer = self._indexer
+        plugin.cache = self._cache
+        plugin.settings = self._settings
 
     @parameterized.expand([
         (plugin.p.IDatasetForm,),
         (plugin.p.IAuthFunctions,),
         (plugin.p.IConfigurer,),
+        (plugin.p.IConfigurable,),
         (plugin.p.IBlueprint,),
         (plugin.p.IActions,),
         (plugin.p.IPackageController,),
@@ -68,7 +89,13 @@ class PluginTest(unittest.TestCase):
         ('resource_show',     plugin.auth.resource_show,     True,  False),
         ('package_acquired',  plugin.auth.package_acquired),
         ('acquisitions_list', plugin.auth.acquisitions_list),
-        ('revoke_access',   plugin.auth.revoke_access)
+        ('revoke_access',   plugin.auth.revoke_access),
+        ('scoped_grants',   plugin.auth.scoped_grants),
+        ('allowed_users_patch', plugin.auth.allowed_users_patch),
+        ('bundle_show',     plugin.auth.manage_bundles),
+        ('bundle_create',   plugin.auth.manage_bundles),
+        ('bundle_update',   plugin.auth.manage_bundles),
+        ('bundle_delete',   plugin.auth.manage_bundles)
     ])
     def test_auth_function(self, function_name, expected_function, is_ckan_23=False, expected=True):
         plugin.tk.check_ckan_version = MagicMock(return_value=is_ckan_23)
@@ -79,7 +106,8 @@ class PluginTest(unittest.TestCase):
         else:
             self.assertNotIn(function_name, auth_functions)
 
-    def test_update_config(self):
+    @patch('ckanext.privatedatasets.plugin.helpers.acquire_buttons')
+    def test_update_config(self, acquire_buttons):
         # Call the method
         config = {'test': 1234, 'another': 'value'}
         self.privateDatasets.update_config(config)
@@ -91,14 +119,47 @@ class PluginTest(unittest.TestCase):
             plugin.tk.add_template_directory.assert_called_once_with(config, 'templates')
         plugin.tk.add_resource('fanstatic', 'privatedatasets')
 
+        # Settings are loaded and the caches of acquire buttons and acquired packages are configured
+        plugin.settings.load.assert_called_once_with(config)
+        self.assertEquals(plugin.settings.load.return_value.acquire_button_cache_size, acquire_buttons.maxsize)
+        acquire_buttons.clear.assert_called_once_with()
+        self.assertEquals(plugin.settings.load.return_value.acquired_cache_size, plugin.cache.acquired_packages.maxsize)
+        plugin.cache.acquired_packages.clear.assert_called_once_with()
+
+    def test_configure(self):
+        plugin.settings.get.return_value.auto_migrate = True
+        self.privateDatasets.configure({})
+        plugin.db.init_db.assert_called_once_with()
+
+    def test_configure_auto_migrate_disabled(self):
+        plugin.settings.get.return_value.auto_migrate = False
+
+        # Migrations are left to the privatedatasets migrate command
+        self.privateDatasets.configure({})
+        self.assertEquals(0, plugin.db.init_db.call_count)
+
+    def test_configure_database_error(self):
+        plugin.settings.get.return_value.auto_migrate = True
+        plugin.db.init_db.side_effect = plugin.SQLAlchemyError('database not available')
+
+        # The error does not prevent CKAN from starting
+        self.privateDatasets.configure({})
+        plugin.db.init_db.assert_called_once_with()
+
     def test_get_blueprint(self):
         # Call the method
         self.assertIsInstance(self.privateDatasets.get_blueprint(), Blueprint)
 
     @parameterized.expand([
+        ('package_show',      plugin.actions.package_show),
         ('package_acquired',  plugin.actions.package_acquired),
         ('acquisitions_list', plugin.actions.acquisitions_list),
-        ('revoke_access',   plugin.actions.revoke_access)
+        ('revoke_access',   plugin.actions.revoke_access),
+        ('allowed_users_patch', plugin.actions.allowed_users_patch),
+        ('bundle_show',     plugin.actions.bundle_show),
+        ('bundle_create',   plugin.actions.bundle_create),
+        ('bundle_update',   plugin.actions.bundle_update),
+        ('bundle_delete',   plugin.actions.bundle_delete)
     ])
     def test_actions_function(self, function_name, expected_function):
         actions = self.privateDatasets.get_actions()
@@ -114,7 +175,9 @@ class PluginTest(unittest.TestCase):
         ('is_dataset_acquired',   plugin.helpers.is_dataset_acquired),
         ('get_allowed_users_str', plugin.helpers.get_allowed_users_str),
         ('is_owner',              plugin.helpers.is_owner),
-        ('can_read',              plugin.helpers.can_read)
+        ('can_read',              plugin.helpers.can_read),
+        ('get_package_list_flags', plugin.helpers.get_package_list_flags),
+        ('get_acquired_package_ids', plugin.helpers.get_acquired_package_ids)
     ])
     def test_helpers_functions(self, function_name, expected_function):
         helpers_functions = self.privateDatasets.get_helpers()
@@ -147,7 +210,9 @@ class PluginTest(unittest.TestCase):
                            plugin.tk.get_converter('convert_to_extras'), plugin.conv_val.private_datasets_metadata_checker],
             'allowed_users_str': [plugin.tk.get_validator('ignore_missing'), plugin.conv_val.private_datasets_metadata_checker],
             'allowed_users': [plugin.conv_val.allowed_users_convert, plugin.tk.get_validator('ignore_missing'),
-                              plugin.conv_val.private_datasets_metadata_checker]
+                              plugin.conv_val.private_datasets_metadata_checker],
+            'allowed_groups': [plugin.tk.get_validator('ignore_missing'), plugin.conv_val.allowed_groups_convert,
+                               plugin.conv_val.private_datasets_metadata_checker]
         }
 
         self._check_fields(returned_schema, fields)
@@ -161,7 +226,8 @@ class PluginTest(unittest.TestCase):
         fields = {
             'acquire_url': [plugin.tk.get_validator('ignore_missing'), plugin.tk.get_converter('convert_from_extras')],
             'searchable': [plugin.tk.get_validator('ignore_missing'), plugin.tk.get_converter('convert_from_extras')],
-            'allowed_users': [plugin.tk.get_validator('ignore_missing'), plugin.conv_val.get_allowed_users]
+            'allowed_users': [plugin.tk.get_validator('ignore_missing'), plugin.conv_val.get_allowed_users],
+            'allowed_groups': [plugin.tk.get_validator('ignore_missing'), plugin.conv_val.get_allowed_groups]
         }
 
         self._check_fields(returned_schema, fields)
@@ -189,6 +255,7 @@ class PluginTest(unittest.TestCase):
             db_user = MagicMock()
             db_user.package_id = pkg_id
             db_user.user_name = user
+            db_user.expires_at = None
             db_current_users.append(db_user)
 
         # Allowed users
@@ -199,9 +266,15 @@ class PluginTest(unittest.TestCase):
         self.assertEquals(expected_pkg_dict, result)                    # Check the result
 
         # Assert that the get method has been called
-        plugin.db.init_db.assert_called_once_with(context['model'])
         plugin.db.AllowedUser.get.assert_called_once_with(package_id=pkg_id)
 
+        # Package metadata cached for the current request is discarded
+        plugin.cache.forget_package.assert_called_once_with(pkg_id)
+
+        # Allowed groups are also deleted
+        plugin.db.AllowedGroup.set_groups.assert_called_once_with(pkg_id, [])
+        plugin.cache.forget_acquired.assert_called_once_with(allowed_users)
+
         # Check that all the users has been deleted
         for user in allowed_users:
             found = False
@@ -286,9 +359,83 @@ class PluginTest(unittest.TestCase):
 
         expected_result = pkg_dict.copy()
         expected_result['capacity'] = finalCapacity
+        expected_result['privatedatasets_private'] = False
+        expected_result['privatedatasets_searchable'] = finalCapacity == 'public'
+        expected_result['privatedatasets_acquirers_i'] = 0
+        expected_result['vocab_privatedatasets_grantees'] = []
 
         self.assertEquals(expected_result, self.privateDatasets.before_index(pkg_dict))
 
+        # Public datasets cannot have allowed users
+        self.assertEquals(0, plugin.indexer.get_grants.call_count)
+
+    @parameterized.expand([
+        (None,    [],         True),
+        ('False', [],         False),
+        ('True',  ['a'],      True),
+        ('False', ['a', 'b'], False),
+    ])
+    def test_packagecontroller_before_index_private(self, searchable, allowed_users, expected_searchable):
+        pkg_dict = {'id': 'package_id', 'capacity': 'public', 'private': True}
+        if searchable is not None:
+            pkg_dict['extras_searchable'] = searchable
+
+        plugin.indexer.get_grants.return_value = {'user_labels': ['allowed-%s' % user for user in allowed_users],
+                                                  'group_ids': [], 'bundle_ids': []}
+
+        result = self.privateDatasets.before_index(pkg_dict)
+
+        # The grants are kept for get_dataset_labels
+        plugin.indexer.get_grants.assert_called_once_with('package_id', keep=True)
+        self.assertEquals(True, result['privatedatasets_private'])
+        self.assertEquals(expected_searchable, result['privatedatasets_searchable'])
+        self.assertEquals(len(allowed_users), result['privatedatasets_acquirers_i'])
+        self.assertEquals(['allowed-%s' % user for user in allowed_users], result['vocab_privatedatasets_grantees'])
+
+    def test_packagecontroller_before_index_allowed_groups(self):
+        plugin.indexer.get_grants.return_value = {'user_labels': ['allowed-a'], 'group_ids': ['g2', 'g1'],
+                                                  'bundle_ids': []}
+
+        result = self.privateDatasets.before_index({'id': 'package_id', 'private': True})
+
+        # Groups are grantees, but they are not counted as acquirers
+        self.assertEquals(1, result['privatedatasets_acquirers_i'])
+        self.assertEquals(['allowed-a', 'allowed_group-g1', 'allowed_group-g2'], result['vocab_privatedatasets_grantees'])
+
+    @parameterized.expand([
+        (['g1'], [],     False),
+        (['g1'], ['g2'], False),
+        ([],     [],     False),
+        (['g1'], [],     True),
+        (['g1'], ['g2'], True),
+        ([],     [],     True),
+    ])
+    def test_packagecontroller_after_update_allowed_groups(self, added_groups, removed_groups, incremental):
+        plugin.tk.get_action = MagicMock()
+        plugin.tk.get_action.return_value.return_value = {'revision_id': 'revision_id'}
+        plugin.db.AllowedGroup.set_groups.return_value = (added_groups, removed_groups)
+        plugin.settings.get.return_value.incremental_index = incremental
+
+        context = {'user': 'test', 'auth_user_obj': {'id': 1}, 'session': MagicMock(), 'model': MagicMock()}
+        self.privateDatasets.after_update(context, {'id': 'package_id', 'allowed_groups': ['g1']})
+
+        plugin.db.AllowedGroup.set_groups.assert_called_once_with('package_id', ['g1'])
+        context['session'].commit.assert_called_once_with()
+
+        labels_indexer = self.privateDatasets.labels_indexer
+        if not added_groups and not removed_groups:
+            self.assertEquals(0, self.privateDatasets.indexer.update_dict.call_count)
+            self.assertEquals(0, labels_indexer.add_labels.call_count)
+        elif incremental:
+            # Groups are not counted as acquirers
+            self.assertEquals(0, self.privateDatasets.indexer.update_dict.call_count)
+            labels_indexer.add_labels.assert_called_once_with('package_id', ['allowed_group-g1'], acquirers=False)
+            if removed_groups:
+                labels_indexer.remove_labels.assert_called_once_with('package_id', ['allowed_group-g2'], acquirers=False)
+        else:
+            self.assertEquals(1, self.privateDatasets.indexer.update_dict.call_count)
+            self.assertEquals(0, labels_indexer.add_labels.call_count)
+
     def _aux_test_after_create_update(self, function, new_users, current_users, users_to_add, users_to_delete):
         package_id = 'package_id'
 
@@ -321,18 +468,28 @@ class PluginTest(unittest.TestCase):
             db_user = MagicMock()
             db_user.package_id = package_id
             db_user.user_name = user
-            db_current_users.append(db_user)
+            db_user.user_id = 'id-%s' % user
+            db_user.expires_at = None
+            db_current_users.append((db_user, user))
 
-        plugin.db.AllowedUser.get = MagicMock(return_value=db_current_users)
+        plugin.db.AllowedUser.get_with_names = MagicMock(return_value=db_current_users)
+        plugin.db.get_user_ids.return_value = {'a': 'id-a'}
 
         # Call the method
         context = {'user': 'test', 'auth_user_obj': {'id': 1}, 'session': MagicMock(), 'model': MagicMock()}
         pkg_dict = {'id': 'package_id', 'allowed_users': new_users}
         function(context, pkg_dict)
 
-        # Check that the database has been called
-        plugin.db.init_db.assert_called_once_with(context['model'])
-        plugin.db.AllowedUser.get.assert_called_once_with(package_id=pkg_dict['id'])
+        # The ids of the new users are stored (users that have not signed up have none)
+        if users_to_add:
+            plugin.db.get_user_ids.assert_called_once_with(users_to_add)
+        for call in context['session'].add.call_args_list:
+            self.assertEquals('id-a' if call[0][0].user_name == 'a' else None, call[0][0].user_id)
+
+        # Check that the database has been called (after locking the list of users)
+        plugin.db.lock_package.assert_called_once_with(pkg_dict['id'])
+        plugin.db.AllowedUser.get_with_names.assert_called_once_with(pkg_dict['id'])
+        plugin.cache.forget_package.assert_called_once_with(pkg_dict['id'])
 
         def _test_calls(user_list, function):
             self.assertEquals(len(user_list), function.call_count)
@@ -353,12 +510,17 @@ class PluginTest(unittest.TestCase):
         # Check that the method has added the appropiate users
         _test_calls(users_to_add, context['session'].add)
 
+        # The acquired packages of the users that have changed are loaded again
+        plugin.cache.forget_acquired.assert_called_once_with(users_to_add + users_to_delete)
+
         if len(users_to_add) == 0 and len(users_to_delete) == 0:
             # Check that the cache has not been updated
             self.assertEquals(0, self.privateDatasets.indexer.update_dict.call_count)
         else:
             # Check that the cache has been updated
             self.privateDatasets.indexer.update_dict.assert_called_once_with(expected_dict)
+            plugin.indexer.prefetch_allowed_users.assert_called_once_with([package_id])
+            plugin.indexer.clear_prefetched.assert_called_once_with()
 
     @parameterized.expand([
         # One element
@@ -404,6 +566,178 @@ class PluginTest(unittest.TestCase):
     def test_packagecontroller_after_update(self, new_users, current_users, users_to_add, users_to_delete):
         self._aux_test_after_create_update(self.privateDatasets.after_update, new_users, current_users, users_to_add, users_to_delete)
 
+    def test_packagecontroller_after_update_renews_expired_grants(self):
+        plugin.db.AllowedUser = MagicMock(side_effect=lambda: MagicMock())
+
+        expired_user = MagicMock(package_id='package_id', user_name='a', user_id='id-a',
+                                 expires_at=datetime.datetime(2000, 1, 1))
+        valid_user = MagicMock(package_id='package_id', user_name='b', user_id='id-b',
+                               expires_at=datetime.datetime(3000, 1, 1))
+        plugin.db.AllowedUser.get_with_names = MagicMock(return_value=[(expired_user, 'a'), (valid_user, 'b')])
+
+        context = {'user': 'test', 'auth_user_obj': {'id': 1}, 'session': MagicMock(), 'model': MagicMock()}
+        plugin.settings.get.return_value.incremental_index = True
+        self.privateDatasets.after_update(context, {'id': 'package_id', 'allowed_users': ['a', 'b']})
+
+        # Only the expired grant is renewed, and its label is added again
+        self.assertIsNone(expired_user.expires_at)
+        self.assertEquals(datetime.datetime(3000, 1, 1), valid_user.expires_at)
+        self.assertEquals(0, context['session'].add.call_count)
+        self.privateDatasets.labels_indexer.add_labels.assert_called_once_with('package_id', ['allowed-id-a'])
+
+    def test_packagecontroller_after_update_renamed_user(self):
+        plugin.db.AllowedUser = MagicMock(side_effect=lambda: MagicMock())
+
+        # The grant was stored before the user was renamed from old_name to a
+        renamed_user = MagicMock(package_id='package_id', user_name='old_name', user_id='id-a',
+                                 expires_at=datetime.datetime(3000, 1, 1))
+        plugin.db.AllowedUser.get_with_names = MagicMock(return_value=[(renamed_user, 'a')])
+
+        context = {'user': 'test', 'auth_user_obj': {'id': 1}, 'session': MagicMock(), 'model': MagicMock()}
+        self.privateDatasets.after_update(context, {'id': 'package_id', 'allowed_users': ['a']})
+
+        # The grant (and its expiration date) is kept, and the dataset is not reindexed
+        self.assertEquals(datetime.datetime(3000, 1, 1), renamed_user.expires_at)
+        self.assertEquals(0, context['session'].delete.call_count)
+        self.assertEquals(0, context['session'].add.call_count)
+        self.assertEquals(0, self.privateDatasets.indexer.update_dict.call_count)
+
+    def test_packagecontroller_after_update_defer_commit(self):
+        plugin.db.AllowedUser = MagicMock(side_effect=lambda: MagicMock())
+        plugin.db.AllowedUser.get_with_names = MagicMock(return_value=[])
+        plugin.db.AllowedGroup.set_groups.return_value = ([], [])
+
+        context = {'user': 'test', 'session': MagicMock(), 'model': MagicMock(), 'defer_commit': True}
+        self.privateDatasets.after_update(context, {'id': 'package_id', 'allowed_users': ['a'], 'allowed_groups': []})
+
+        # The changes are committed by the caller
+        self.assertEquals(1, context['session'].add.call_count)
+        self.assertEquals(0, context['session'].commit.call_count)
+
+        # The dataset is not reindexed until the changes have been committed
+        self.assertEquals(0, self.privateDatasets.indexer.update_dict.call_count)
+        plugin.indexer.reindex_after_batch.assert_called_once_with(self.privateDatasets._reindex_later, 'package_id')
+
+    def test_packagecontroller_after_update_defer_commit_reindex_delay(self):
+        # Notifications use the batches of the indexer module
+        plugin.indexer = self._indexer
+        plugin.db.AllowedUser = MagicMock(side_effect=lambda: MagicMock())
+        plugin.db.AllowedUser.get_with_names = MagicMock(return_value=[])
+        plugin.settings.get.return_value.reindex_delay = 5
+        queue = self.privateDatasets.reindex_queue = MagicMock()
+
+        context = {'user': 'test', 'session': MagicMock(), 'model': MagicMock(), 'defer_commit': True}
+        with plugin.indexer.batch():
+            self.privateDatasets.after_update(context, {'id': 'package_id', 'allowed_users': ['a']})
+
+            # Datasets are not queued until the changes have been committed
+            self.assertEquals(0, queue.add.call_count)
+
+        queue.add.assert_called_once_with('package_id')
+        self.assertEquals(0, self.privateDatasets.indexer.update_dict.call_count)
+
+    @parameterized.expand([
+        (0, False),
+        (5, True),
+    ])
+    def test_reindex_later(self, reindex_delay, queued):
+        plugin.settings.get.return_value.reindex_delay = reindex_delay
+        queue = self.privateDatasets.reindex_queue = MagicMock()
+        self.privateDatasets._reindex_packages = MagicMock()
+
+        self.privateDatasets._reindex_later(['pkg1', 'pkg2'])
+
+        if queued:
+            self.assertEquals([(('pkg1',),), (('pkg2',),)], queue.add.call_args_list)
+            self.assertEquals(0, self.privateDatasets._reindex_packages.call_count)
+        else:
+            self.privateDatasets._reindex_packages.assert_called_once_with(['pkg1', 'pkg2'])
+            self.assertEquals(0, queue.add.call_count)
+
+    def test_packagecontroller_after_update_reindex_delay(self):
+        plugin.db.AllowedUser = MagicMock(side_effect=lambda: MagicMock())
+        plugin.db.AllowedUser.get_with_names = MagicMock(return_value=[])
+        plugin.settings.get.return_value.reindex_delay = 5
+        plugin.settings.get.return_value.reindex_batch_size = 100
+
+        for user in ('a', 'b'):
+            context = {'user': 'test', 'auth_user_obj': {'id': 1}, 'session': MagicMock(), 'model': MagicMock()}
+            self.privateDatasets.after_update(context, {'id': 'package_id', 'allowed_users': [user]})
+
+        # Datasets are queued instead of being reindexed immediately, and a single queue is created
+        self.assertEquals(0, self.privateDatasets.indexer.update_dict.call_count)
+        plugin.indexer.ReindexQueue.assert_called_once_with(self.privateDatasets._reindex_packages, 100, 5)
+        queue = plugin.indexer.ReindexQueue.return_value
+        self.assertEquals([(('package_id',),), (('package_id',),)], queue.add.call_args_list)
+
+    def test_reindex_packages(self):
+        def _package_show(context, data_dict):
+            if data_dict['id'] == 'deleted':
+                raise self._tk.ObjectNotFound()
+            return {'id': data_dict['id'], 'revision_id': 'revision_%s' % data_dict['id']}
+
+        revision_show = MagicMock(side_effect=lambda context, data_dict: {'timestamp': data_dict['id']})
+        plugin.tk.get_action = MagicMock(side_effect=lambda action: {'package_show': _package_show,
+                                                                     'revision_show': revision_show}[action])
+
+        self.privateDatasets._reindex_packages(['pkg1', 'deleted', 'pkg2'])
+
+        # Datasets are committed together, and the ones that cannot be shown are skipped
+        plugin.indexer.prefetch_allowed_users.assert_called_once_with(['pkg1', 'deleted', 'pkg2'])
+        self.assertEquals([((expected,), {'defer_commit': True}) for expected in [
+            {'id': 'pkg1', 'revision_id': 'revision_pkg1', 'metadata_modified': 'revision_pkg1'},
+            {'id': 'pkg2', 'revision_id': 'revision_pkg2', 'metadata_modified': 'revision_pkg2'}]],
+            self.privateDatasets.indexer.update_dict.call_args_list)
+        self.privateDatasets.indexer.commit.assert_called_once_with()
+        plugin.indexer.clear_prefetched.assert_called_once_with()
+
+    @parameterized.expand([
+        (['a'],           [],              ['a'],           []),
+        ([],              ['a'],           [],              ['a']),
+        (['a', 'b'],      ['b', 'c'],      ['a'],           ['c']),
+        (['a', 'b'],      ['a', 'b'],      [],              []),
+    ])
+    def test_packagecontroller_after_update_incremental_index(self, new_users, current_users, users_to_add, users_to_delete):
+        package_id = 'package_id'
+
+        plugin.db.AllowedUser = MagicMock(side_effect=lambda: MagicMock())
+
+        db_current_users = []
+        for user in current_users:
+            db_user = MagicMock()
+            db_user.package_id = package_id
+            db_user.user_name = user
+            db_user.user_id = 'id-%s' % user
+            db_user.expires_at = None
+            db_current_users.append((db_user, user))
+
+        plugin.db.AllowedUser.get_with_names = MagicMock(return_value=db_current_users)
+        # Users that have not signed up are labelled by name
+        plugin.db.get_user_ids.return_value = {'a': 'id-a'}
+
+        context = {'user': 'test', 'auth_user_obj': {'id': 1}, 'session': MagicMock(), 'model': MagicMock()}
+        pkg_dict = {'id': package_id, 'allowed_users': new_users}
+
+        plugin.settings.get.return_value.incremental_index = True
+        self.privateDatasets.after_update(context, pkg_dict)
+
+        # The full document is never reindexed
+        self.assertEquals(0, self.privateDatasets.indexer.update_dict.call_count)
+
+        labels_indexer = self.privateDatasets.labels_indexer
+        if users_to_add:
+            labels_indexer.add_labels.assert_called_once_with(package_id, ['allowed-id-a' if user == 'a' else
+                                                                           'allowed_name-%s' % user
+                                                                           for user in users_to_add])
+        else:
+            self.assertEquals(0, labels_indexer.add_labels.call_count)
+
+        if users_to_delete:
+            labels_indexer.remove_labels.assert_called_once_with(package_id, ['allowed-id-%s' % user
+                                                                              for user in users_to_delete])
+        else:
+            self.assertEquals(0, labels_indexer.remove_labels.call_count)
+
     @parameterized.expand([
         (1, True),
         (1, False),
@@ -421,8 +755,9 @@ class PluginTest(unittest.TestCase):
 
         search_results = {'facets': ['facet1', 'facet2'], 'results': [], 'elements': num_seach_results}
         # Add resources
-        for _ in range(num_seach_results):
+        for i in range(num_seach_results):
             search_results['results'].append({
+                'id': 'package_id_%d' % i,
                 'allowed_users': ['user1', 'user2'],
                 'seearchable': True,
                 'acquire_url': 'https://upm.es',
@@ -449,3 +784,63 @@ class PluginTest(unittest.TestCase):
 
         self.assertEquals(final_search_results['facets'], search_results['facets'])
         self.assertEquals(final_search_results['elements'], search_results['elements'])
+
+        # The packages are loaded at once
+        plugin.cache.prefetch.assert_called_once_with(['package_id_%d' % i for i in range(num_seach_results)],
+                                                      plugin.tk.c.user)
+
+    @parameterized.expand([
+        ('active', False, None,     [],           ['public']),
+        ('active', True,  None,     [],           ['creator-creator_id', 'grant-creator-creator_id']),
+        ('active', True,  'conwet', [],           ['member-conwet', 'grant-organization-conwet',
+                                                   'grant-creator-creator_id']),
+        ('active', True,  None,     ['a'],        ['creator-creator_id', 'allowed-a', 'grant-creator-creator_id']),
+        ('active', True,  'conwet', ['a', 'b'],   ['member-conwet', 'allowed-a', 'allowed-b',
+                                                   'grant-organization-conwet', 'grant-creator-creator_id']),
+        ('draft',  True,  None,     ['a'],        ['creator-creator_id', 'allowed-a', 'grant-creator-creator_id']),
+        ('active', True,  None,     [],           ['creator-creator_id', 'grant-creator-creator_id',
+                                                   'grant-bundle-b1', 'grant-bundle-b2'], ['b2', 'b1']),
+        ('active', False, None,     [],           ['public'], ['b1']),
+        ('active', True,  None,     ['a'],        ['creator-creator_id', 'allowed-a', 'allowed_group-g1',
+                                                   'allowed_group-g2', 'grant-creator-creator_id'], [], ['g2', 'g1']),
+    ])
+    def test_get_dataset_labels(self, state, private, owner_org, allowed_users, expected_labels, bundles=(),
+                                allowed_groups=()):
+        dataset_obj = MagicMock(spec=['id', 'state', 'private', 'owner_org', 'creator_user_id'])
+        dataset_obj.id = 'package_id'
+        dataset_obj.state = state
+        dataset_obj.private = private
+        dataset_obj.owner_org = owner_org
+        dataset_obj.creator_user_id = 'creator_id'
+
+        plugin.indexer.get_grants.return_value = {'user_labels': ['allowed-%s' % user for user in allowed_users],
+                                                  'group_ids': list(allowed_groups), 'bundle_ids': list(bundles)}
+
+        self.assertEquals(expected_labels, self.privateDatasets.get_dataset_labels(dataset_obj))
+
+        if private:
+            plugin.indexer.get_grants.assert_called_once_with(dataset_obj.id)
+        else:
+            self.assertEquals(0, plugin.indexer.get_grants.call_count)
+
+    @parameterized.expand([
+        (None,   [],                                   ['public', 'searchable']),
+        ('test', [],                                   ['public', 'searchable', 'allowed-user_id', 'allowed_name-test']),
+        ('test', [('organization', 'o1'), ('creator', 'c1')],
+         ['public', 'searchable', 'allowed-user_id', 'allowed_name-test', 'grant-creator-c1',
+          'grant-organization-o1']),
+        ('test', [],                                   ['public', 'searchable', 'allowed-user_id', 'allowed_name-test',
+                                                        'allowed_group-g1', 'allowed_group-g2'], ['g2', 'g1']),
+    ])
+    def test_get_user_dataset_labels(self, user_name, scoped_grants, expected_labels, group_ids=()):
+        user_obj = None
+        if user_name is not None:
+            user_obj = MagicMock()
+            user_obj.id = 'user_id'
+            user_obj.name = user_name
+
+        plugin.cache.get_scoped_grants.return_value = frozenset(scoped_grants)
+        plugin.cache.get_user_group_ids.return_value = frozenset(group_ids)
+
+        with patch.object(plugin.DefaultPermissionLabels, 'get_user_dataset_labels', return_value=['public']):
+            self.assertEquals(expected_labels, self.privateDatasets.get_user_dataset_labels(user_obj))
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from mock import patch
+from parameterized import parameterized
+
+import ckanext.privatedatasets.settings as settings
+
+
+class SettingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self._settings = settings._settings
+        settings._settings = None
+
+    def tearDown(self):
+        settings._settings = self._settings
+
+    @parameterized.expand([
+        (None,    False, None),
+        ('True',  True,  None),
+        (' tRUe', True,  None),
+        ('False', False, None),
+        ('afa  ', False, None),
+        (True,    True,  None),
+        (False,   False, None),
+        (False,   True , 'trUe'),
+        (False,   True , 'on'),
+        (False,   True , '1'),
+        (True,    False, '0'),
+        (True,    False, 'off'),
+        (True,    False, 'fAlsE'),
+        (True,    False, 'potato'),
+    ])
+    @patch("ckanext.privatedatasets.settings.os.environ", new={})
+    def test_bool_settings(self, config_value, expected_value, env_val):
+        # {} is shared between tests, so we have clear it each time
+        settings.os.environ.clear()
+
+        names = {
+            'show_acquire_url_on_create': 'ckan.privatedatasets.show_acquire_url_on_create',
+            'show_acquire_url_on_edit': 'ckan.privatedatasets.show_acquire_url_on_edit',
+            'incremental_index': 'ckan.privatedatasets.incremental_index',
+        }
+
+        config = {}
+        for config_name in names.values():
+            if config_value is not None:
+                config[config_name] = config_value
+            if env_val:
+                settings.os.environ[config_name.upper().replace('.', '_')] = env_val
+
+        loaded = settings.load(config)
+
+        for attr in names:
+            self.assertEquals(expected_value, getattr(loaded, attr))
+
+    @patch("ckanext.privatedatasets.settings.os.environ", new={})
+    def test_defaults(self):
+        settings.os.environ.clear()
+
+        self.assertEquals(settings.Settings(parser='', show_acquire_url_on_create=False, show_acquire_url_on_edit=False,
+                                            incremental_index=False, acquire_button_cache_size=1000,
+                                            auto_migrate=False, reindex_delay=0, reindex_batch_size=100,
+                                            grants_filter_refresh=0, grants_filter_error_rate=0.01,
+                                            grants_filter_max_memory=16, acquired_cache_ttl=0,
+                                            acquired_cache_size=1000, grants_snapshot='',
+                                            grants_snapshot_refresh=10, notifier_users=frozenset()),
+                          settings.load({}))
+
+    @patch("ckanext.privatedatasets.settings.os.environ", new={})
+    def test_notifier_users(self):
+        settings.os.environ.clear()
+        config = {'ckan.privatedatasets.notifier_users': ' store, market  other '}
+
+        self.assertEquals(frozenset(['store', 'market', 'other']), settings.load(config).notifier_users)
+
+    @patch("ckanext.privatedatasets.settings.os.environ", new={})
+    def test_parser(self):
+        settings.os.environ.clear()
+        config = {'ckan.privatedatasets.parser': ' ckanext.privatedatasets.parsers.fiware:FiWareNotificationParser '}
+
+        self.assertEquals('ckanext.privatedatasets.parsers.fiware:FiWareNotificationParser', settings.load(config).parser)
+
+        # The environment takes precedence over the config file
+        settings.os.environ['CKAN_PRIVATEDATASETS_PARSER'] = 'other.parser:Parser'
+        self.assertEquals('other.parser:Parser', settings.load(config).parser)
+
+    @parameterized.expand([
+        ('10',   10),
+        (25,     25),
+        ('0',    None),
+        ('-1',   None),
+        ('many', None),
+    ])
+    @patch("ckanext.privatedatasets.settings.os.environ", new={})
+    def test_acquire_button_cache_size(self, config_value, expected_value):
+        settings.os.environ.clear()
+        config = {'ckan.privatedatasets.acquire_button_cache_size': config_value}
+
+        if expected_value is None:
+            self.assertRaises(ValueError, settings.load, config)
+        else:
+            self.assertEquals(expected_value, settings.load(config).acquire_button_cache_size)
+
+    @parameterized.expand([
+        ('false', False),
+        ('true',  True),
+    ])
+    @patch("ckanext.privatedatasets.settings.os.environ", new={})
+    def test_auto_migrate(self, config_value, expected_value):
+        settings.os.environ.clear()
+        config = {'ckan.privatedatasets.auto_migrate': config_value}
+
+        self.assertEquals(expected_value, settings.load(config).auto_migrate)
+
+    @parameterized.expand([
+        ('5',    '50',  5,    50),
+        ('0',    '1',   0,    1),
+        ('-1',   '10',  None, None),
+        ('soon', '10',  None, None),
+        ('5',    '0',   None, None),
+    ])
+    @patch("ckanext.privatedatasets.settings.os.environ", new={})
+    def test_reindex_queue(self, delay, batch_size, expected_delay, expected_batch_size):
+        settings.os.environ.clear()
+        config = {'ckan.privatedatasets.reindex_delay': delay, 'ckan.privatedatasets.reindex_batch_size': batch_size}
+
+        if expected_delay is None:
+            self.assertRaises(ValueError, settings.load, config)
+        else:
+            loaded = settings.load(config)
+            self.assertEquals(expected_delay, loaded.reindex_delay)
+            self.assertEquals(expected_batch_size, loaded.reindex_batch_size)
+
+    @parameterized.expand([
+        ('300', '0.001', '4',  (300, 0.001, 4)),
+        ('0',   '0.5',   '1',  (0, 0.5, 1)),
+        ('300', '0',     '4',  None),
+        ('300', '1',     '4',  None),
+        ('300', 'low',   '4',  None),
+        ('300', '0.01',  '0',  None),
+        ('-1',  '0.01',  '4',  None),
+    ])
+    @patch("ckanext.privatedatasets.settings.os.environ", new={})
+    def test_grants_filter(self, refresh, error_rate, max_memory, expected):
+        settings.os.environ.clear()
+        config = {'ckan.privatedatasets.grants_filter_refresh': refresh,
+                  'ckan.privatedatasets.grants_filter_error_rate': error_rate,
+                  'ckan.privatedatasets.grants_filter_max_memory': max_memory}
+
+        if expected is None:
+            self.assertRaises(ValueError, settings.load, config)
+        else:
+            loaded = settings.load(config)
+            self.assertEquals(expected, (loaded.grants_filter_refresh, loaded.grants_filter_error_rate,
+                                         loaded.grants_filter_max_memory))
+
+    @parameterized.expand([
+        ('60', '500', 60,   500),
+        ('0',  '1',   0,    1),
+        ('-1', '500', None, None),
+        ('60', '0',   None, None),
+    ])
+    @patch("ckanext.privatedatasets.settings.os.environ", new={})
+    def test_acquired_cache(self, ttl, size, expected_ttl, expected_size):
+        settings.os.environ.clear()
+        config = {'ckan.privatedatasets.acquired_cache_ttl': ttl, 'ckan.privatedatasets.acquired_cache_size': size}
+
+        if expected_ttl is None:
+            self.assertRaises(ValueError, settings.load, config)
+        else:
+            loaded = settings.load(config)
+            self.assertEquals(expected_ttl, loaded.acquired_cache_ttl)
+            self.assertEquals(expected_size, loaded.acquired_cache_size)
+
+    @parameterized.expand([
+        (' /var/lib/ckan/grants.snapshot ', '30', '/var/lib/ckan/grants.snapshot', 30),
+        ('',                                '1',  '',                              1),
+        ('/var/lib/ckan/grants.snapshot',   '0',  None,                            None),
+    ])
+    @patch("ckanext.privatedatasets.settings.os.environ", new={})
+    def test_grants_snapshot(self, path, refresh, expected_path, expected_refresh):
+        settings.os.environ.clear()
+        config = {'ckan.privatedatasets.grants_snapshot': path, 'ckan.privatedatasets.grants_snapshot_refresh': refresh}
+
+        if expected_refresh is None:
+            self.assertRaises(ValueError, settings.load, config)
+        else:
+            loaded = settings.load(config)
+            self.assertEquals(expected_path, loaded.grants_snapshot)
+            self.assertEquals(expected_refresh, loaded.grants_snapshot_refresh)
+
+    def test_settings_are_frozen(self):
+        loaded = settings.load({})
+
+        self.assertIs(loaded, settings.get())
+        self.assertRaises(AttributeError, setattr, loaded, 'parser', 'other')
+
+    @patch("ckanext.privatedatasets.settings.load")
+    def test_get_loads_settings_once(self, load):
+        def _load():
+            settings._settings = 'settings'
+        load.side_effect = _load
+
+        self.assertEquals('settings', settings.get())
+        self.assertEquals('settings', settings.get())
+        load.assert_called_once_with()
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock, patch
+from parameterized import parameterized
+
+import ckanext.privatedatasets.snapshot as snapshot
+
+
+def _timestamp(date):
+    return (date - datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'grants.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_grant_key(self):
+        # Keys are stable and fit in 64 bits
+        key = snapshot.grant_key('pkg1', u'usér')
+        self.assertEquals(key, snapshot.grant_key(u'pkg1', u'usér'))
+        self.assertTrue(0 <= key < 2 ** 64)
+        self.assertNotEqual(key, snapshot.grant_key('pkg1', u'user'))
+
+    @parameterized.expand([
+        (0,),
+        (1,),
+        (1000,),
+    ])
+    def test_write_read(self, count):
+        grants = [('pkg%d' % (i % 13), 'user%d' % i, None) for i in range(count)]
+
+        self.assertEquals(count, snapshot.write(self.path, grants))
+
+        grants_snapshot = snapshot.GrantsSnapshot(self.path)
+        self.assertEquals(count, len(grants_snapshot))
+        self.assertEquals(snapshot.HEADER.size + count * snapshot.RECORD.size, os.path.getsize(self.path))
+
+        # Every grant is found, and no other one
+        for package_id, user_name, _ in grants:
+            self.assertTrue(grants_snapshot.is_granted(package_id, user_name))
+        for i in range(count):
+            self.assertFalse(grants_snapshot.is_granted('pkg%d' % (i % 13), 'other%d' % i))
+        self.assertFalse(grants_snapshot.is_granted('pkg0', 'nobody'))
+
+        # No temporary file is left
+        self.assertEquals(['grants.snapshot'], os.listdir(self.directory))
+
+    @patch.object(snapshot, 'RUN_SIZE', 3)
+    def test_write_runs(self):
+        # Duplicated grants can be sorted in different runs
+        later = datetime.datetime(2018, 1, 3)
+        grants = [('pkg%d' % (i % 3), 'user%d' % i, None) for i in range(10)] + [('pkg1', 'a', later)]
+        grants.insert(1, ('pkg1', 'a', datetime.datetime(2018, 1, 2)))
+
+        self.assertEquals(11, snapshot.write(self.path, grants))
+
+        grants_snapshot = snapshot.GrantsSnapshot(self.path)
+        self.assertEquals(11, len(grants_snapshot))
+        for package_id, user_name, _ in grants:
+            self.assertTrue(grants_snapshot.is_granted(package_id, user_name, _timestamp(datetime.datetime(2018, 1, 2))))
+        self.assertFalse(grants_snapshot.is_granted('pkg1', 'a', _timestamp(later)))
+        self.assertFalse(grants_snapshot.is_granted('pkg0', 'nobody'))
+
+        # Records are sorted by key, and no temporary file is left
+        keys = [grants_snapshot._record(i)[0] for i in range(len(grants_snapshot))]
+        self.assertEquals(sorted(keys), keys)
+        self.assertEquals(['grants.snapshot'], os.listdir(self.directory))
+
+    def test_expiry(self):
+        tomorrow = datetime.datetime(2018, 1, 2)
+        snapshot.write(self.path, [('pkg1', 'a', tomorrow), ('pkg1', 'b', None)])
+        grants_snapshot = snapshot.GrantsSnapshot(self.path)
+
+        now = _timestamp(datetime.datetime(2018, 1, 1))
+        self.assertTrue(grants_snapshot.is_granted('pkg1', 'a', now))
+        self.assertTrue(grants_snapshot.is_granted('pkg1', 'b', now))
+
+        # Grants expire even if the snapshot is not updated
+        now = _timestamp(tomorrow)
+        self.assertFalse(grants_snapshot.is_granted('pkg1', 'a', now))
+        self.assertTrue(grants_snapshot.is_granted('pkg1', 'b', now))
+
+    @parameterized.expand([
+        (datetime.datetime(2018, 1, 2), None,                          None),
+        (None,                          datetime.datetime(2018, 1, 2), None),
+        (datetime.datetime(2018, 1, 2), datetime.datetime(2018, 1, 3), datetime.datetime(2018, 1, 3)),
+        (datetime.datetime(2018, 1, 3), datetime.datetime(2018, 1, 2), datetime.datetime(2018, 1, 3)),
+    ])
+    def test_duplicated_grants(self, first_expiry, second_expiry, expected_expiry):
+        self.assertEquals(1, snapshot.write(self.path, [('pkg1', 'a', first_expiry), ('pkg1', 'a', second_expiry)]))
+        grants_snapshot = snapshot.GrantsSnapshot(self.path)
+
+        # The grant that lasts longer is kept
+        later = _timestamp(datetime.datetime(2018, 1, 2, 12))
+        self.assertTrue(grants_snapshot.is_granted('pkg1', 'a', later))
+        if expected_expiry is not None:
+            self.assertFalse(grants_snapshot.is_granted('pkg1', 'a', _timestamp(expected_expiry)))
+
+    def test_write_error(self):
+        def _grants():
+            yield 'pkg1', 'a', None
+            raise Exception('Database error')
+
+        snapshot.write(self.path, [('pkg1', 'b', None)])
+        self.assertRaises(Exception, snapshot.write, self.path, _grants())
+
+        # The previous snapshot is kept and the temporary file is removed
+        self.assertEquals(['grants.snapshot'], os.listdir(self.directory))
+        self.assertTrue(snapshot.GrantsSnapshot(self.path).is_granted('pkg1', 'b'))
+
+    @parameterized.expand([
+        (b'',),
+        (b'PDGS',),
+        (snapshot.HEADER.pack(b'XXXX', snapshot.VERSION, 0),),
+        (snapshot.HEADER.pack(snapshot.MAGIC, snapshot.VERSION + 1, 0),),
+        # Truncated file
+        (snapshot.HEADER.pack(snapshot.MAGIC, snapshot.VERSION, 2) + snapshot.RECORD.pack(1, 0),),
+    ])
+    def test_invalid_file(self, content):
+        with open(self.path, 'wb') as snapshot_file:
+            snapshot_file.write(content)
+
+        self.assertRaises(ValueError, snapshot.GrantsSnapshot, self.path)
+
+    def test_replaced(self):
+        snapshot.write(self.path, [('pkg1', 'a', None)])
+        grants_snapshot = snapshot.GrantsSnapshot(self.path)
+        self.assertFalse(grants_snapshot.is_outdated())
+
+        snapshot.write(self.path, [('pkg1', 'b', None)])
+
+        # The file that was opened can still be read after it has been replaced
+        self.assertTrue(grants_snapshot.is_outdated())
+        self.assertTrue(grants_snapshot.is_granted('pkg1', 'a'))
+        self.assertTrue(snapshot.GrantsSnapshot(self.path).is_granted('pkg1', 'b'))
+
+    @patch('ckanext.privatedatasets.snapshot.db')
+    def test_export(self, db):
+        db.AllowedUser.iter_grants.return_value = iter([('pkg1', 'a', None), ('pkg2', 'b', None)])
+
+        self.assertEquals(2, snapshot.export(self.path))
+
+        db.AllowedUser.iter_grants.assert_called_once_with(with_expiry=True)
+        self.assertTrue(snapshot.GrantsSnapshot(self.path).is_granted('pkg2', 'b'))
+
+
+class SnapshotSettingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'grants.snapshot')
+
+        self._settings = snapshot.settings
+        snapshot.settings = MagicMock()
+        snapshot.settings.get.return_value.grants_snapshot = self.path
+        snapshot.settings.get.return_value.grants_snapshot_refresh = 10
+
+        self._time = snapshot.time
+        snapshot.time = MagicMock()
+        snapshot.time.time.return_value = 1000000000
+
+        snapshot._snapshot = None
+        snapshot._checked_at = 0
+
+    def tearDown(self):
+        snapshot.settings = self._settings
+        snapshot.time = self._time
+        snapshot._snapshot = None
+        snapshot._checked_at = 0
+        shutil.rmtree(self.directory)
+
+    def test_is_enabled(self):
+        self.assertTrue(snapshot.is_enabled())
+        snapshot.settings.get.return_value.grants_snapshot = ''
+        self.assertFalse(snapshot.is_enabled())
+
+    def test_is_granted(self):
+        snapshot.write(self.path, [('pkg1', 'a', None)])
+
+        self.assertTrue(snapshot.is_granted('pkg1', 'a'))
+        self.assertFalse(snapshot.is_granted('pkg1', 'b'))
+
+    def test_refresh(self):
+        snapshot.write(self.path, [('pkg1', 'a', None)])
+        self.assertTrue(snapshot.is_granted('pkg1', 'a'))
+        loaded = snapshot.get_snapshot()
+
+        # The file is only checked every grants_snapshot_refresh seconds
+        snapshot.write(self.path, [('pkg1', 'b', None)])
+        snapshot.time.time.return_value += 9
+        self.assertIs(loaded, snapshot.get_snapshot())
+        self.assertFalse(snapshot.is_granted('pkg1', 'b'))
+
+        # The new snapshot replaces the previous one
+        snapshot.time.time.return_value += 1
+        self.assertTrue(snapshot.is_granted('pkg1', 'b'))
+        self.assertFalse(snapshot.is_granted('pkg1', 'a'))
+
+        # It is not opened again when it has not changed
+        current = snapshot.get_snapshot()
+        snapshot.time.time.return_value += 10
+        self.assertIs(current, snapshot.get_snapshot())
+
+    def test_missing_snapshot(self):
+        # Nobody is granted until the snapshot can be loaded
+        self.assertIsNone(snapshot.get_snapshot())
+        self.assertFalse(snapshot.is_granted('pkg1', 'a'))
+
+        snapshot.write(self.path, [('pkg1', 'a', None)])
+        snapshot.time.time.return_value += 10
+        self.assertTrue(snapshot.is_granted('pkg1', 'a'))
+
+    def test_invalid_new_snapshot(self):
+        snapshot.write(self.path, [('pkg1', 'a', None)])
+        snapshot.get_snapshot()
+
+        with open(self.path + '.new', 'wb') as snapshot_file:
+            snapshot_file.write(b'invalid')
+        os.rename(self.path + '.new', self.path)
+        snapshot.time.time.return_value += 10
+
+        # The previous snapshot is used until a valid one is exported
+        self.assertTrue(snapshot.is_granted('pkg1', 'a'))